@@ -1,18 +1,51 @@
-import dataclasses
+# UltraSystray
+#
+# Copyright (C) 2022 Ronny Rentner
+#
+# Nothing heavy is imported here, the backends are imported when the first
+# icon is created. See benchmark/importtime.py for the import time budget.
+#
+
+#: Backends that can be selected by name, with the ``backend`` argument of
+#: SystrayIcon or the ULTRASYSTRAY_BACKEND environment variable
+BACKENDS = ('gtk', 'appindicator', 'win32', 'null')
 
-@dataclasses.dataclass
 class DefaultIcons:
     default = 32512
 
 class SystrayIcon():
-    def __new__(cls, *args, **kwargs):
-        import sys
-        if sys.platform.startswith('win32'):
+    def __new__(cls, *args, backend=None, **kwargs):
+        """
+        :param backend: The name of the backend, one of :data:`BACKENDS`.
+            Defaults to the ULTRASYSTRAY_BACKEND environment variable or else
+            to the backend of the platform.
+        """
+        import os, sys
+        backend = backend or os.environ.get('ULTRASYSTRAY_BACKEND')
+        if backend:
+            SystrayIcon = import_backend(backend).SystrayIcon
+        elif sys.platform.startswith('win32'):
             from .win32 import SystrayIcon
         elif sys.platform.startswith('darwin'):
             from .darwin import SystrayIcon
         else:
-            from .gtk import SystrayIcon
+            # The backend that works in this desktop session, see probe.py
+            from .probe import load_backend
+            SystrayIcon = load_backend().SystrayIcon
 
         return SystrayIcon(*args, **kwargs) 
 
+def import_backend(name):
+    """Imports a backend module by its name in :data:`BACKENDS`.
+    """
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown backend '{name}', use one of {', '.join(BACKENDS)}")
+    import importlib
+    return importlib.import_module(f'.{name}', __name__)
+
+def __getattr__(name):
+    # The manager pulls in the dispatcher, so it is imported on first use
+    if name == 'TrayManager':
+        from .manager import TrayManager
+        return TrayManager
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
@@ -0,0 +1,42 @@
+# UltraSystray
+#
+# Copyright (C) 2022 Ronny Rentner
+#
+
+class Animation():
+    """A looping sequence of icon frames.
+
+    The backends decode all frames once when the animation starts and then
+    only swap the decoded frames from a timer of their main loop.
+    """
+    __slots__ = ('sources', 'frames', 'interval', 'index')
+
+    def __init__(self, sources, fps=10):
+        self.sources = tuple(sources)
+        if not self.sources:
+            raise ValueError('An animation needs at least one frame')
+        if fps <= 0:
+            raise ValueError(f'Invalid frame rate {fps}')
+
+        #: Decoded frames, set by :meth:`decode`
+        self.frames = None
+        #: Milliseconds between two frames
+        self.interval = max(1, round(1000 / fps))
+        self.index = 0
+
+    def __len__(self):
+        return len(self.sources)
+
+    def decode(self, decoder):
+        """Decodes all frames with ``decoder`` unless this was already done.
+        """
+        if self.frames is None:
+            self.frames = tuple(decoder(source) for source in self.sources)
+        return self.frames
+
+    def current(self):
+        return self.frames[self.index]
+
+    def next(self):
+        self.index = (self.index + 1) % len(self.frames)
+        return self.frames[self.index]
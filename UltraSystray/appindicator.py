@@ -3,20 +3,72 @@
 # Copyright (C) 2022 Ronny Rentner
 #
 
+import time
+# Start of the import phase of the startup profile
+_import_started = time.perf_counter()
+
 import gi
 gi.require_version('Gtk', '3.0')
-gi.require_version('AyatanaAppIndicator3', '0.1')
-gi.require_version('Notify', '0.7')
+gi.require_version('GdkPixbuf', '2.0')
 
-from gi.repository import Gtk, GLib, GObject
-from gi.repository import AyatanaAppIndicator3 as AppIndicator
-from gi.repository import Notify
+from gi.repository import Gtk, Gdk, GLib, GObject, GdkPixbuf
 
+import hashlib
+import logging
 import pathlib
 import signal
+import threading
+
+from . import badge, cache, dispatch, gtk_menu, ico, icons
+from .animation import Animation
+from .archive import IconRef, cache_file
+from .dispatch import Dispatcher, marshalled
+# Indicators of a TrayManager run on the plain GTK main loop
+from .gtk import MainLoop
+from .gtk_menu import GtkMenu
+from .menu import Menu, MenuItem
+from .metrics import Metrics
+from .startup import StartupProfile
+
+_imported = time.perf_counter()
+
+log = logging.getLogger(__name__)
+
+# AyatanaAppIndicator3 is loaded when the first indicator is shown, Notify with
+# the first notification
+AppIndicator = None
+Notify = None
+
+def _load_appindicator():
+    global AppIndicator
+    if AppIndicator is None:
+        gi.require_version('AyatanaAppIndicator3', '0.1')
+        from gi.repository import AyatanaAppIndicator3
+        AppIndicator = AyatanaAppIndicator3
+    return AppIndicator
+
+def _load_notify(app_name):
+    global Notify
+    if Notify is None:
+        gi.require_version('Notify', '0.7')
+        from gi.repository import Notify as module
+        module.init(app_name)
+        Notify = module
+    return Notify
 
 class SystrayIcon():
-    def __init__(self, unique_id=None, icon=None, title=None, menu_items=None, **kwargs):
+    # AppIndicator hosts don't tell us the panel size, only the scale factor
+    # of the monitor is known
+    ICON_SIZE = 24
+
+    def __init__(self, unique_id=None, icon=None, title=None, menu_items=None, executor=None, metrics=False, startup_hook=None, **kwargs):
+        """
+        :param metrics: Records the metrics returned by :meth:`stats`.
+
+        :param startup_hook: Called with the :class:`startup.StartupProfile`
+            once the indicator is registered with the StatusNotifierWatcher.
+        """
+        started = time.perf_counter()
         self.appindicator = None
 
         self.unique_id = unique_id or self.generate_random_id()
@@ -24,29 +76,74 @@ class SystrayIcon():
         self.title = title
         self.menu_items = menu_items
 
+        self.connected = True
+        #: The size in device pixels icons are prepared for
+        self.pixels = self.ICON_SIZE
+        self._icon_path = None
+        self.badge = None
+        self.animation = None
+        self._animation_timer = None
+
+        #: Runs the public methods in the GTK main loop when they are called
+        #: from other threads
+        self.dispatcher = Dispatcher(GLib.idle_add)
+        #: :class:`concurrent.futures.Executor` for menu callbacks, which
+        #: otherwise run in the main loop
+        self.executor = executor
+        # Set while run_async() drives the main loop
+        self._stopped = None
+        #: The :class:`manager.TrayManager` hosting the indicator, if any
+        self.manager = None
+        self._monitors_handler = None
+
+        #: Set once the panel shows the icon while its main loop runs
+        self.ready = threading.Event()
+        #: Seconds :meth:`start` and :meth:`stop` took the last time
+        self.startup_duration = None
+        self.shutdown_duration = None
+        self._thread = None
+
+        #: Timestamps of the startup phases up to the first registration
+        self.startup_profile = StartupProfile((_import_started, _imported), startup_hook)
+        self.startup_profile.add('construct', started)
+        self._show_started = None
+
+        #: Counts and latencies of clicks, menu callbacks and messages
+        self.metrics = Metrics(metrics)
+
     def generate_random_id(self):
         # Generate random id if none was provided
         import random, string
         return ''.join(random.SystemRandom().choice(string.ascii_uppercase + string.digits) for _ in range(12))
 
     def show(self):
+        started = self._show_started = time.perf_counter()
+        _load_appindicator()
+
+        self.pixels = self.ICON_SIZE * self.scale_factor()
+        self._monitors_handler = Gdk.Screen.get_default().connect('monitors-changed', self.on_monitors_changed)
 
-        if isinstance(self.icon, pathlib.Path):
+        with self.startup_profile.measure('icon'):
+            icon = self._icon_path = self.current_icon_path()
+
+        if isinstance(icon, pathlib.Path):
             self.appindicator = AppIndicator.Indicator.new_with_path(
                 self.unique_id,
-                self.icon.stem,
+                icon.stem,
                 AppIndicator.IndicatorCategory.APPLICATION_STATUS,
-                str(self.icon.parent))
+                str(icon.parent))
         else:
             self.appindicator = AppIndicator.Indicator.new(
                 self.unique_id,
-                self.icon,
+                icon,
                 AppIndicator.IndicatorCategory.APPLICATION_STATUS)
 
         self.appindicator.set_status(AppIndicator.IndicatorStatus.ACTIVE)
+        self.appindicator.connect('connection-changed', self.on_connection_changed)
 
         # Appindicators must have a menu attached or otherwise they are not visible
-        self.set_menu(self.create_menu(items=self.menu_items))
+        with self.startup_profile.measure('menu'):
+            self.set_menu(self.create_menu(items=self.menu_items))
 
         # Middle click executes last menu item (which should be quit)
         self.set_middle_click_target(item=-1)
@@ -55,13 +152,201 @@ class SystrayIcon():
             self.appindicator.set_title(self.title)
             GLib.set_application_name(self.title)
 
-        Notify.init(self.unique_id)
+        if self.animation:
+            self.start_animation()
+
+        self.startup_profile.add('show', started)
+
+    def hide(self):
+        """Removes the indicator from the panel. It can be shown again with
+        :meth:`show`.
+        """
+        if self._animation_timer:
+            GLib.source_remove(self._animation_timer)
+            self._animation_timer = None
+        if self._monitors_handler:
+            Gdk.Screen.get_default().disconnect(self._monitors_handler)
+            self._monitors_handler = None
+        if self.appindicator:
+            self.appindicator.set_status(AppIndicator.IndicatorStatus.PASSIVE)
+            self.appindicator = None
+            self._icon_path = None
+
+    def icon_path(self, icon):
+        if ico.is_ico(icon):
+            # Remember the extracted frame, so that switching between icons
+            # does not parse the ICO again
+            def load():
+                path = self.cache_ico_frame(icon)
+                return path, len(str(path))
+            return cache.icons.get(cache.key(icon, self.pixels), load)
+        if isinstance(icon, IconRef):
+            # AppIndicators only take icon names and a theme path, so icons
+            # from the archive are cached once on disk by content hash
+            return icon.materialize()
+
+        data = icons.as_buffer(icon)
+        if data is not None:
+            format = icons.image_format(data)
+            if not format:
+                raise ValueError('Unknown icon data format')
+            # In-memory icons have to be cached on disk as well
+            def load():
+                path = cache_file(data, format)
+                return path, len(str(path))
+            return cache.icons.get(cache.key(data, self.pixels), load)
+
+        return icon
+
+    @marshalled
+    def set_icon(self, icon):
+        """Changes the icon.
+
+        :param icon: A :class:`pathlib.Path`, a theme icon name, an
+            :class:`archive.IconRef`, an :class:`ico.IcoFile` or encoded PNG,
+            ICO or SVG data in any object supporting the buffer protocol.
+        """
+        self.icon = icon
+        if self.appindicator and not self.animation:
+            self.apply_icon(self.current_icon_path())
+
+    @marshalled
+    def set_badge(self, value, color=badge.DEFAULT_COLOR, position='top-right'):
+        """Draws a badge like an unread count or a warning dot onto the icon.
+
+        :param value: A number, a short text, ``''`` for a plain dot or ``None``
+            to remove the badge.
+
+        Every combination of icon, badge and size is rendered only once.
+        """
+        self.badge = badge.make(value, color, position)
+        if self.appindicator and not self.animation:
+            self.apply_icon(self.current_icon_path())
+
+    def current_icon_path(self):
+        if not self.badge:
+            return self.icon_path(self.icon)
+
+        icon = self.icon
+        current = self.badge
+        def load():
+            path = self.icon_path(icon)
+            if isinstance(path, pathlib.Path):
+                pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_size(str(path), self.pixels, self.pixels)
+            else:
+                pixbuf = Gtk.IconTheme.get_default().load_icon(path, self.pixels, 0)
+            data = badge.composite_pixbuf(pixbuf, current).save_to_bufferv('png', [], [])[1]
+            path = cache_file(data, 'png')
+            return path, len(str(path))
+        return cache.icons.get(cache.key(icon, self.pixels, overlay=current), load)
+
+    def apply_icon(self, icon):
+        # Takes an icon as returned by icon_path()
+        if icon == self._icon_path:
+            return
+        self._icon_path = icon
+
+        if isinstance(icon, pathlib.Path):
+            theme_path = str(icon.parent)
+            if theme_path != self.appindicator.get_icon_theme_path():
+                self.appindicator.set_icon_theme_path(theme_path)
+            self.appindicator.set_icon_full(icon.stem, self.title or '')
+        else:
+            self.appindicator.set_icon_full(icon, self.title or '')
+
+    @marshalled
+    def animate(self, frames, fps=10):
+        """Cycles through a sequence of icons until :meth:`stop_animation` is called.
+
+        All frames are resolved to icon files once up front, every frame swap
+        only passes a new icon name to the indicator.
+        """
+        self.stop_animation(restore=False)
+        self.animation = Animation(frames, fps)
+        if self.appindicator:
+            self.start_animation()
+
+    def start_animation(self):
+        frames = self.animation.decode(self.icon_path)
+        self.apply_icon(frames[self.animation.index])
+        if self.connected:
+            self._animation_timer = GLib.timeout_add(self.animation.interval, self.next_animation_frame)
+
+    def next_animation_frame(self):
+        if not self.connected:
+            # Resumed by on_connection_changed()
+            self._animation_timer = None
+            return False
+
+        self.metrics.count('animation_frame')
+        self.apply_icon(self.animation.next())
+        return True
+
+    @marshalled
+    def stop_animation(self, restore=True):
+        if self._animation_timer:
+            GLib.source_remove(self._animation_timer)
+            self._animation_timer = None
+        self.animation = None
+
+        if restore and self.appindicator:
+            self.apply_icon(self.current_icon_path())
+
+    def scale_factor(self):
+        display = Gdk.Display.get_default()
+        monitor = display.get_primary_monitor() or display.get_monitor(0)
+        return monitor.get_scale_factor() if monitor else 1
+
+    def on_monitors_changed(self, screen):
+        # A new scale factor may need another ICO frame. The icon is only
+        # swapped if the resulting file actually differs.
+        pixels = self.ICON_SIZE * self.scale_factor()
+        if pixels == self.pixels:
+            return
+        self.pixels = pixels
+
+        if self.animation:
+            self.animation.frames = None
+            frames = self.animation.decode(self.icon_path)
+            self.apply_icon(frames[self.animation.index])
+        else:
+            self.apply_icon(self.current_icon_path())
+
+    def on_connection_changed(self, indicator, connected):
+        # Without a connection to the StatusNotifierWatcher, the indicator is
+        # not shown anywhere and animations are paused
+        self.connected = connected
+        self.metrics.count('connection_changed')
+        if connected:
+            self.startup_profile.add('embedded', self._show_started)
+            self.ready.set()
+        if self.animation and connected and not self._animation_timer:
+            self._animation_timer = GLib.timeout_add(self.animation.interval, self.next_animation_frame)
+
+    def cache_ico_frame(self, icon):
+        # AppIndicators can only load icons by name from a theme path, which
+        # does not support ICO. Thus the best fitting frame is stored once as
+        # PNG in the cache, named by its content hash.
+        frame = ico.load(icon).best(self.pixels)
+        digest = hashlib.blake2b(frame.data, digest_size=16).hexdigest()
+
+        def encode():
+            if frame.format == 'png':
+                return frame.data
+            loader = GdkPixbuf.PixbufLoader()
+            loader.write(frame.encoded().tobytes())
+            loader.close()
+            return loader.get_pixbuf().save_to_bufferv('png', [], [])[1]
+
+        return cache_file(encode, 'png', digest=digest)
 
     def abouttoshow(self, *args):
-        print("abouttoshow", *args)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('about to show %r', args, extra={ 'event': 'about_to_show' })
 
     def event(self, *args):
-        print("event", *args)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('menu event %r', args, extra={ 'event': 'dbusmenu' })
 
     def run(self):
         # Make sure that we do not inhibit CTRL-C;
@@ -69,60 +354,154 @@ class SystrayIcon():
         try: signal.signal(signal.SIGINT, signal.SIG_DFL)
         except ValueError: pass
 
+        self.dispatcher.attach()
+        try:
+            # Ready once the indicator is connected, see on_connection_changed()
+            self._start()
+            Gtk.main()
+        finally:
+            self.dispatcher.detach()
+
+    def start(self, timeout=None):
+        """Runs the icon on a thread of its own and returns once the panel
+        shows it. See :func:`dispatch.start`.
+        """
+        dispatch.start(self, timeout)
+
+    def stop(self, timeout=None):
+        """Quits the icon and waits until its main loop has ended. See
+        :func:`dispatch.stop`.
+        """
+        dispatch.stop(self, timeout)
+
+    async def run_async(self):
+        """Shows the indicator and drives the GTK main loop from the running
+        asyncio loop until :meth:`quit` is called.
+
+        Menu callbacks may be coroutine functions, they run as tasks of the
+        loop.
+        """
+        import asyncio
+        loop = asyncio.get_running_loop()
+        self._stopped = asyncio.Event()
+
+        # Calls from other threads wake up the asyncio loop directly
+        self.dispatcher.wakeup = loop.call_soon_threadsafe
+        self.dispatcher.attach()
+        try:
+            self._start()
+            await dispatch.run_glib(self._stopped)
+        finally:
+            self.dispatcher.detach()
+            self.dispatcher.wakeup = GLib.idle_add
+            self._stopped = None
+            self.hide()
+
+    def _start(self):
         self.show()
 
         server = GObject.GObject.get_property(self.appindicator, "dbus-menu-server")
-        print('server', server)
         root = GObject.GObject.get_property(server, "root-node")
-        print('root', root)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('dbus menu server %r, root %r', server, root, extra={ 'event': 'dbusmenu' })
         root.connect('about-to-show', self.abouttoshow)
         root.connect('event', self.event)
         root.connect('item-activated', self.event)
         server.connect('item-activation-requested', self.event)
 
-        Gtk.main()
+    @marshalled
+    def notify(self, message, title=None):
+        """Shows a desktop notification.
 
+        libnotify is only loaded and initialized with the first notification.
+
+        :return: the ``Notify.Notification``, e.g. to close it again
+        """
+        _load_notify(GLib.get_application_name() or self.unique_id)
+        icon = self._icon_path
+        notification = Notify.Notification.new(title or self.title or '', message, str(icon) if icon else None)
+        notification.show()
+        return notification
+
+    @marshalled
     def set_middle_click_target(self, item=-1):
         menu = self.appindicator.get_menu()
         children = menu.get_children()
         self.appindicator.set_secondary_activate_target(children[item])
 
+    @marshalled
     def set_title(self, title):
         self.title = title
         self.appindicator.set_title(self.title)
 
+    @marshalled
     def set_menu(self, menu):
         # Appindicators must have a menu attached or otherwise they are not visible
         self.appindicator.set_menu(menu)
 
     def create_menu(self, items=None):
-        menu = Gtk.Menu.new()
-        if items:
-            for item in items:
-                menu.append(self.create_menu_item(**item))
-        else:
-            menu.append(self.create_menu_item('Quit', Gtk.main_quit))
-        menu.show_all()
+        return GtkMenu(items or [{'key': 'quit', 'label': 'Quit', 'callback': self.quit}], runner=self.run_callback)
 
-        return menu
+    def run_callback(self, item, argument, set_busy=None):
+        """Runs the callback of a clicked menu item, on the executor of the
+        item or of the icon if there is one.
+        """
+        return dispatch.run_callback(self.dispatcher, self.executor, item, argument, set_busy, self.metrics)
 
-    def create_menu_item(self, label='', callback=None, variant='default', active=True, enabled=True):
+    def stats(self, format=None):
+        """Returns counts and latency histograms of clicks, menu callbacks and
+        main loop messages, see :class:`metrics.Metrics`. They are only
+        recorded if the icon was created with ``metrics=True``.
 
-        if variant == 'separator':
-            return Gtk.SeparatorMenuItem()
+        :param format: ``'openmetrics'`` for the OpenMetrics text format
+            instead of a dict.
+        """
+        if format == 'openmetrics':
+            return self.metrics.openmetrics(self.dispatcher.dispatched)
+        if format is not None:
+            raise ValueError(f'Unknown format {format!r}')
+        return self.metrics.snapshot(self.dispatcher.dispatched)
 
-        menu_item = None
-        if variant == 'check':
-            menu_item = Gtk.CheckMenuItem.new_with_label(label)
-            menu_item.set_active(active)
-        else:
-            menu_item = Gtk.MenuItem.new_with_label(label)
-            menu_item.set_sensitive(enabled)
+    def create_menu_item(self, label='', callback=None, variant='default', active=True, enabled=True, key=None, submenu=None):
+        return gtk_menu.create_widget(MenuItem(label, callback, variant, active, enabled, key, submenu))[0]
 
-        menu_item.connect('activate', callback)
+    @marshalled
+    def update_menu(self, items):
+        """Changes the menu items.
 
-        return menu_item
+        :param items: A :class:`menu.Menu` or a list of :class:`menu.MenuItem`
+            instances or dicts. Showing the same :class:`menu.Menu` again does
+            nothing.
 
-    @classmethod
-    def quit(cls, menu_item):
-        Gtk.main_quit()
+        Items are matched by their ``key``, or by variant and label if they
+        have none. Only the changed widgets are touched, so the host only
+        receives small DBusMenu updates.
+        """
+        # Validates the items before anything is changed
+        self.menu_items = items = Menu.coerce(items)
+        if not self.appindicator:
+            return
+
+        menu = self.appindicator.get_menu()
+        children = menu.get_children()
+        target = children[-1] if children else None
+        menu.update(items)
+
+        children = menu.get_children()
+        if children and children[-1] is not target:
+            self.set_middle_click_target(item=-1)
+
+    @marshalled
+    def quit(self, *args):
+        """Ends the main loop.
+
+        Indicators hosted by a :class:`manager.TrayManager` are only removed
+        from it, the main loop keeps running for the other icons.
+        """
+        if self.manager:
+            self.manager.remove(self)
+            return
+        if self._stopped:
+            self._stopped.set()
+        else:
+            Gtk.main_quit()
@@ -0,0 +1,205 @@
+# UltraSystray
+#
+# Copyright (C) 2022 Ronny Rentner
+#
+# Packs the icons tree into a single archive file and reads icons from it.
+#
+# Layout of an archive:
+#
+#   header   magic, version, offset and length of the index
+#   data     the icon files, identical files are stored only once
+#   index    zlib compressed JSON manifest, see UltraSystray.icons
+#
+# The reader maps the archive into memory and hands out memoryviews into the
+# mapping, so uncompressed icons are never copied.
+#
+
+import hashlib
+import json
+import mmap
+import pathlib
+import struct
+import zlib
+
+from . import icons
+
+ARCHIVE_PATH = pathlib.Path(__file__).parent / 'icons.pack'
+
+MAGIC = b'USICONS\x00'
+VERSION = 1
+
+# magic, version, index offset, index length
+_HEADER = struct.Struct('<8sIQQ')
+
+
+class IconRef():
+    """Reference to an icon inside a :class:`icons.Manifest` or :class:`IconArchive`.
+
+    All backends accept an :class:`IconRef` wherever they accept a :class:`pathlib.Path`.
+    """
+    __slots__ = ('source', 'entry')
+
+    def __init__(self, source, entry):
+        self.source = source
+        self.entry = entry
+
+    def __repr__(self):
+        return f"IconRef('{self.entry.name}', variant='{self.entry.variant}', size={self.entry.size}, format='{self.entry.format}')"
+
+    @property
+    def name(self):
+        return self.entry.name
+
+    @property
+    def format(self):
+        return self.entry.format
+
+    @property
+    def hash(self):
+        return self.entry.hash
+
+    def data(self):
+        """Returns the encoded icon as :class:`memoryview`.
+        """
+        return self.source.data(self.entry)
+
+    def materialize(self, directory=None):
+        """Returns a path to the icon on the filesystem for toolkits that only
+        accept file names.
+
+        Icons from an archive are written once into a cache directory, named by
+        their content hash, and reused from there.
+        """
+        path = self.source.path(self.entry)
+        if path:
+            return path
+
+        return cache_file(self.data, self.entry.format, digest=self.entry.hash, directory=directory)
+
+
+class IconArchive(icons.Manifest):
+    def __init__(self, path=ARCHIVE_PATH):
+        self.archive_path = pathlib.Path(path)
+
+        with open(self.archive_path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._mmap)
+
+        magic, version, index_offset, index_length = _HEADER.unpack_from(self._mmap)
+        if magic != MAGIC:
+            raise ValueError(f"'{self.archive_path}' is not an icon archive")
+        if version != VERSION:
+            raise ValueError(f"Unsupported icon archive version '{version}'")
+
+        data = json.loads(zlib.decompress(self._view[index_offset:index_offset + index_length]))
+        if data.get('version') != icons.MANIFEST_VERSION:
+            raise ValueError(f"Unsupported icon manifest version '{data.get('version')}'")
+        super().__init__([icons.IconEntry._make(row) for row in data['icons']], root=self.archive_path.parent)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._view.release()
+        self._mmap.close()
+
+    def path(self, entry):
+        # Icons inside an archive have no path of their own
+        return None
+
+    def data(self, entry):
+        view = self._view[entry.offset:entry.offset + entry.length]
+        if entry.compression == 'zlib':
+            return memoryview(zlib.decompress(view))
+        return view
+
+
+def pack(manifest, path=ARCHIVE_PATH, compress=False):
+    """Packs all icons of a manifest into a single archive file.
+
+    :param manifest: The :class:`icons.Manifest` of a loose icons tree.
+
+    :param compress: Compress every entry with zlib if that makes it smaller.
+        Compressed entries have to be decompressed on access and are not
+        zero-copy anymore.
+
+    :return: the number of bytes written
+    """
+    entries = []
+    # Offset and length of every unique content hash already written
+    written = {}
+
+    with open(path, 'wb') as f:
+        f.write(b'\0' * _HEADER.size)
+        offset = _HEADER.size
+
+        for entry in manifest.entries:
+            if entry.hash not in written:
+                data = manifest.data(entry).tobytes()
+                compression = ''
+                if compress:
+                    compressed = zlib.compress(data, 9)
+                    if len(compressed) < len(data):
+                        data = compressed
+                        compression = 'zlib'
+                f.write(data)
+                written[entry.hash] = (offset, len(data), compression)
+                offset += len(data)
+
+            stored_offset, stored_length, compression = written[entry.hash]
+            entries.append(entry._replace(offset=stored_offset, length=stored_length, compression=compression))
+
+        index = zlib.compress(json.dumps({
+            'version': icons.MANIFEST_VERSION,
+            'fields': icons.IconEntry._fields,
+            'icons': entries,
+        }, separators=(',', ':')).encode(), 9)
+        f.write(index)
+
+        f.seek(0)
+        f.write(_HEADER.pack(MAGIC, VERSION, offset, len(index)))
+
+    return offset + len(index)
+
+
+def cache_directory():
+    import os
+    base = os.environ.get('XDG_CACHE_HOME') or pathlib.Path.home() / '.cache'
+    return pathlib.Path(base) / 'UltraSystray' / 'icons'
+
+
+def cache_file(data, format, digest=None, directory=None):
+    """Stores encoded icon data once in the cache directory, named by its
+    content hash, and returns the path.
+
+    :param data: A buffer or a callable returning one. The callable is only
+        invoked if the file does not exist yet.
+    """
+    if digest is None:
+        if callable(data):
+            data = data()
+        digest = hashlib.blake2b(data, digest_size=16).hexdigest()
+
+    directory = pathlib.Path(directory or cache_directory())
+    path = directory / f'{digest}.{format}'
+    if not path.exists():
+        directory.mkdir(parents=True, exist_ok=True)
+        partial = path.with_suffix('.partial')
+        partial.write_bytes(data() if callable(data) else data)
+        partial.replace(path)
+    return path
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Pack the icons tree into a single archive')
+    parser.add_argument('root', nargs='?', default=icons.ICONS_PATH, type=pathlib.Path)
+    parser.add_argument('--output', '-o', default=ARCHIVE_PATH, type=pathlib.Path)
+    parser.add_argument('--compress', action='store_true', help='zlib compress every entry')
+    args = parser.parse_args()
+
+    size = pack(icons.Manifest.build(args.root), args.output, compress=args.compress)
+    print(f"Wrote {size} bytes to '{args.output}'")
@@ -0,0 +1,189 @@
+# UltraSystray
+#
+# Copyright (C) 2022 Ronny Rentner
+#
+# Badges like unread counts or warning dots drawn on top of an icon.
+#
+# Badges are rendered with a tiny built-in bitmap font and alpha blended onto
+# the RGBA pixels of the decoded icon, so no font or imaging library is
+# needed. Only the pixels below the badge are touched. The backends cache the
+# result per icon, badge and size.
+#
+
+import collections
+
+from . import ico
+
+POSITIONS = ('top-right', 'top-left', 'bottom-right', 'bottom-left')
+
+DEFAULT_COLOR = (220, 40, 40, 255)
+TEXT_COLOR = (255, 255, 255, 255)
+
+# Numbers above this are shown as '99+'
+MAX_NUMBER = 99
+
+# 3x5 pixel glyphs, one string per row
+FONT = {
+    '0': ('111', '101', '101', '101', '111'),
+    '1': ('010', '110', '010', '010', '111'),
+    '2': ('111', '001', '111', '100', '111'),
+    '3': ('111', '001', '011', '001', '111'),
+    '4': ('101', '101', '111', '001', '001'),
+    '5': ('111', '100', '111', '001', '111'),
+    '6': ('111', '100', '111', '101', '111'),
+    '7': ('111', '001', '010', '010', '010'),
+    '8': ('111', '101', '111', '101', '111'),
+    '9': ('111', '101', '111', '001', '111'),
+    '+': ('000', '010', '111', '010', '000'),
+    '-': ('000', '000', '111', '000', '000'),
+    '!': ('010', '010', '010', '000', '010'),
+    '?': ('111', '001', '011', '000', '010'),
+}
+GLYPH_WIDTH = 3
+GLYPH_HEIGHT = 5
+
+Badge = collections.namedtuple('Badge', ('text', 'color', 'position'))
+
+
+def make(value, color=DEFAULT_COLOR, position='top-right'):
+    """Creates a hashable :class:`Badge` from user input.
+
+    :param value: A number, a short text of the characters in :data:`FONT`, an
+        empty string for a plain dot or ``None`` for no badge at all.
+
+    :param color: An ``(r, g, b[, a])`` tuple or a ``'#rrggbb[aa]'`` string.
+
+    :return: a :class:`Badge` or ``None``
+    """
+    if value is None:
+        return None
+
+    if isinstance(value, int):
+        text = f'{MAX_NUMBER}+' if value > MAX_NUMBER else str(value)
+    else:
+        text = str(value)
+
+    unknown = set(text) - FONT.keys()
+    if unknown:
+        raise ValueError(f"Badges cannot show the characters {''.join(sorted(unknown))!r}")
+
+    if position not in POSITIONS:
+        raise ValueError(f"Invalid badge position '{position}', use one of {', '.join(POSITIONS)}")
+
+    return Badge(text, parse_color(color), position)
+
+
+def parse_color(color):
+    if isinstance(color, str):
+        value = color.lstrip('#')
+        if len(value) not in (6, 8):
+            raise ValueError(f"Invalid color '{color}'")
+        color = tuple(bytes.fromhex(value))
+
+    color = tuple(int(c) for c in color)
+    if len(color) == 3:
+        color += (255,)
+    if len(color) != 4 or not all(0 <= c <= 255 for c in color):
+        raise ValueError(f"Invalid color {color}")
+    return color
+
+
+def composite(rgba, width, height, badge):
+    """Draws a badge onto RGBA pixels.
+
+    :param rgba: RGBA pixels, row by row from the top without padding.
+
+    :return: a new :class:`bytearray` with the badge drawn on it
+    """
+    out = bytearray(rgba)
+    size = min(width, height)
+
+    # The badge is a circle covering about half of the icon, or a pill if the
+    # text does not fit into a circle
+    diameter = max(7, round(size * 0.55))
+    scale = max(1, int(diameter * 0.6) // GLYPH_HEIGHT)
+    text_width = len(badge.text) * (GLYPH_WIDTH + 1) * scale - scale if badge.text else 0
+    badge_width = min(width, max(diameter, text_width + 2 * scale + diameter // 2))
+    badge_height = min(height, diameter)
+
+    left = width - badge_width if badge.position.endswith('right') else 0
+    top = 0 if badge.position.startswith('top') else height - badge_height
+
+    # The pill is the set of points within radius of the horizontal segment
+    # between the centers of its end caps
+    radius = badge_height / 2
+    cy = top + radius
+    x0 = left + radius
+    x1 = left + badge_width - radius
+
+    r, g, b, a = badge.color
+    for y in range(top, top + badge_height):
+        py = y + 0.5
+        for x in range(left, left + badge_width):
+            px = x + 0.5
+            dx = x0 - px if px < x0 else px - x1 if px > x1 else 0
+            distance = (dx * dx + (py - cy) ** 2) ** 0.5
+            # Anti-aliased edge
+            coverage = min(1.0, max(0.0, radius - distance + 0.5))
+            if coverage:
+                _blend(out, (y * width + x) * 4, r, g, b, round(a * coverage))
+
+    if badge.text:
+        text_left = left + (badge_width - text_width) // 2
+        text_top = top + (badge_height - GLYPH_HEIGHT * scale) // 2
+        tr, tg, tb, ta = TEXT_COLOR
+        for i, char in enumerate(badge.text):
+            glyph_left = text_left + i * (GLYPH_WIDTH + 1) * scale
+            for row, bits in enumerate(FONT[char]):
+                for column, bit in enumerate(bits):
+                    if bit != '1':
+                        continue
+                    for y in range(text_top + row * scale, text_top + (row + 1) * scale):
+                        for x in range(glyph_left + column * scale, glyph_left + (column + 1) * scale):
+                            if 0 <= x < width and 0 <= y < height:
+                                _blend(out, (y * width + x) * 4, tr, tg, tb, ta)
+
+    return out
+
+
+def _blend(dst, i, r, g, b, a):
+    """Blends a single straight alpha pixel over ``dst[i:i + 4]``.
+    """
+    da = dst[i + 3]
+    if a == 255 or da == 0:
+        dst[i:i + 4] = bytes((r, g, b, a))
+        return
+
+    inverse = da * (255 - a) // 255
+    oa = a + inverse
+    dst[i] = (r * a + dst[i] * inverse) // oa
+    dst[i + 1] = (g * a + dst[i + 1] * inverse) // oa
+    dst[i + 2] = (b * a + dst[i + 2] * inverse) // oa
+    dst[i + 3] = oa
+
+
+def composite_pixbuf(pixbuf, badge):
+    """Returns a new GdkPixbuf with a badge drawn onto ``pixbuf``.
+    """
+    from gi.repository import GdkPixbuf, GLib
+
+    if not pixbuf.get_has_alpha():
+        pixbuf = pixbuf.add_alpha(False, 0, 0, 0)
+
+    width = pixbuf.get_width()
+    height = pixbuf.get_height()
+    stride = pixbuf.get_rowstride()
+    pixels = pixbuf.get_pixels()
+    rgba = b''.join(pixels[y * stride:y * stride + width * 4] for y in range(height))
+
+    out = composite(rgba, width, height, badge)
+    return GdkPixbuf.Pixbuf.new_from_bytes(
+        GLib.Bytes.new(bytes(out)), GdkPixbuf.Colorspace.RGB, True, 8, width, height, width * 4)
+
+
+def composite_frame(frame, badge):
+    """Returns a new 32 bit :class:`ico.IcoFrame` with a badge drawn onto a PNG
+    or 32 bit BMP frame, see :meth:`ico.IcoFrame.rgba`.
+    """
+    rgba = frame.rgba()
+    return ico.IcoFrame.from_rgba(frame.width, frame.height, composite(rgba, frame.width, frame.height, badge))
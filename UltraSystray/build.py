@@ -0,0 +1,287 @@
+# UltraSystray
+#
+# Copyright (C) 2022 Ronny Rentner
+#
+# Build pipeline for the icons tree:
+#
+#   python -m UltraSystray.build [--jobs N] [--formats ico,png] [--manifest] [--pack] [root]
+#
+# 1. Upstream material icons (<category>/<name>/materialicons<variant>/<size>px.svg)
+#    are moved into the flat layout <category>/<name>[-<variant>]-<size>px.svg
+# 2. Every SVG is converted to ICO and PNG on a process pool. Sources with
+#    identical content are converted only once.
+# 3. The content hash of every source is kept in a state file, so later runs
+#    only convert sources that have changed.
+#
+# SVGs are rendered with cairosvg if it is installed, otherwise with
+# ImageMagick's `convert`.
+#
+
+import concurrent.futures
+import hashlib
+import json
+import os
+import pathlib
+import shutil
+import subprocess
+
+from . import ico, icons
+
+ICO_SIZES = (256, 96, 64, 48, 32, 24, 16)
+PNG_SIZE = 256
+FORMATS = ('ico', 'png')
+
+STATE_NAME = '.build-state.json'
+STATE_VERSION = 1
+
+
+def reorganize(root):
+    """Moves upstream material icons into the flat layout of the icons tree.
+
+    Empty directories are removed once at the end and not after every file.
+
+    :return: the number of moved files
+    """
+    root = pathlib.Path(root)
+    moved = 0
+    directories = set()
+
+    for path in list(root.rglob('materialicons*/*.svg')):
+        source_dir = path.parent
+        name_dir = source_dir.parent
+        # The variant like 'round', 'outlined', 'twotone', etc.
+        variant = source_dir.name[len('materialicons'):]
+        target = name_dir.parent / f"{name_dir.name}{'-' + variant if variant else ''}-{path.name}"
+
+        os.replace(path, target)
+        directories.update((source_dir, name_dir))
+        moved += 1
+
+    # Deepest directories first
+    for directory in sorted(directories, key=lambda d: len(d.parts), reverse=True):
+        try:
+            directory.rmdir()
+        except OSError:
+            pass
+
+    return moved
+
+
+def render_pngs(source, sizes):
+    """Renders an SVG file to PNG data for every size in ``sizes``.
+
+    :return: a dict mapping every size to its PNG data
+    """
+    try:
+        import cairosvg
+    except ImportError:
+        cairosvg = None
+
+    if cairosvg:
+        return { size: cairosvg.svg2png(url=str(source), output_width=size, output_height=size) for size in sizes }
+
+    # A single convert process rasterizes the SVG once and writes a resized
+    # copy per size
+    import tempfile
+    with tempfile.TemporaryDirectory() as directory:
+        paths = { size: pathlib.Path(directory) / f'{size}.png' for size in sizes }
+        command = ['convert', '-background', 'none', '-density', '1200', str(source)]
+        for size, path in paths.items():
+            command += ['(', '+clone', '-resize', f'{size}x{size}', '-write', f'png:{path}', '+delete', ')']
+        command.append('null:')
+        subprocess.run(command, check=True, capture_output=True)
+        return { size: path.read_bytes() for size, path in paths.items() }
+
+
+def convert_icon(source, outputs, ico_sizes=ICO_SIZES, png_size=PNG_SIZE):
+    """Converts a single SVG file. This is run in the worker processes.
+
+    :param outputs: Mapping from format to output path.
+
+    :return: the list of written paths
+    """
+    sizes = set()
+    for format in outputs:
+        if format == 'ico':
+            sizes.update(ico_sizes)
+        elif format == 'png':
+            sizes.add(png_size)
+        else:
+            raise ValueError(f"Unsupported output format '{format}'")
+    pngs = render_pngs(source, sorted(sizes, reverse=True))
+
+    written = []
+    for format, output in outputs.items():
+        if format == 'ico':
+            data = ico.encode(ico.IcoFrame.from_png(pngs[size]) for size in ico_sizes)
+        else:
+            data = pngs[png_size]
+
+        partial = output.with_name(output.name + '.partial')
+        partial.write_bytes(data)
+        os.replace(partial, output)
+        written.append(output)
+
+    return written
+
+
+class State():
+    """Remembers stat data and content hash of every source from the last build.
+    """
+    def __init__(self, path, options):
+        self.path = pathlib.Path(path)
+        self.options = options
+        self.sources = {}
+        self.changed = True
+
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+
+        # Changed options invalidate everything that was built before
+        if data.get('version') == STATE_VERSION and data.get('options') == options:
+            self.sources = data['sources']
+            self.changed = False
+
+    def hash(self, path, relative):
+        """Returns the content hash of a source, reusing the hash from the
+        last build if the file was not touched since.
+
+        :return: the hash and whether it differs from the last build
+        """
+        stat = os.stat(path)
+        known = self.sources.get(relative)
+        if known and known[0] == stat.st_mtime_ns and known[1] == stat.st_size:
+            return known[2], False
+
+        with open(path, 'rb') as f:
+            digest = hashlib.blake2b(f.read(), digest_size=16).hexdigest()
+        changed = not known or known[2] != digest
+        self.sources[relative] = [stat.st_mtime_ns, stat.st_size, digest]
+        self.changed = True
+        return digest, changed
+
+    def forget(self, relative):
+        if self.sources.pop(relative, None):
+            self.changed = True
+
+    def save(self):
+        partial = self.path.with_name(self.path.name + '.partial')
+        with open(partial, 'w') as f:
+            json.dump({'version': STATE_VERSION, 'options': self.options, 'sources': self.sources}, f, separators=(',', ':'))
+        os.replace(partial, self.path)
+
+
+def build(root=icons.ICONS_PATH, output=None, formats=FORMATS, jobs=None, force=False, log=print):
+    """Reorganizes and converts the icons tree.
+
+    :param output: Directory for the converted icons, by default they are
+        written next to their sources.
+
+    :param jobs: Number of worker processes, defaults to the number of CPUs.
+
+    :param force: Ignore the state of previous builds.
+
+    :return: the number of converted sources
+    """
+    root = pathlib.Path(root)
+    output = pathlib.Path(output or root)
+    formats = tuple(formats)
+
+    moved = reorganize(root)
+    if moved:
+        log(f'Moved {moved} material icons')
+
+    state = State(output / STATE_NAME, {'formats': list(formats), 'ico_sizes': list(ICO_SIZES), 'png_size': PNG_SIZE})
+    if force:
+        state.sources = {}
+
+    # Sources to convert, grouped by content hash. This loop runs over the
+    # whole tree on every build, so it sticks to plain strings and one stat
+    # call per source.
+    pending = {}
+    seen = set()
+    for directory, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        prefix = pathlib.Path(directory).relative_to(root).as_posix()
+        prefix = '' if prefix == '.' else prefix + '/'
+        # Without a separate output directory, the targets are in the listing
+        existing = set(filenames) if output == root else None
+
+        for filename in sorted(filenames):
+            if not filename.endswith('.svg'):
+                continue
+            relative = prefix + filename
+            seen.add(relative)
+            digest, changed = state.hash(os.path.join(directory, filename), relative)
+
+            stem = relative[:-len('.svg')]
+            if existing is not None:
+                missing = any(f'{filename[:-len(".svg")]}.{format}' not in existing for format in formats)
+            else:
+                missing = any(not os.path.exists(output / f'{stem}.{format}') for format in formats)
+
+            if changed or missing:
+                targets = {format: output / f'{stem}.{format}' for format in formats}
+                pending.setdefault(digest, []).append((root / relative, targets))
+
+    # Forget sources that were removed
+    for relative in state.sources.keys() - seen:
+        state.forget(relative)
+
+    if pending:
+        for group in pending.values():
+            for source, targets in group:
+                for target in targets.values():
+                    target.parent.mkdir(parents=True, exist_ok=True)
+
+        with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+            futures = {executor.submit(convert_icon, *group[0]): group for group in pending.values()}
+            for future in concurrent.futures.as_completed(futures):
+                group = futures[future]
+                try:
+                    future.result()
+                except Exception as e:
+                    # Convert it again next time
+                    for source, targets in group:
+                        state.forget(source.relative_to(root).as_posix())
+                    log(f"Cannot convert '{group[0][0]}': {e}")
+                    continue
+
+                # Duplicates get a copy of the first result
+                first_targets = group[0][1]
+                for source, targets in group[1:]:
+                    for format, target in targets.items():
+                        shutil.copyfile(first_targets[format], target)
+
+    if state.changed:
+        state.save()
+
+    converted = sum(len(group) for group in pending.values())
+    log(f'Converted {converted} icons ({len(pending)} unique)')
+    return converted
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Reorganize and convert the icons tree')
+    parser.add_argument('root', nargs='?', default=icons.ICONS_PATH, type=pathlib.Path)
+    parser.add_argument('--output', '-o', type=pathlib.Path, help='write converted icons here instead of next to their sources')
+    parser.add_argument('--formats', default=','.join(FORMATS), help='comma separated output formats (default: %(default)s)')
+    parser.add_argument('--jobs', '-j', type=int, help='number of worker processes')
+    parser.add_argument('--force', action='store_true', help='convert everything, ignoring previous builds')
+    parser.add_argument('--manifest', action='store_true', help='update the icon manifest afterwards')
+    parser.add_argument('--pack', action='store_true', help='update the icon archive afterwards')
+    args = parser.parse_args()
+
+    build(args.root, args.output, formats=args.formats.split(','), jobs=args.jobs, force=args.force)
+
+    if args.manifest or args.pack:
+        manifest = icons.Manifest.build(args.output or args.root)
+        if args.manifest:
+            manifest.save()
+        if args.pack:
+            from . import archive
+            archive.pack(manifest)
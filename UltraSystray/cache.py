@@ -0,0 +1,130 @@
+# UltraSystray
+#
+# Copyright (C) 2022 Ronny Rentner
+#
+# Process-wide cache of decoded icons, shared by all tray icons.
+#
+# Backends store whatever their toolkit needs (a GdkPixbuf on Linux, an HICON
+# on Windows) under a key of source identity, modification time, pixel size
+# and scale. Entries are evicted least recently used first once the byte
+# budget is exceeded.
+#
+
+import collections
+import hashlib
+import pathlib
+import threading
+
+DEFAULT_MAX_BYTES = 16 * 1024 * 1024
+
+
+class IconCache():
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        # key -> (value, size in bytes, release callback)
+        self._entries = collections.OrderedDict()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, loader, release=None):
+        """Returns the cached value for ``key`` or creates it with ``loader``.
+
+        :param loader: Callable without arguments returning a tuple of the
+            decoded icon and its size in bytes.
+
+        :param release: Optional callable that is given the decoded icon when
+            it is evicted, e.g. to free native handles.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+
+            self.misses += 1
+            value, size = loader()
+
+            self._entries[key] = (value, size, release)
+            self.bytes += size
+            self._evict()
+            return value
+
+    def _evict(self):
+        # The newest entry is always kept, even if it exceeds the budget alone
+        while self.bytes > self.max_bytes and len(self._entries) > 1:
+            key, (value, size, release) = self._entries.popitem(last=False)
+            self.bytes -= size
+            self.evictions += 1
+            if release:
+                release(value)
+
+    def resize(self, max_bytes):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            entries = list(self._entries.values())
+            self._entries.clear()
+            self.bytes = 0
+        for value, size, release in entries:
+            if release:
+                release(value)
+
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'bytes': self.bytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+def source_key(icon):
+    """Returns the identity of an icon source.
+
+    Files are identified by path and modification time, everything else by
+    content hash or name.
+    """
+    if isinstance(icon, pathlib.Path):
+        return ('file', str(icon), icon.stat().st_mtime_ns)
+
+    # IconRef from the icon archive
+    digest = getattr(icon, 'hash', None)
+    if isinstance(digest, str):
+        return ('hash', digest)
+
+    # Stock or theme icon names
+    if isinstance(icon, str):
+        return ('name', icon)
+
+    # IcoFile or anything supporting the buffer protocol
+    data = getattr(icon, 'data', icon)
+    return ('hash', hashlib.blake2b(data, digest_size=16).hexdigest())
+
+
+def key(icon, size, scale=1, overlay=None):
+    """Returns the cache key of an icon decoded at a pixel size and scale.
+
+    :param overlay: Anything hashable that is drawn onto the icon, e.g. a badge.
+    """
+    return (source_key(icon), size, scale, overlay)
+
+
+#: The cache shared by all icons of the process
+icons = IconCache()
@@ -0,0 +1,485 @@
+# UltraSystray
+#
+# Copyright (C) 2022 Ronny Rentner
+#
+# Marshals calls from any thread into the thread running the main loop of the
+# tray icon.
+#
+# Calls from the main loop thread itself, or from the thread that created the
+# tray before its main loop is started, are executed right away. All other
+# calls are queued in order, also before the main loop runs, and the main loop
+# is woken up once per batch, with GLib.idle_add() on Linux and a posted window
+# message on Windows. While start() brings up the main loop thread, calls from
+# all threads are queued. Once the main loop has ended, calls raise
+# RuntimeError.
+#
+# Menu and click callbacks may be coroutine functions. They run as tasks of
+# the asyncio loop that drives the tray with run_async(). asyncio and inspect
+# are only imported when they are needed, they are slow to import.
+#
+# start() and stop() run the main loop of a tray icon on a thread of its own.
+#
+
+import collections
+import concurrent.futures
+import functools
+import logging
+import select
+import threading
+import time
+
+from .metrics import item_name
+
+log = logging.getLogger(__name__)
+
+
+class Dispatcher():
+    def __init__(self, wakeup):
+        """
+        :param wakeup: Thread-safe callable that is given :meth:`drain` and
+            makes the main loop call it soon, e.g. ``GLib.idle_add``.
+        """
+        self.wakeup = wakeup
+        #: Ident of the thread that created the dispatcher, the only one that
+        #: calls directly before the main loop runs
+        self.owner = threading.get_ident()
+        #: Ident of the main loop thread while it runs
+        self.thread = None
+        #: Set from :meth:`starting` until :meth:`attach`, while the main loop
+        #: thread is starting up
+        self.pending = False
+        #: Set by :meth:`detach` once the main loop has ended
+        self.ended = False
+
+        self._calls = collections.deque()
+        self._lock = threading.Lock()
+        # Held by direct calls before the main loop runs, so attach() waits
+        # for them and everything after it is queued
+        self._direct = threading.RLock()
+        self._scheduled = False
+        #: Number of calls from other threads run by :meth:`drain`
+        self.dispatched = 0
+
+    def starting(self):
+        """Called before the main loop is started on another thread. Until it
+        calls :meth:`attach`, calls from all threads are queued.
+        """
+        with self._direct:
+            self.pending = True
+            self.ended = False
+
+    def attach(self):
+        """Marks the calling thread as main loop thread.
+        """
+        with self._direct:
+            self.thread = threading.get_ident()
+            self.pending = False
+            self.ended = False
+
+    def detach(self):
+        """Called when the main loop has ended. Pending calls are cancelled,
+        later calls raise :class:`RuntimeError`.
+        """
+        self.thread = None
+        self.pending = False
+        self.ended = True
+        with self._lock:
+            calls = self._calls
+            self._calls = collections.deque()
+            self._scheduled = False
+        for future, function, args, kwargs in calls:
+            future.cancel()
+
+    def on_loop_thread(self):
+        if self.thread is None:
+            # Before the main loop is started, the thread that created the
+            # tray calls directly, e.g. to set it up before run()
+            return not self.pending and not self.ended and self.owner == threading.get_ident()
+        return self.thread == threading.get_ident()
+
+    def call(self, function, *args, **kwargs):
+        """Calls ``function`` in the main loop thread.
+
+        :return: a :class:`concurrent.futures.Future` of the result. It is done
+            already if the function was called directly.
+
+        :raises RuntimeError: if the main loop has ended
+        """
+        future = concurrent.futures.Future()
+        # Exceptions of direct calls are raised right away, like without a
+        # dispatcher
+        if self.thread is None:
+            with self._direct:
+                if self.on_loop_thread():
+                    future.set_result(function(*args, **kwargs))
+                    return future
+        elif self.thread == threading.get_ident():
+            future.set_result(function(*args, **kwargs))
+            return future
+        if self.ended:
+            raise RuntimeError('The main loop has ended')
+
+        with self._lock:
+            self._calls.append((future, function, args, kwargs))
+            schedule = not self._scheduled
+            self._scheduled = True
+        if schedule:
+            self.wakeup(self.drain)
+        return future
+
+    def drain(self, *args):
+        """Runs all queued calls in order. Must be called in the main loop thread.
+        """
+        with self._lock:
+            calls = self._calls
+            self._calls = collections.deque()
+            self._scheduled = False
+
+        self.dispatched += len(calls)
+        for future, function, args, kwargs in calls:
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(function(*args, **kwargs))
+            except BaseException as e:
+                # Raised by the future to the caller
+                future.set_exception(e)
+
+        # Removes the GLib idle source
+        return False
+
+
+def start(tray, timeout=None):
+    """Runs ``tray.run()`` on a new thread and waits until ``tray.ready`` is
+    set, i.e. until the panel shows the icon while its main loop runs.
+
+    The time this took is stored in ``tray.startup_duration``.
+
+    :raises TimeoutError: if the icon wasn't ready within ``timeout`` seconds,
+        e.g. because there is no tray. The icon keeps running and may still
+        show up later.
+    :raises RuntimeError: if the main loop failed to start
+    """
+    if tray._thread and tray._thread.is_alive():
+        raise RuntimeError('The icon is running already')
+
+    errors = []
+    def run():
+        try:
+            tray.run()
+        except BaseException as e:
+            if tray.ready.is_set():
+                raise
+            # Raised by start() instead
+            errors.append(e)
+        finally:
+            if tray.dispatcher.pending:
+                # Failed before the main loop ran
+                tray.dispatcher.detach()
+            # Wakes up start() if the main loop failed early
+            tray.ready.set()
+
+    started = time.perf_counter()
+    tray.ready.clear()
+    # Calls from other threads are queued until the main loop thread runs
+    tray.dispatcher.starting()
+    tray._thread = threading.Thread(target=run, name='UltraSystray', daemon=True)
+    tray._thread.start()
+
+    if not tray.ready.wait(timeout):
+        raise TimeoutError(f'The icon was not ready within {timeout} seconds')
+    if errors:
+        raise RuntimeError('The main loop of the icon failed to start') from errors[0]
+    tray.startup_duration = time.perf_counter() - started
+
+
+def stop(tray, timeout=None):
+    """Quits the main loop of ``tray`` and waits until it has ended. The time
+    this took is stored in ``tray.shutdown_duration``. Does nothing if the main
+    loop isn't running.
+
+    :raises TimeoutError: if the main loop didn't end within ``timeout`` seconds
+    """
+    started = time.perf_counter()
+    thread = tray._thread
+    dispatcher = tray.dispatcher
+    if thread is None and dispatcher.thread is None and not dispatcher.pending:
+        # Stopped already, or the main loop never ran
+        pass
+    elif thread is None or thread is threading.current_thread():
+        # Not started by start(), or stopped from a callback
+        try:
+            tray.quit().result(timeout)
+        except concurrent.futures.TimeoutError:
+            raise TimeoutError(f'The icon did not quit within {timeout} seconds') from None
+    else:
+        if thread.is_alive():
+            tray.quit()
+        thread.join(timeout)
+        if thread.is_alive():
+            raise TimeoutError(f'The icon did not quit within {timeout} seconds')
+        tray._thread = None
+    tray.shutdown_duration = time.perf_counter() - started
+
+
+def run_callback(dispatcher, executor, item, argument, set_busy=None, metrics=None):
+    """Runs the callback of a :class:`menu.MenuItem` after it was clicked.
+
+    Callbacks run on ``item.executor`` or else on ``executor``, or in the main
+    loop thread if both are not set. Coroutine functions always run as task of
+    the running asyncio loop. While the callback runs on an executor or as
+    task, ``set_busy(True)`` disables the menu item. Afterwards, in the main
+    loop thread, ``set_busy(False)`` enables it again and ``item.done`` is
+    given the future of the callback.
+
+    :param metrics: :class:`metrics.Metrics` to record the duration of the
+        callback in, as ``menu`` event and per item.
+
+    :return: the :class:`concurrent.futures.Future` or :class:`asyncio.Task`
+        of the callback
+    """
+    import inspect
+
+    if item.executor is not None:
+        executor = item.executor
+    if metrics is not None and not metrics.enabled:
+        metrics = None
+    timed = metrics is not None or log.isEnabledFor(logging.DEBUG)
+
+    if not executor or inspect.iscoroutinefunction(item.callback):
+        future = concurrent.futures.Future()
+        started = time.perf_counter()
+        try:
+            result = item.callback(argument)
+        except Exception as e:
+            future.set_exception(e)
+        else:
+            if inspect.isawaitable(result):
+                return _run_task(item, result, set_busy, metrics, started if timed else None)
+            future.set_result(result)
+        if timed:
+            _observe(metrics, item, time.perf_counter() - started)
+        _finish(item, future)
+        return future
+
+    if set_busy:
+        set_busy(True)
+
+    def finish(future):
+        if set_busy:
+            set_busy(False)
+        _finish(item, future)
+
+    if timed:
+        future = executor.submit(_timed_callback, metrics, item, argument)
+    else:
+        future = executor.submit(item.callback, argument)
+    future.add_done_callback(lambda future: dispatcher.call(finish, future))
+    return future
+
+
+def _timed_callback(metrics, item, argument):
+    started = time.perf_counter()
+    try:
+        return item.callback(argument)
+    finally:
+        _observe(metrics, item, time.perf_counter() - started)
+
+
+def _observe(metrics, item, seconds):
+    if metrics is not None:
+        metrics.observe('menu', seconds, item)
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug('menu callback of %s took %.6f s', item_name(item), seconds,
+            extra={ 'event': 'menu', 'item': item_name(item), 'duration': seconds })
+
+
+def _run_task(item, awaitable, set_busy, metrics=None, started=None):
+    import asyncio, inspect
+
+    try:
+        task = asyncio.ensure_future(awaitable, loop=asyncio.get_running_loop())
+    except RuntimeError:
+        if inspect.iscoroutine(awaitable):
+            awaitable.close()
+        future = concurrent.futures.Future()
+        future.set_exception(RuntimeError('Async callbacks need a tray running with run_async()'))
+        _finish(item, future)
+        return future
+
+    if set_busy:
+        set_busy(True)
+
+    def finish(task):
+        if started is not None:
+            # Includes the time the task was waiting
+            _observe(metrics, item, time.perf_counter() - started)
+        if set_busy:
+            set_busy(False)
+        _finish(item, task)
+
+    task.add_done_callback(finish)
+    return task
+
+
+def schedule(result):
+    """Runs the result of a click handler as task of the running asyncio loop
+    if it is awaitable, e.g. if the handler is a coroutine function.
+    """
+    import inspect
+    if not inspect.isawaitable(result):
+        return result
+
+    import asyncio
+
+    try:
+        task = asyncio.ensure_future(result, loop=asyncio.get_running_loop())
+    except RuntimeError:
+        if inspect.iscoroutine(result):
+            result.close()
+        log.error('Async click handlers need a tray running with run_async()')
+        return None
+
+    task.add_done_callback(_report)
+    return task
+
+
+def _report(task):
+    if not task.cancelled() and task.exception():
+        log.error('An error occurred in an async click handler', exc_info=task.exception())
+
+
+async def run_glib(stopped):
+    """Drives the default GLib main context from the running asyncio loop
+    until the :class:`asyncio.Event` ``stopped`` is set.
+
+    A loop of ``gi.events.GLibEventLoopPolicy`` (PyGObject 3.50 and later) runs
+    on the GLib main context and dispatches its events by itself, so this only
+    waits. On other loops, every iteration of the context is split into its
+    prepare, query, check and dispatch steps. The file descriptors GLib polls
+    are watched by the asyncio loop, and the timeout GLib asks for is the only
+    timer, so an idle tray doesn't wake up the process.
+
+    :raises RuntimeError: if another thread owns the GLib main context, e.g.
+        because it runs ``Gtk.main()``
+    """
+    import asyncio
+    from gi.repository import GLib
+
+    loop = asyncio.get_running_loop()
+    if is_glib_loop(loop):
+        await stopped.wait()
+        return
+
+    context = GLib.MainContext.default()
+    if not context.acquire():
+        raise RuntimeError('The GLib main context is owned by another thread')
+
+    waiter = None
+    def wake(*args):
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    stop = asyncio.ensure_future(stopped.wait())
+    stop.add_done_callback(wake)
+    # File descriptor -> events watched by the asyncio loop
+    watched = {}
+    try:
+        while not stopped.is_set():
+            ready, priority = context.prepare()
+            timeout, fds = context.query(priority)
+            _watch_fds(loop, watched, fds, wake)
+
+            if ready or timeout == 0:
+                # Give other tasks a turn before looking for more events
+                await asyncio.sleep(0)
+            else:
+                waiter = loop.create_future()
+                timer = loop.call_later(timeout / 1000, wake) if timeout > 0 else None
+                try:
+                    await waiter
+                finally:
+                    waiter = None
+                    if timer:
+                        timer.cancel()
+
+            _poll_fds(fds)
+            if context.check(priority, fds):
+                context.dispatch()
+    finally:
+        stop.cancel()
+        _watch_fds(loop, watched, (), wake)
+        context.release()
+
+
+def _watch_fds(loop, watched, fds, callback):
+    """Makes the asyncio loop call ``callback`` when one of the
+    :class:`GLib.PollFD` ``fds`` is ready, and stops watching all others.
+    """
+    events = {}
+    for fd in fds:
+        events[fd.fd] = events.get(fd.fd, 0) | fd.events
+
+    for fd in list(watched):
+        if events.get(fd) != watched[fd]:
+            loop.remove_reader(fd)
+            loop.remove_writer(fd)
+            del watched[fd]
+
+    for fd, mask in events.items():
+        if fd in watched:
+            continue
+        # GLib.IOCondition has the values of the poll() events
+        if mask & (select.POLLIN | select.POLLPRI):
+            loop.add_reader(fd, callback)
+        if mask & select.POLLOUT:
+            loop.add_writer(fd, callback)
+        watched[fd] = mask
+
+
+def _poll_fds(fds):
+    """Sets the ``revents`` of the :class:`GLib.PollFD` ``fds`` without waiting.
+    """
+    if not fds:
+        return
+    events = {}
+    for fd in fds:
+        events[fd.fd] = events.get(fd.fd, 0) | fd.events
+    poll = select.poll()
+    for fd, mask in events.items():
+        poll.register(fd, mask)
+    revents = dict(poll.poll(0))
+    for fd in fds:
+        fd.revents = revents.get(fd.fd, 0) & (fd.events | select.POLLERR | select.POLLHUP | select.POLLNVAL)
+
+
+def is_glib_loop(loop):
+    """Returns whether an asyncio loop runs on the GLib main context, i.e. was
+    created by ``gi.events.GLibEventLoopPolicy``.
+    """
+    try:
+        from gi.events import GLibEventLoop
+    except ImportError:
+        # PyGObject before 3.50
+        return False
+    return isinstance(loop, GLibEventLoop)
+
+
+def _finish(item, future):
+    if item.done:
+        item.done(future)
+    elif not future.cancelled() and future.exception():
+        log.error('An error occurred in the callback of %s', item, exc_info=future.exception(),
+            extra={ 'event': 'menu', 'item': item_name(item) })
+
+
+def marshalled(method):
+    """Makes a method of a tray icon callable from any thread.
+
+    The method is run in the main loop thread of the icon and returns a
+    :class:`concurrent.futures.Future` of its result.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        return self.dispatcher.call(method, self, *args, **kwargs)
+    return wrapper
@@ -3,15 +3,48 @@
 # Copyright (C) 2022 Ronny Rentner
 #
 
+import time
+# Start of the import phase of the startup profile
+_import_started = time.perf_counter()
+
 import gi
 gi.require_version('Gtk', '3.0')
-from gi.repository import Gtk
+gi.require_version('GdkPixbuf', '2.0')
+from gi.repository import Gtk, Gdk, GdkPixbuf, GLib
 
+import logging
 import pathlib
 import signal
+import threading
+
+from . import badge, cache, dispatch, gtk_menu, ico, icons
+from .animation import Animation
+from .archive import IconRef
+from .dispatch import Dispatcher, marshalled
+from .gtk_menu import GtkMenu
+from .menu import Menu, MenuItem
+from .metrics import Metrics
+from .startup import StartupProfile
+
+_imported = time.perf_counter()
+
+log = logging.getLogger(__name__)
+
+#: Approximate bytes of a cached frame size in the icon cache
+FRAME_SIZE_BYTES = 300
 
 class SystrayIcon():
-    def __init__(self, unique_id=None, icon=None, tooltip=None, menu_items=None, **kwargs):
+    # Icon size used until the panel tells us its real size
+    ICON_SIZE = 24
+
+    def __init__(self, unique_id=None, icon=None, tooltip=None, menu_items=None, executor=None, metrics=False, startup_hook=None, **kwargs):
+        """
+        :param metrics: Records the metrics returned by :meth:`stats`.
+
+        :param startup_hook: Called with the :class:`startup.StartupProfile`
+            once the icon is embedded into the panel.
+        """
+        started = time.perf_counter()
 
         # unique_id not used in this implementation
         self.unique_id = unique_id
@@ -20,53 +53,228 @@ class SystrayIcon():
         self.tooltip = tooltip
         self.menu_items = menu_items
         self.menu = None
+        self.status_icon = None
+
+        #: The size in device pixels of the displayed icon
+        self.pixels = None
+        self._pixbuf = None
+
+        self.badge = None
+        self.animation = None
+        self._animation_timer = None
+
+        #: Runs the public methods in the GTK main loop when they are called
+        #: from other threads
+        self.dispatcher = Dispatcher(GLib.idle_add)
+        #: :class:`concurrent.futures.Executor` for menu callbacks, which
+        #: otherwise run in the main loop
+        self.executor = executor
+        # Set while run_async() drives the main loop
+        self._stopped = None
+        #: The :class:`manager.TrayManager` hosting the icon, if any
+        self.manager = None
+        self._monitors_handler = None
+
+        #: Set once the panel shows the icon while its main loop runs
+        self.ready = threading.Event()
+        #: Seconds :meth:`start` and :meth:`stop` took the last time
+        self.startup_duration = None
+        self.shutdown_duration = None
+        self._thread = None
+
+        #: Timestamps of the startup phases up to the first embedding
+        self.startup_profile = StartupProfile((_import_started, _imported), startup_hook)
+        self.startup_profile.add('construct', started)
+        self._show_started = None
+
+        #: Counts and latencies of clicks, menu callbacks and messages
+        self.metrics = Metrics(metrics)
 
     def show(self): 
+        started = self._show_started = time.perf_counter()
+
         if self.menu_items:
-            self.set_menu(self.create_menu(items=self.menu_items))
+            with self.startup_profile.measure('menu'):
+                self.set_menu(self.create_menu(items=self.menu_items))
 
         self.status_icon = Gtk.StatusIcon.new()
-        self.status_icon.connect('activate', self.on_left_click)
+        self.status_icon.connect('activate', lambda *args: dispatch.schedule(self.metrics.call('left_click', self.on_left_click, *args)))
         self.status_icon.connect('button-release-event', self.on_click)
-        self.status_icon.connect('popup-menu', self.on_right_click)
-
-        if isinstance(self.icon, pathlib.Path):
-            self.status_icon.set_from_file(str(self.icon))
-        else:
-            self.status_icon.set_from_stock(self.icon)
+        self.status_icon.connect('popup-menu', lambda *args: self.metrics.call('right_click', self.on_right_click, *args))
+        self.status_icon.connect('notify::embedded', self.on_embedded_changed)
+        self.status_icon.connect('size-changed', self.on_size_changed)
+        self.status_icon.connect('notify::screen', self.on_geometry_changed)
+        self._monitors_handler = Gdk.Screen.get_default().connect('monitors-changed', self.on_geometry_changed)
 
+        with self.startup_profile.measure('icon'):
+            self.update_icon()
         self.set_tooltip(self.tooltip)
-        
+
+        if self.animation:
+            self.start_animation()
+
+        self.startup_profile.add('show', started)
+
+    def hide(self):
+        """Removes the icon from the panel. It can be shown again with :meth:`show`.
+        """
+        if self._animation_timer:
+            GLib.source_remove(self._animation_timer)
+            self._animation_timer = None
+        if self._monitors_handler:
+            Gdk.Screen.get_default().disconnect(self._monitors_handler)
+            self._monitors_handler = None
+        if self.status_icon:
+            self.status_icon.set_visible(False)
+            self.status_icon = None
+            self._pixbuf = None
+
     def run(self):
         # Make sure that we do not inhibit CTRL-C;
         # this is only possible from the main thread
         try: signal.signal(signal.SIGINT, signal.SIG_DFL)
         except ValueError: pass
 
-        self.show()
-        Gtk.main()
+        self.dispatcher.attach()
+        try:
+            # Ready once the icon is embedded, see on_embedded_changed()
+            self.show()
+            Gtk.main()
+        finally:
+            self.dispatcher.detach()
+
+    def start(self, timeout=None):
+        """Runs the icon on a thread of its own and returns once the panel
+        shows it. See :func:`dispatch.start`.
+        """
+        dispatch.start(self, timeout)
+
+    def stop(self, timeout=None):
+        """Quits the icon and waits until its main loop has ended. See
+        :func:`dispatch.stop`.
+        """
+        dispatch.stop(self, timeout)
+
+    async def run_async(self):
+        """Shows the icon and drives the GTK main loop from the running asyncio
+        loop until :meth:`quit` is called.
 
+        Menu callbacks and click handlers may be coroutine functions, they run
+        as tasks of the loop.
+        """
+        import asyncio
+        loop = asyncio.get_running_loop()
+        self._stopped = asyncio.Event()
+
+        # Calls from other threads wake up the asyncio loop directly
+        self.dispatcher.wakeup = loop.call_soon_threadsafe
+        self.dispatcher.attach()
+        try:
+            self.show()
+            await dispatch.run_glib(self._stopped)
+        finally:
+            self.dispatcher.detach()
+            self.dispatcher.wakeup = GLib.idle_add
+            self._stopped = None
+            self.hide()
+
+    @marshalled
     def quit(self, *args, **kwargs):
-        print('quit')
+        """Hides the icon and ends its main loop.
+
+        Icons hosted by a :class:`manager.TrayManager` are only removed from
+        it, the main loop keeps running for the other icons.
+        """
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('quit', extra={ 'event': 'quit' })
+        if self.manager:
+            self.manager.remove(self)
+            return
         self.status_icon.set_visible(False)
-        Gtk.main_quit()
+        if self._stopped:
+            self._stopped.set()
+        else:
+            Gtk.main_quit()
 
     def on_click(self, status_icon=None, event_button=None, *args):
         if event_button and event_button.button == 2:
-            self.on_middle_click()
+            dispatch.schedule(self.metrics.call('middle_click', self.on_middle_click))
+
+    def on_embedded_changed(self, *args):
+        if self.status_icon.is_embedded():
+            self.startup_profile.add('embedded', self._show_started)
+            self.ready.set()
+
+        # Embedding may move the icon to a panel of another size or scale
+        self.on_geometry_changed()
+
+        # Animations only run while the icon is actually visible in a panel
+        if self.animation and not self._animation_timer and self.status_icon.is_embedded():
+            self._animation_timer = GLib.timeout_add(self.animation.interval, self.next_animation_frame)
+
+    def on_size_changed(self, status_icon, size):
+        self.on_geometry_changed()
+        # We provide icons in the right size, so GTK does not need to scale
+        return True
+
+    def on_geometry_changed(self, *args):
+        # Only swap the icon if a different frame or raster size is needed
+        if not self.status_icon or isinstance(self.icon, str):
+            return
+
+        if self.animation:
+            if self.icon_pixels(self.animation.sources[0]) != self.pixels:
+                self.animation.frames = None
+                self.start_animation(restart=False)
+        else:
+            self.update_icon()
+
+    def icon_size(self):
+        """Returns the logical size of the icon in the panel and the scale factor
+        of the monitor it is on.
+        """
+        size = self.status_icon.get_size() or self.ICON_SIZE
+
+        ok, screen, area, orientation = self.status_icon.get_geometry()
+        display = screen.get_display() if ok and screen else Gdk.Display.get_default()
+        if ok:
+            monitor = display.get_monitor_at_point(area.x, area.y)
+        else:
+            monitor = display.get_primary_monitor() or display.get_monitor(0)
+
+        return size, monitor.get_scale_factor() if monitor else 1
+
+    def icon_pixels(self, icon):
+        """Returns the size in device pixels to decode an icon at.
+
+        For ICO files, this is the size of the frame that fits the panel best,
+        so that any panel size served by the same frame shares the decoded icon.
+        """
+        size, scale = self.icon_size()
+        if not ico.is_ico(icon):
+            return size * scale
+
+        # Kept in the shared cache, so that generated icons are evicted with
+        # their decoded frames
+        key = ('frame size', cache.source_key(icon), size, scale)
+        return cache.icons.get(key, lambda: (ico.load(icon).best(size, scale).width, FRAME_SIZE_BYTES))
 
     def on_left_click(self, *args):
-        print('left click', args)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('left click', extra={ 'event': 'left_click' })
 
     def on_middle_click(self, *args):
-        print('middle click', args)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('middle click', extra={ 'event': 'middle_click' })
         self.quit()
 
     def on_right_click(self, *args):
-        print('right click', args)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('right click', extra={ 'event': 'right_click', 'button': args[1] })
         if self.menu:
             self.menu.popup(None, None, self.status_icon.position_menu, self.status_icon, args[1], args[2]);
 
+    @marshalled
     def set_tooltip(self, tooltip):
         self.tooltip = tooltip
         self.title = tooltip 
@@ -80,34 +288,193 @@ class SystrayIcon():
         # The title may be used by screen readers.
         self.status_icon.set_title(self.title)
 
+    @marshalled
     def set_menu(self, menu):
         self.menu = menu
 
-    def create_menu(self, items=None):
-        menu = Gtk.Menu.new()
-        if items:
-            for item in items:
-                menu.append(self.create_menu_item(**item))
+    @marshalled
+    def set_icon(self, icon):
+        """Changes the icon.
+
+        :param icon: A :class:`pathlib.Path`, a stock icon name, an
+            :class:`archive.IconRef`, an :class:`ico.IcoFile` or encoded PNG,
+            ICO or SVG data in any object supporting the buffer protocol.
+        """
+        self.icon = icon
+        if self.status_icon and not self.animation:
+            self.update_icon()
+
+    def update_icon(self):
+        if isinstance(self.icon, str):
+            self.status_icon.set_from_stock(self.icon)
+            self._pixbuf = None
+            return
+
+        # Decoded icons are shared between all icons of the process, so
+        # switching back and forth between icons doesn't decode them again
+        icon = self.icon
+        pixels = self.pixels = self.icon_pixels(icon)
+        current = self.badge
+        if current:
+            pixbuf = cache.icons.get(cache.key(icon, pixels, overlay=current), lambda: self.decode_badge(icon, pixels, current))
         else:
-            menu.append(self.create_menu_item('Quit', self.quit))
-        menu.show_all()
+            pixbuf = cache.icons.get(cache.key(icon, pixels), lambda: self.decode_icon(icon, pixels))
+
+        if pixbuf is not self._pixbuf:
+            self._pixbuf = pixbuf
+            self.status_icon.set_from_pixbuf(pixbuf)
+
+    @marshalled
+    def set_badge(self, value, color=badge.DEFAULT_COLOR, position='top-right'):
+        """Draws a badge like an unread count or a warning dot onto the icon.
+
+        :param value: A number, a short text, ``''`` for a plain dot or ``None``
+            to remove the badge.
+
+        Every combination of icon, badge and size is rendered only once. Badges
+        are not drawn on stock icons.
+        """
+        self.badge = badge.make(value, color, position)
+        if self.status_icon and not self.animation:
+            self.update_icon()
+
+    def decode_badge(self, icon, size, current):
+        base = cache.icons.get(cache.key(icon, size), lambda: self.decode_icon(icon, size))
+        pixbuf = badge.composite_pixbuf(base, current)
+        return pixbuf, pixbuf.get_byte_length()
+
+    @marshalled
+    def animate(self, frames, fps=10):
+        """Cycles through a sequence of icons until :meth:`stop_animation` is called.
 
-        return menu
+        All frames are decoded once up front, every frame swap only hands a
+        decoded frame to GTK.
+        """
+        self.stop_animation(restore=False)
+        self.animation = Animation(frames, fps)
+        if self.status_icon:
+            self.start_animation()
 
-    def create_menu_item(self, label='', callback=None, variant='default', active=True, enabled=True):
+    def start_animation(self, restart=True):
+        pixels = self.pixels = self.icon_pixels(self.animation.sources[0])
+        frames = self.animation.decode(lambda frame: self.decode_icon(frame, pixels)[0])
+        self._pixbuf = frames[self.animation.index]
+        self.status_icon.set_from_pixbuf(self._pixbuf)
+        if restart:
+            self._animation_timer = GLib.timeout_add(self.animation.interval, self.next_animation_frame)
 
-        if variant == 'separator':
-            return Gtk.SeparatorMenuItem()
+    def next_animation_frame(self):
+        if not self.status_icon.is_embedded():
+            # Resumed by on_embedded_changed()
+            self._animation_timer = None
+            return False
 
-        menu_item = None
-        if variant == 'check':
-            menu_item = Gtk.CheckMenuItem.new_with_label(label)
-            menu_item.set_active(active)
+        self.metrics.count('animation_frame')
+        self._pixbuf = self.animation.next()
+        self.status_icon.set_from_pixbuf(self._pixbuf)
+        return True
+
+    @marshalled
+    def stop_animation(self, restore=True):
+        if self._animation_timer:
+            GLib.source_remove(self._animation_timer)
+            self._animation_timer = None
+        self.animation = None
+
+        if restore and self.status_icon:
+            self.update_icon()
+
+    def decode_icon(self, icon, size):
+        if ico.is_ico(icon):
+            # Decode only the frame that fits the panel best
+            pixbuf = self.load_pixbuf(ico.load(icon).best(size).encoded(), size)
+        elif isinstance(icon, pathlib.Path):
+            pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_size(str(icon), size, size)
+        elif isinstance(icon, IconRef):
+            pixbuf = self.load_pixbuf(icon.data(), size)
         else:
-            menu_item = Gtk.MenuItem.new_with_label(label)
-            menu_item.set_sensitive(enabled)
+            data = icons.as_buffer(icon)
+            if data is None:
+                raise TypeError(f'Unsupported icon {icon!r}')
+            pixbuf = self.load_pixbuf(data, size)
+        return pixbuf, pixbuf.get_byte_length()
+
+    def load_pixbuf(self, data, size=None):
+        # Decode encoded image data without going through a file. The loader
+        # only takes bytes, so other buffers have to be copied once.
+        if not isinstance(data, bytes):
+            obj = getattr(data, 'obj', None)
+            if isinstance(obj, bytes) and len(obj) == data.nbytes:
+                data = obj
+            else:
+                data = bytes(data)
+
+        loader = GdkPixbuf.PixbufLoader()
+        if size:
+            loader.set_size(size, size)
+        loader.write(data)
+        loader.close()
+        return loader.get_pixbuf()
+
+    def create_menu(self, items=None):
+        return GtkMenu(items or [{'key': 'quit', 'label': 'Quit', 'callback': self.quit}], runner=self.run_callback)
+
+    def run_callback(self, item, argument, set_busy=None):
+        """Runs the callback of a clicked menu item, on the executor of the
+        item or of the icon if there is one.
+        """
+        return dispatch.run_callback(self.dispatcher, self.executor, item, argument, set_busy, self.metrics)
+
+    def stats(self, format=None):
+        """Returns counts and latency histograms of clicks, menu callbacks and
+        main loop messages, see :class:`metrics.Metrics`. They are only
+        recorded if the icon was created with ``metrics=True``.
+
+        :param format: ``'openmetrics'`` for the OpenMetrics text format
+            instead of a dict.
+        """
+        if format == 'openmetrics':
+            return self.metrics.openmetrics(self.dispatcher.dispatched)
+        if format is not None:
+            raise ValueError(f'Unknown format {format!r}')
+        return self.metrics.snapshot(self.dispatcher.dispatched)
 
-        menu_item.connect('activate', callback)
+    def create_menu_item(self, label='', callback=None, variant='default', active=True, enabled=True, key=None, submenu=None):
+        return gtk_menu.create_widget(MenuItem(label, callback, variant, active, enabled, key, submenu))[0]
 
-        return menu_item
+    @marshalled
+    def update_menu(self, items):
+        """Changes the menu items.
 
+        :param items: A :class:`menu.Menu` or a list of :class:`menu.MenuItem`
+            instances or dicts. Showing the same :class:`menu.Menu` again does
+            nothing.
+
+        Items are matched by their ``key``, or by variant and label if they
+        have none, and only the changed widgets are touched.
+        """
+        # Validates the items before anything is changed
+        self.menu_items = items = Menu.coerce(items)
+        if self.menu is None:
+            self.set_menu(self.create_menu(items))
+        else:
+            self.menu.update(items)
+
+
+class MainLoop():
+    """The GTK main loop of a :class:`manager.TrayManager`, shared by all its
+    icons.
+    """
+    def wakeup(self, drain):
+        GLib.idle_add(drain)
+
+    def run(self, start):
+        """Runs the main loop until :meth:`quit` is called.
+
+        :param start: Called in the loop thread before the main loop runs.
+        """
+        start()
+        Gtk.main()
+
+    def quit(self):
+        Gtk.main_quit()
@@ -0,0 +1,177 @@
+# UltraSystray
+#
+# Copyright (C) 2022 Ronny Rentner
+#
+# Gtk.Menu shared by the GTK and the AppIndicator backend.
+#
+# Updates only touch the widgets of items that changed. AppIndicators export
+# the menu via DBusMenu, which sends one small layout update per changed
+# widget instead of the whole layout.
+#
+# Submenus are populated when they are shown. On AppIndicators, the DBusMenu
+# exporter activates the parent item when the host is about to show the
+# submenu, which populates it as well.
+#
+
+import gi
+gi.require_version('Gtk', '3.0')
+from gi.repository import Gtk
+
+from . import menu
+
+
+class GtkMenu(Gtk.Menu):
+    def __init__(self, items=None, runner=None):
+        """
+        :param runner: Called as ``runner(item, widget, set_busy)`` to run the
+            callback of a clicked item, see :func:`dispatch.run_callback`.
+            Without it, callbacks are called directly.
+        """
+        super().__init__()
+        self.runner = runner
+        #: :class:`menu.MenuEntry` instances in menu order, handles are
+        #: ``(widget, handler id)`` tuples
+        self.entries = []
+        #: The :class:`menu.Menu` shown right now
+        self.items = None
+        #: Keys of the items whose callbacks are running
+        self.busy = set()
+        self.update(items)
+
+    def update(self, items):
+        """Changes the menu to show ``items``.
+
+        :return: the number of changed widgets
+        """
+        items = menu.Menu.coerce(items)
+        if items is self.items:
+            return 0
+        self.items = items
+        for section in items.sections:
+            section.attach(self.refresh)
+        return menu.reconcile(self.entries, items, self)
+
+    def refresh(self):
+        """Shows the current page of all :class:`menu.Paged` sections.
+        """
+        if self.items is not None:
+            menu.reconcile(self.entries, self.items, self)
+
+    def populate(self, submenu):
+        """Shows the items of a :class:`menu.Submenu`, unless they are shown already.
+        """
+        self.update(submenu.items())
+
+    def set_busy(self, key, busy):
+        """Disables an item while its callback is running.
+        """
+        if busy:
+            self.busy.add(key)
+        else:
+            self.busy.discard(key)
+
+        for entry in self.entries:
+            if entry.key == key:
+                entry.handle[0].set_sensitive(entry.item.enabled and not busy)
+                break
+
+    def activate_item(self, widget):
+        # The item is looked up when it is clicked, so changing the callback
+        # of an item doesn't touch its widget
+        for entry in self.entries:
+            if entry.handle[0] is widget:
+                break
+        else:
+            return
+
+        item = entry.item
+        if not item.callback:
+            return
+        if self.runner:
+            self.runner(item, widget, lambda busy: self.set_busy(entry.key, busy))
+        else:
+            item.callback(widget)
+
+    def insert_item(self, position, item):
+        widget, handler = create_widget(item, self.activate_item, self.runner)
+        if item.key is not None and item.key in self.busy:
+            widget.set_sensitive(False)
+        self.insert(widget, position)
+        widget.show()
+        return widget, handler
+
+    def remove_item(self, entry):
+        widget, handler = entry.handle
+        self.remove(widget)
+        widget.destroy()
+
+    def move_item(self, entry, position):
+        self.reorder_child(entry.handle[0], position)
+
+    def update_item(self, entry, item):
+        old = entry.item
+        widget, handler = entry.handle
+        if item.variant != old.variant or item.submenu != old.submenu:
+            return None
+        if item.variant == 'separator':
+            return entry.handle
+
+        if item.label != old.label:
+            widget.set_label(item.label)
+        if item.enabled != old.enabled:
+            widget.set_sensitive(item.enabled and entry.key not in self.busy)
+
+        if item.variant in ('check', 'radio') and item.active != widget.get_active():
+            # Setting the state must not look like a click
+            widget.handler_block(handler)
+            widget.set_active(item.active)
+            widget.handler_unblock(handler)
+
+        return entry.handle
+
+
+def create_widget(item, activate=None, runner=None):
+    """Creates the widget for a :class:`menu.MenuItem`.
+
+    Submenus are empty until they are shown.
+
+    :param activate: Called with the widget when it is clicked, instead of
+        the callback of the item.
+
+    :param runner: The ``runner`` of the :class:`GtkMenu` of a submenu.
+
+    :return: the widget and the ID of its ``activate`` handler
+    """
+    if item.variant == 'separator':
+        return Gtk.SeparatorMenuItem(), None
+
+    if item.variant in ('check', 'radio'):
+        # Radio items are check items drawn as radio buttons, like on win32
+        widget = Gtk.CheckMenuItem.new_with_label(item.label)
+        widget.set_draw_as_radio(item.variant == 'radio')
+        widget.set_active(item.active)
+    else:
+        widget = Gtk.MenuItem.new_with_label(item.label)
+    widget.set_sensitive(item.enabled)
+
+    if item.submenu is not None:
+        submenu = menu.as_submenu(item.submenu)
+        child = GtkMenu(runner=runner)
+        populate = lambda *args: child.populate(submenu)
+        child.connect('show', populate)
+        widget.set_submenu(child)
+        return widget, widget.connect('activate', populate)
+
+    if activate is None:
+        activate = lambda widget: item.callback(widget) if item.callback else None
+
+    if isinstance(item, menu.PageItem):
+        # Turning the page with the mouse keeps the menu open
+        widget.connect('button-release-event', _turn_page, activate)
+
+    return widget, widget.connect('activate', activate)
+
+
+def _turn_page(widget, event, activate):
+    activate(widget)
+    return True
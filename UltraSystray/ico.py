@@ -0,0 +1,365 @@
+# UltraSystray
+#
+# Copyright (C) 2022 Ronny Rentner
+#
+# Reader and writer for the ICO container format.
+#
+# Only the directory of an ICO file is parsed. Every frame is a memoryview
+# into the (memory-mapped) file, so picking the right frame for a given pixel
+# size does not copy or decode any of the others.
+#
+# ICO files can also be assembled in memory from PNG or raw RGBA frames, which
+# is fast enough to generate icons at runtime:
+#
+#   data = ico.encode([ico.IcoFrame.from_rgba(16, 16, rgba), ico.IcoFrame.from_png(png)])
+#   tray.set_icon(ico.IcoFile(data))
+#
+# Frames are only decoded to pixels for drawing badges onto them, see
+# IcoFrame.rgba(). PNG frames are decoded with zlib, which is fast enough for
+# the small frames of tray icons.
+#
+
+import mmap
+import pathlib
+import struct
+import zlib
+
+# reserved, type, count
+ICONDIR = struct.Struct('<HHH')
+# width, height, colors, reserved, planes, bit count, size, offset
+ICONDIRENTRY = struct.Struct('<BBBBHHII')
+# size, width, height, planes, bit count, compression, image size,
+# x pixels per meter, y pixels per meter, colors used, colors important
+BITMAPINFOHEADER = struct.Struct('<IiiHHIIiiII')
+
+TYPE_ICON = 1
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# width, height, bit depth, color type, compression, filter, interlace
+PNG_IHDR = struct.Struct('>IIBBBBB')
+# Channels per PNG color type: gray, RGB, palette, gray + alpha, RGBA
+PNG_CHANNELS = { 0: 1, 2: 3, 3: 1, 4: 2, 6: 4 }
+
+
+class IcoFrame():
+    __slots__ = ('width', 'height', 'bit_count', 'format', 'data')
+
+    def __init__(self, width, height, bit_count, format, data):
+        self.width = width
+        self.height = height
+        self.bit_count = bit_count
+        # Either 'png' or 'bmp' (a DIB without file header)
+        self.format = format
+        self.data = data
+
+    def __repr__(self):
+        return f'IcoFrame({self.width}x{self.height}, {self.bit_count} bit, {self.format})'
+
+    @classmethod
+    def from_png(cls, data):
+        """Creates a frame from PNG encoded data, which is stored as it is.
+        """
+        data = memoryview(data)
+        if data[:8] != PNG_SIGNATURE:
+            raise ValueError('Not PNG data')
+        width, height = struct.unpack_from('>II', data, 16)
+        return cls(width, height, 32, 'png', data)
+
+    @classmethod
+    def from_rgba(cls, width, height, rgba):
+        """Creates a 32 bit BMP frame from raw RGBA pixels, row by row from the top.
+        """
+        rgba = memoryview(rgba).cast('B')
+        stride = width * 4
+        if len(rgba) != stride * height:
+            raise ValueError(f'Expected {stride * height} bytes of RGBA data, got {len(rgba)}')
+
+        # DIBs store BGRA rows from the bottom up
+        bgra = bytearray(len(rgba))
+        bgra[0::4] = rgba[2::4]
+        bgra[1::4] = rgba[1::4]
+        bgra[2::4] = rgba[0::4]
+        bgra[3::4] = rgba[3::4]
+        pixels = b''.join(bgra[y * stride:(y + 1) * stride] for y in reversed(range(height)))
+
+        # The AND mask is unused with an alpha channel but must be present,
+        # every row padded to 32 bits
+        mask = bytes(((width + 31) // 32) * 4 * height)
+
+        header = BITMAPINFOHEADER.pack(
+            BITMAPINFOHEADER.size, width, height * 2, 1, 32, 0, len(pixels) + len(mask), 0, 0, 0, 0)
+        return cls(width, height, 32, 'bmp', memoryview(b''.join((header, pixels, mask))))
+
+    def rgba(self):
+        """Decodes the frame to RGBA pixels, row by row from the top.
+
+        :raises ValueError: for BMP frames with less than 32 bit and PNG
+            frames :func:`decode_png` cannot decode
+        """
+        if self.format == 'png':
+            return decode_png(self.data)[2]
+
+        if self.bit_count != 32:
+            raise ValueError(f'Only 32 bit BMP frames can be decoded, not {self}')
+
+        width = self.width
+        height = self.height
+        header_size = int.from_bytes(self.data[:4], 'little')
+        stride = width * 4
+        pixels = self.data[header_size:header_size + stride * height]
+
+        # BGRA rows from the bottom to RGBA rows from the top
+        rows = b''.join(pixels[y * stride:(y + 1) * stride] for y in reversed(range(height)))
+        rgba = bytearray(len(rows))
+        rgba[0::4] = rows[2::4]
+        rgba[1::4] = rows[1::4]
+        rgba[2::4] = rows[0::4]
+        rgba[3::4] = rows[3::4]
+        return rgba
+
+    def encoded(self):
+        """Returns the frame as a self-contained image for image decoders.
+
+        PNG frames are returned as they are, BMP frames are wrapped into an ICO
+        file with just this frame.
+        """
+        if self.format == 'png':
+            return self.data
+        return memoryview(encode((self,)))
+
+
+class IcoFile():
+    def __init__(self, data):
+        """Parses the directory of an ICO file.
+
+        :param data: Any object supporting the buffer protocol.
+        """
+        self.data = memoryview(data)
+        self.frames = []
+
+        if len(self.data) < ICONDIR.size:
+            raise ValueError('Not an ICO file, too short')
+
+        reserved, type, count = ICONDIR.unpack_from(self.data)
+        if reserved != 0 or type != TYPE_ICON:
+            raise ValueError('Not an ICO file')
+
+        for i in range(count):
+            width, height, colors, reserved, planes, bit_count, size, offset = \
+                ICONDIRENTRY.unpack_from(self.data, ICONDIR.size + i * ICONDIRENTRY.size)
+
+            if offset + size > len(self.data):
+                raise ValueError(f'ICO frame {i} exceeds the end of the file')
+
+            frame_data = self.data[offset:offset + size]
+
+            if frame_data[:8] == PNG_SIGNATURE:
+                format = 'png'
+                # The directory cannot express sizes above 256, so take the
+                # real size from the IHDR chunk
+                width, height = struct.unpack_from('>II', frame_data, 16)
+            else:
+                format = 'bmp'
+                # A size of 0 means 256 pixels
+                width = width or 256
+                height = height or 256
+
+            self.frames.append(IcoFrame(width, height, bit_count, format, frame_data))
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __iter__(self):
+        return iter(self.frames)
+
+    def sizes(self):
+        return sorted({frame.width for frame in self.frames})
+
+    def best(self, size, scale=1):
+        """Returns the frame that fits best for a given logical pixel size.
+
+        An exact match is preferred, otherwise the smallest frame that is
+        larger than needed, so that it only has to be scaled down. Among frames
+        of the same size, the one with the most colors wins.
+        """
+        if not self.frames:
+            raise ValueError('ICO file does not contain any frames')
+
+        target = round(size * scale)
+
+        def rank(frame):
+            return (frame.width < target, abs(frame.width - target), -frame.bit_count)
+
+        return min(self.frames, key=rank)
+
+
+def encode(frames):
+    """Assembles an ICO file in memory.
+
+    :param frames: :class:`IcoFrame` instances, usually created with
+        :meth:`IcoFrame.from_png` or :meth:`IcoFrame.from_rgba`.
+
+    :return: the ICO file as :class:`bytes`
+    """
+    frames = tuple(frames)
+    offset = ICONDIR.size + len(frames) * ICONDIRENTRY.size
+
+    parts = [ICONDIR.pack(0, TYPE_ICON, len(frames))]
+    for frame in frames:
+        # Sizes of 256 and above are stored as 0
+        parts.append(ICONDIRENTRY.pack(
+            frame.width if frame.width < 256 else 0,
+            frame.height if frame.height < 256 else 0,
+            0, 0, 1, frame.bit_count, len(frame.data), offset))
+        offset += len(frame.data)
+    parts.extend(frame.data for frame in frames)
+
+    return b''.join(parts)
+
+
+def decode_png(data):
+    """Decodes PNG data with 8 bits per channel and without interlacing, the
+    kind icon tools write.
+
+    :return: the width, the height and the RGBA pixels as :class:`bytearray`,
+        row by row from the top
+    """
+    data = memoryview(data).cast('B')
+    if data[:8] != PNG_SIGNATURE:
+        raise ValueError('Not PNG data')
+
+    header = None
+    palette = b''
+    transparency = b''
+    compressed = []
+    offset = 8
+    while offset + 8 <= len(data):
+        length, kind = struct.unpack_from('>I4s', data, offset)
+        chunk = data[offset + 8:offset + 8 + length]
+        offset += length + 12
+        if kind == b'IHDR':
+            header = PNG_IHDR.unpack_from(chunk)
+        elif kind == b'PLTE':
+            palette = bytes(chunk)
+        elif kind == b'tRNS':
+            transparency = bytes(chunk)
+        elif kind == b'IDAT':
+            compressed.append(chunk)
+        elif kind == b'IEND':
+            break
+
+    if header is None:
+        raise ValueError('PNG data without IHDR chunk')
+    width, height, depth, color_type, compression, filter, interlace = header
+    if depth != 8 or interlace or color_type not in PNG_CHANNELS:
+        raise ValueError(f'Cannot decode PNG with bit depth {depth}, color type {color_type} and interlace {interlace}')
+
+    channels = PNG_CHANNELS[color_type]
+    stride = width * channels
+    raw = zlib.decompress(b''.join(compressed))
+    if len(raw) < (stride + 1) * height:
+        raise ValueError('Truncated PNG data')
+
+    pixels = bytearray(stride * height)
+    prior = bytearray(stride)
+    for y in range(height):
+        start = y * (stride + 1)
+        row = bytearray(raw[start + 1:start + 1 + stride])
+        _unfilter(raw[start], row, prior, channels)
+        pixels[y * stride:(y + 1) * stride] = row
+        prior = row
+
+    count = width * height
+    if color_type == 6:
+        return width, height, pixels
+
+    rgba = bytearray(count * 4)
+    if color_type == 3:
+        # Palette entries without alpha in tRNS are opaque
+        alpha = transparency + b'\xff' * (256 - len(transparency))
+        table = [palette[i * 3:i * 3 + 3] + alpha[i:i + 1] for i in range(len(palette) // 3)]
+        rgba[:] = b''.join(table[index] for index in pixels)
+    elif color_type == 2:
+        rgba[0::4] = pixels[0::3]
+        rgba[1::4] = pixels[1::3]
+        rgba[2::4] = pixels[2::3]
+        rgba[3::4] = b'\xff' * count
+    else:
+        gray = pixels[0::channels]
+        rgba[0::4] = gray
+        rgba[1::4] = gray
+        rgba[2::4] = gray
+        rgba[3::4] = pixels[1::2] if color_type == 4 else b'\xff' * count
+    return width, height, rgba
+
+
+def _unfilter(kind, row, prior, bpp):
+    """Reverses the PNG filter of a row in place.
+    """
+    if kind == 0:
+        return
+    if kind == 2:
+        row[:] = bytes((a + b) & 0xff for a, b in zip(row, prior))
+        return
+    if kind not in (1, 3, 4):
+        raise ValueError(f'Invalid PNG filter type {kind}')
+
+    for i in range(len(row)):
+        left = row[i - bpp] if i >= bpp else 0
+        if kind == 1:
+            predictor = left
+        elif kind == 3:
+            predictor = (left + prior[i]) >> 1
+        else:
+            up = prior[i]
+            upper_left = prior[i - bpp] if i >= bpp else 0
+            estimate = left + up - upper_left
+            distance_left = abs(estimate - left)
+            distance_up = abs(estimate - up)
+            distance_upper_left = abs(estimate - upper_left)
+            if distance_left <= distance_up and distance_left <= distance_upper_left:
+                predictor = left
+            elif distance_up <= distance_upper_left:
+                predictor = up
+            else:
+                predictor = upper_left
+        row[i] = (row[i] + predictor) & 0xff
+
+
+def load(icon):
+    """Creates an :class:`IcoFile` from a path, an :class:`archive.IconRef` or
+    a buffer. An :class:`IcoFile` is returned as it is.
+
+    Files are memory-mapped and never read as a whole.
+    """
+    if isinstance(icon, IcoFile):
+        return icon
+
+    if isinstance(icon, (str, pathlib.Path)):
+        with open(icon, 'rb') as f:
+            return IcoFile(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    if hasattr(icon, 'data') and callable(icon.data):
+        return IcoFile(icon.data())
+
+    return IcoFile(icon)
+
+
+def is_ico(icon):
+    """Returns whether a path, an :class:`archive.IconRef` or a buffer refers
+    to ICO data.
+    """
+    if isinstance(icon, IcoFile):
+        return True
+    if isinstance(icon, pathlib.Path):
+        return icon.suffix.lower() == '.ico'
+    if isinstance(icon, str):
+        return False
+    from .archive import IconRef
+    if isinstance(icon, IconRef):
+        return icon.format == 'ico'
+    # Any other buffer, memoryviews have a format attribute of their own
+    try:
+        return bytes(memoryview(icon)[:4]) == ICONDIR.pack(0, TYPE_ICON, 0)[:4]
+    except TypeError:
+        return False
@@ -0,0 +1,283 @@
+# UltraSystray
+#
+# Copyright (C) 2022 Ronny Rentner
+#
+# Index of the bundled icons tree.
+#
+# The manifest is generated once at build time (see setup.py or run
+# `python -m UltraSystray.icons`) so that looking up an icon at runtime never
+# has to walk or glob the filesystem. Installed packages ship the icons as one
+# packed archive instead, see UltraSystray.archive:
+#
+#   from UltraSystray import icons
+#   entry = icons.get('alarm', variant='outlined', size=24)
+#   icon_file = icons.path('alarm', variant='outlined', size=24)
+#   icon_ref = icons.ref('alarm', variant='outlined', size=24)
+#
+
+import collections
+import hashlib
+import json
+import pathlib
+import re
+import struct
+
+from . import ico
+
+ICONS_PATH = pathlib.Path(__file__).parent.parent / 'icons'
+MANIFEST_NAME = 'manifest.json'
+MANIFEST_VERSION = 2
+
+FORMATS = ('ico', 'png', 'svg')
+
+# Variant that is picked if the caller does not ask for a specific one
+DEFAULT_VARIANTS = {
+    'material': 'filled',
+    'heroicons': 'outline',
+}
+
+# For the loose icons tree, offset is always 0, length is the file size and
+# there is no compression. Packed archives store the same records with offsets
+# into the archive and the stored (possibly compressed) length.
+IconEntry = collections.namedtuple('IconEntry',
+    ('path', 'name', 'family', 'category', 'variant', 'size', 'format', 'offset', 'length', 'hash', 'compression'))
+
+_MATERIAL_RE = re.compile(r'^(?P<name>[a-z0-9_]+)(?:-(?P<variant>outlined|round|sharp|twotone))?-(?P<size>\d+)px$')
+_SVG_SIZE_RE = re.compile(rb'viewBox="[-\d.]+ [-\d.]+ ([\d.]+) [\d.]+"|width="([\d.]+)"')
+
+
+class Manifest():
+    def __init__(self, entries, root=ICONS_PATH):
+        self.root = pathlib.Path(root)
+        self.entries = entries
+
+        # All entries for a name, used when the caller leaves attributes open
+        self._by_name = {}
+        # Exact (name, variant, size, format) match
+        self._by_key = {}
+
+        for entry in entries:
+            self._by_name.setdefault(entry.name, []).append(entry)
+            self._by_key.setdefault((entry.name, entry.variant, entry.size, entry.format), entry)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, name):
+        return name in self._by_name
+
+    def names(self):
+        return self._by_name.keys()
+
+    def get(self, name, variant=None, size=None, format=None, family=None):
+        """Returns the best matching :class:`IconEntry` or ``None``.
+
+        Attributes that are not given are resolved in favor of the default
+        variant of the icon family, the largest size and the first format in
+        :data:`FORMATS`. If ``size`` is given but not available, the closest
+        size is returned.
+        """
+        if family is None and variant is not None and size is not None and format is not None:
+            entry = self._by_key.get((name, variant, size, format))
+            if entry:
+                return entry
+
+        candidates = self._by_name.get(name)
+        if not candidates:
+            return None
+
+        candidates = [e for e in candidates
+            if (variant is None or e.variant == variant)
+            and (format is None or e.format == format)
+            and (family is None or e.family == family)]
+        if not candidates:
+            return None
+
+        def rank(entry):
+            return (
+                entry.variant != DEFAULT_VARIANTS.get(entry.family, ''),
+                abs(entry.size - size) if size else 0,
+                -entry.size,
+                FORMATS.index(entry.format))
+
+        return min(candidates, key=rank)
+
+    def path(self, entry):
+        return self.root / entry.path
+
+    def data(self, entry):
+        return memoryview(self.path(entry).read_bytes())
+
+    def save(self, path=None):
+        path = path or self.root / MANIFEST_NAME
+        data = {
+            'version': MANIFEST_VERSION,
+            'fields': IconEntry._fields,
+            'icons': self.entries,
+        }
+        with open(path, 'w') as f:
+            json.dump(data, f, separators=(',', ':'))
+
+    @classmethod
+    def from_dict(cls, data, root=ICONS_PATH):
+        if data.get('version') != MANIFEST_VERSION:
+            raise ValueError(f"Unsupported icon manifest version '{data.get('version')}'")
+        return cls([IconEntry._make(row) for row in data['icons']], root=root)
+
+    @classmethod
+    def load(cls, root=ICONS_PATH):
+        root = pathlib.Path(root)
+        try:
+            with open(root / MANIFEST_NAME, 'rb') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            raise FileNotFoundError(f"Icon manifest '{root / MANIFEST_NAME}' not found, "
+                "build it with `python -m UltraSystray.icons`") from None
+        return cls.from_dict(data, root=root)
+
+    @classmethod
+    def build(cls, root=ICONS_PATH):
+        """Scans the icons tree and creates a new manifest from it.
+        """
+        root = pathlib.Path(root)
+        entries = []
+        for path in sorted(root.rglob('*')):
+            if path.suffix[1:] not in FORMATS or not path.is_file():
+                continue
+            entry = scan_icon(path, root)
+            if entry:
+                entries.append(entry)
+        return cls(entries, root=root)
+
+
+def scan_icon(path, root=ICONS_PATH):
+    """Creates an :class:`IconEntry` from an icon file.
+
+    The layout of the tree determines name, family, category and variant:
+
+    * ``material/<category>/<name>[-<variant>]-<size>px.svg``
+    * ``heroicons/<variant>/<name>.svg``
+    * ``<name>.<format>`` for all other icons
+
+    :return: an :class:`IconEntry` or ``None`` if the path does not fit
+    """
+    path = pathlib.Path(path)
+    relative = path.relative_to(root)
+    parts = relative.parts
+    format = path.suffix[1:]
+    data = path.read_bytes()
+
+    family = category = variant = ''
+    size = None
+    name = path.stem
+
+    if parts[0] == 'material' and len(parts) == 3:
+        match = _MATERIAL_RE.match(path.stem)
+        if not match:
+            return None
+        family = 'material'
+        category = parts[1]
+        name = match['name']
+        variant = match['variant'] or DEFAULT_VARIANTS[family]
+        size = int(match['size'])
+    elif parts[0] == 'heroicons' and len(parts) == 3:
+        family = 'heroicons'
+        variant = parts[1]
+
+    if size is None:
+        size = image_size(data, format)
+
+    return IconEntry(
+        relative.as_posix(), name, family, category, variant, size, format,
+        0, len(data), hashlib.blake2b(data, digest_size=16).hexdigest(), '')
+
+
+def as_buffer(icon):
+    """Returns a :class:`memoryview` of encoded icon data or ``None`` if
+    ``icon`` does not support the buffer protocol, e.g. for paths and names.
+    """
+    if isinstance(icon, (str, pathlib.PurePath)):
+        return None
+    try:
+        return memoryview(icon).cast('B')
+    except TypeError:
+        return None
+
+
+def image_format(data):
+    """Detects the format of encoded icon data.
+
+    :return: one of :data:`FORMATS` or ``None``
+    """
+    head = bytes(data[:256])
+    if head.startswith(ico.PNG_SIGNATURE):
+        return 'png'
+    if head.startswith(b'\0\0\1\0'):
+        return 'ico'
+    if b'<svg' in head:
+        return 'svg'
+    return None
+
+
+def image_size(data, format):
+    """Returns the pixel size of an icon, for ICO the largest contained size.
+    """
+    if format == 'png':
+        # Width from the IHDR chunk
+        return struct.unpack_from('>I', data, 16)[0]
+
+    if format == 'ico':
+        return max(ico.IcoFile(data).sizes(), default=0)
+
+    match = _SVG_SIZE_RE.search(data)
+    if match:
+        return round(float(match[1] or match[2]))
+    return 0
+
+
+_manifest = None
+
+def manifest():
+    """Returns the manifest of the bundled icons, loading it on first use.
+
+    The packed archive is preferred over the loose icons tree if it exists.
+    """
+    global _manifest
+    if _manifest is None:
+        from . import archive
+        if archive.ARCHIVE_PATH.exists():
+            _manifest = archive.IconArchive()
+        else:
+            _manifest = Manifest.load()
+    return _manifest
+
+def get(name, variant=None, size=None, format=None, family=None):
+    return manifest().get(name, variant=variant, size=size, format=format, family=family)
+
+def path(name, variant=None, size=None, format=None, family=None):
+    """Like :func:`get` but returns the :class:`pathlib.Path` of the icon.
+
+    Returns ``None`` for icons that only exist inside the packed archive, use
+    :func:`ref` for those.
+    """
+    entry = get(name, variant=variant, size=size, format=format, family=family)
+    return manifest().path(entry) if entry else None
+
+def ref(name, variant=None, size=None, format=None, family=None):
+    """Like :func:`get` but returns an :class:`archive.IconRef` that can be
+    passed to all backends.
+
+    On Windows, SVG icons like most bundled ones need cairosvg, ICO and PNG
+    icons are preferred if they exist.
+    """
+    from .archive import IconRef
+    entry = get(name, variant=variant, size=size, format=format, family=family)
+    return IconRef(manifest(), entry) if entry else None
+
+
+if __name__ == '__main__':
+    import sys
+    root = pathlib.Path(sys.argv[1]) if len(sys.argv) > 1 else ICONS_PATH
+    result = Manifest.build(root)
+    result.save()
+    print(f"Wrote {len(result)} icons to '{root / MANIFEST_NAME}'")
@@ -0,0 +1,139 @@
+# UltraSystray
+#
+# Copyright (C) 2022 Ronny Rentner
+#
+# Hosts many tray icons on a single main loop.
+#
+# The icons of a manager share its main loop and its dispatcher, and with them
+# the backend resources like the win32 window class and the icon cache.
+# Adding or removing an icon only shows or hides that one icon.
+#
+
+import os
+import signal
+import sys
+import threading
+
+from . import dispatch
+from .dispatch import Dispatcher, marshalled
+
+
+def default_backend():
+    """Returns the backend module :class:`SystrayIcon` uses on this platform,
+    or the one named by the ULTRASYSTRAY_BACKEND environment variable.
+    """
+    name = os.environ.get('ULTRASYSTRAY_BACKEND')
+    if name:
+        from . import import_backend
+        backend = import_backend(name)
+    elif sys.platform.startswith('win32'):
+        from . import win32 as backend
+    elif sys.platform.startswith('darwin'):
+        raise NotImplementedError('TrayManager is not supported on macOS')
+    else:
+        from .probe import load_backend
+        backend = load_backend()
+    return backend
+
+
+class TrayManager():
+    def __init__(self, backend=None):
+        """
+        :param backend: The backend module, e.g. ``UltraSystray.appindicator``.
+            Defaults to the one of :class:`SystrayIcon`.
+        """
+        self.backend = backend or default_backend()
+        self.loop = self.backend.MainLoop()
+        #: Shared by all icons, their public methods run in the main loop of
+        #: the manager
+        self.dispatcher = Dispatcher(self.loop.wakeup)
+
+        #: The icons in the order they were added, mapped to their own
+        #: dispatcher, which they get back when they are removed
+        self.icons = {}
+        self.running = False
+
+        #: Set once the icons are shown and the main loop runs
+        self.ready = threading.Event()
+        #: Seconds :meth:`start` and :meth:`stop` took the last time
+        self.startup_duration = None
+        self.shutdown_duration = None
+        self._thread = None
+
+    def create(self, **kwargs):
+        """Creates an icon of the backend and adds it.
+
+        :param kwargs: Passed on to the ``SystrayIcon`` of the backend.
+        """
+        icon = self.backend.SystrayIcon(**kwargs)
+        self.add(icon)
+        return icon
+
+    @marshalled
+    def add(self, icon):
+        """Adds an icon, which is shown right away if the main loop runs.
+        """
+        if icon in self.icons:
+            return
+        if icon.manager is not None:
+            raise ValueError(f'{icon!r} belongs to another TrayManager')
+
+        self.icons[icon] = icon.dispatcher
+        icon.manager = self
+        icon.dispatcher = self.dispatcher
+        if self.running:
+            icon.show()
+
+    @marshalled
+    def remove(self, icon):
+        """Hides an icon and removes it. The other icons keep running.
+        """
+        if icon not in self.icons:
+            return
+
+        icon.dispatcher = self.icons.pop(icon)
+        icon.manager = None
+        if self.running:
+            icon.hide()
+
+    def run(self):
+        """Shows all icons and runs the main loop until :meth:`quit` is called.
+        """
+        # Make sure that we do not inhibit CTRL-C;
+        # this is only possible from the main thread
+        try: signal.signal(signal.SIGINT, signal.SIG_DFL)
+        except ValueError: pass
+
+        try:
+            self.loop.run(self._start)
+        finally:
+            if self.running:
+                self.running = False
+                for icon in self.icons:
+                    icon.hide()
+            self.dispatcher.detach()
+
+    def _start(self):
+        self.dispatcher.attach()
+        self.running = True
+        for icon in self.icons:
+            icon.show()
+        self.ready.set()
+
+    def start(self, timeout=None):
+        """Runs the main loop on a thread of its own and returns once the icons
+        are shown. See :func:`dispatch.start`.
+        """
+        dispatch.start(self, timeout)
+
+    def stop(self, timeout=None):
+        """Quits the main loop and waits until it has ended. See
+        :func:`dispatch.stop`.
+        """
+        dispatch.stop(self, timeout)
+
+    @marshalled
+    def quit(self):
+        """Hides all icons and ends the main loop.
+        """
+        self.loop.quit()
@@ -0,0 +1,468 @@
+# UltraSystray
+#
+# Copyright (C) 2022 Ronny Rentner
+#
+# Backend independent menu handling.
+#
+# Menus are given as a Menu of MenuItem instances or as a list of dicts like
+# { 'key': 'quit', 'label': 'Quit', 'callback': quit }. Dicts are validated and
+# turned into MenuItem instances once, backends only ever see MenuItems.
+#
+# The key identifies an item across menu updates, so that update_menu() only
+# inserts, removes, moves or changes the items that differ from the live menu.
+# Items without a key are identified by variant and label.
+#
+# An item with a 'submenu' opens a submenu. Its items are only created when the
+# submenu is opened for the first time, see Submenu.
+#
+# Very long lists are added to a menu as Paged section, which only shows one
+# page of items at a time. Turning the page relabels the existing items.
+#
+
+import weakref
+
+VARIANTS = ('default', 'check', 'radio', 'separator')
+
+
+class MenuItem():
+    """A validated menu item.
+
+    Menu items are compared by value and must not be changed once they are
+    part of a :class:`Menu`, create a new one instead.
+
+    :param variant: One of :data:`VARIANTS`. Check and radio items show
+        ``active`` as their state, the application is responsible for
+        unchecking the other items of a radio group.
+
+    :param submenu: A :class:`Submenu`, a callable returning menu items or
+        the menu items themselves.
+
+    :param executor: A :class:`concurrent.futures.Executor` to run the
+        callback on instead of the one of the tray icon, or ``False`` to run
+        it in the main loop thread.
+
+    :param done: Called in the main loop thread with the
+        :class:`concurrent.futures.Future` of the callback once it has
+        finished. Without it, exceptions of the callback are printed.
+    """
+    __slots__ = ('key', 'label', 'callback', 'variant', 'active', 'enabled', 'submenu', 'executor', 'done', 'compiled')
+
+    FIELDS = frozenset(('key', 'label', 'callback', 'variant', 'active', 'enabled', 'submenu', 'executor', 'done'))
+
+    def __init__(self, label='', callback=None, variant='default', active=True, enabled=True, key=None, submenu=None, executor=None, done=None):
+        if variant not in VARIANTS:
+            raise ValueError(f"Invalid menu item variant '{variant}', use one of {', '.join(VARIANTS)}")
+        if callback is not None and not callable(callback):
+            raise TypeError(f'Menu item callback {callback!r} is not callable')
+        if submenu is not None and variant == 'separator':
+            raise ValueError('Separators cannot have a submenu')
+        if executor not in (None, False) and not hasattr(executor, 'submit'):
+            raise TypeError(f'Menu item executor {executor!r} is not an executor')
+        if done is not None and not callable(done):
+            raise TypeError(f'Menu item done callback {done!r} is not callable')
+
+        self.key = key
+        self.label = str(label)
+        self.callback = callback
+        self.variant = variant
+        self.active = bool(active)
+        self.enabled = bool(enabled)
+        if submenu is None or isinstance(submenu, Submenu) or callable(submenu):
+            self.submenu = submenu
+        else:
+            self.submenu = Menu.coerce(submenu)
+        self.executor = executor
+        self.done = done
+
+        #: Backend name -> compiled form of this item, e.g. a MENUITEMINFO.
+        #: Created by the first backend that compiles the item.
+        self.compiled = None
+
+    @classmethod
+    def coerce(cls, item):
+        """Returns a :class:`MenuItem` for a :class:`MenuItem` or a dict.
+        """
+        if isinstance(item, cls):
+            return item
+
+        unknown = item.keys() - cls.FIELDS
+        if unknown:
+            raise ValueError(f"Unknown menu item keys {', '.join(sorted(map(repr, unknown)))} in {item!r}")
+        return cls(**item)
+
+    def _fields(self):
+        return (self.key, self.label, self.callback, self.variant, self.active, self.enabled, self.submenu, self.executor, self.done)
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if not isinstance(other, MenuItem):
+            return NotImplemented
+        return self._fields() == other._fields()
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f"MenuItem({self.label!r}, variant='{self.variant}', key={self.key!r})"
+
+
+class PageItem(MenuItem):
+    """The navigation items of a :class:`Paged` section.
+
+    Backends keep the menu open when they are clicked, if they can. Their
+    callbacks always run in the main loop thread.
+    """
+    __slots__ = ()
+
+
+class Menu():
+    """An immutable sequence of validated :class:`MenuItem` instances and
+    :class:`Paged` sections.
+
+    Backends remember the last menu they have shown, showing the same
+    :class:`Menu` again costs nothing.
+    """
+    __slots__ = ('items', 'keys', 'sections')
+
+    def __init__(self, items=()):
+        self.items = tuple(item if isinstance(item, Paged) else MenuItem.coerce(item) for item in items)
+        #: The key of every item, see :func:`keyed`
+        self.keys = tuple(key for key, item in keyed(self.items))
+        #: The :class:`Paged` sections
+        self.sections = tuple(item for item in self.items if isinstance(item, Paged))
+
+    def flat(self):
+        """Returns the ``(key, item)`` pairs of all items to show, with the
+        current page of every :class:`Paged` section.
+        """
+        if not self.sections:
+            return list(zip(self.keys, self.items))
+
+        result = []
+        for key, item in zip(self.keys, self.items):
+            if isinstance(item, Paged):
+                result.extend(item.window())
+            else:
+                result.append((key, item))
+        return result
+
+    @classmethod
+    def coerce(cls, items):
+        """Returns a :class:`Menu` for a :class:`Menu`, a sequence of menu items or ``None``.
+        """
+        if isinstance(items, cls):
+            return items
+        return cls(items or ())
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __getitem__(self, index):
+        return self.items[index]
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if not isinstance(other, Menu):
+            return NotImplemented
+        return self.items == other.items
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f'Menu({list(self.items)!r})'
+
+
+class MenuEntry():
+    """An item of a live menu together with the backend handle for it.
+    """
+    __slots__ = ('key', 'item', 'handle')
+
+    def __init__(self, key, item, handle):
+        self.key = key
+        self.item = item
+        self.handle = handle
+
+    def __repr__(self):
+        return f'MenuEntry({self.key!r})'
+
+
+class Submenu():
+    """Items of a submenu that are only created when the submenu is opened.
+
+    :param provider: Callable returning the menu items. It is called the
+        first time the submenu is opened and again after :meth:`invalidate`.
+
+    :param cache: Keep the items until :meth:`invalidate` is called. If
+        false, the provider is called every time the submenu is opened.
+    """
+    __slots__ = ('provider', 'cache', '_items')
+
+    def __init__(self, provider, cache=True):
+        self.provider = provider
+        self.cache = cache
+        self._items = None
+
+    def __repr__(self):
+        return f'Submenu({self.provider!r}, cache={self.cache})'
+
+    def items(self):
+        """Returns the menu items as :class:`Menu`, the same one as long as
+        they are cached.
+        """
+        items = self._items
+        if items is None or not self.cache:
+            items = self._items = Menu.coerce(self.provider())
+        return items
+
+    def invalidate(self):
+        """Asks the provider again the next time the submenu is opened.
+
+        An open submenu is not changed.
+        """
+        self._items = None
+
+
+class Paged():
+    """A menu section showing a long list of items one page at a time, with
+    navigation items to the previous and the next page.
+
+    Only the items of the current page are created. They are keyed by their
+    position on the page, so turning the page only relabels the items that are
+    already there.
+
+    :param items: A sequence of menu items, or a callable returning the menu
+        item at an index if ``length`` is given.
+
+    :param length: The number of items or a callable returning it, only used
+        with a callable ``items``.
+
+    :param key: Identifies the section, must be unique within the menu.
+    """
+    __slots__ = ('getter', 'length', 'page_size', 'key', 'offset', 'previous_label', 'more_label', '_window', '_listeners')
+
+    def __init__(self, items, length=None, page_size=50, key='paged', previous_label='Previous', more_label='More…'):
+        if page_size < 1:
+            raise ValueError(f'Invalid page size {page_size}')
+        if key is None:
+            raise ValueError('A paged section needs a key')
+
+        if callable(items):
+            if length is None:
+                raise ValueError('A paged section with an item getter needs a length')
+            self.getter = items
+            self.length = length
+        else:
+            self.getter = items.__getitem__
+            self.length = items.__len__
+
+        self.page_size = page_size
+        self.key = key
+        #: Index of the first item of the current page
+        self.offset = 0
+        self.previous_label = previous_label
+        self.more_label = more_label
+
+        self._window = None
+        # Weak references to the refresh methods of the menus showing this section
+        self._listeners = []
+
+    def __len__(self):
+        return self.length() if callable(self.length) else self.length
+
+    def __repr__(self):
+        return f'Paged(key={self.key!r}, offset={self.offset}, page_size={self.page_size})'
+
+    def window(self):
+        """Returns the ``(key, item)`` pairs of the current page, including the
+        navigation items.
+        """
+        if self._window is None:
+            length = len(self)
+            self.offset = max(0, min(self.offset, (length - 1) // self.page_size * self.page_size))
+            end = min(length, self.offset + self.page_size)
+
+            window = []
+            if self.offset:
+                window.append(((self.key, 'previous'), PageItem(self.previous_label, self.previous_page, executor=False)))
+            for slot, index in enumerate(range(self.offset, end)):
+                window.append(((self.key, 'row', slot), MenuItem.coerce(self.getter(index))))
+            if end < length:
+                window.append(((self.key, 'more'), PageItem(self.more_label, self.next_page, executor=False)))
+            self._window = window
+        return self._window
+
+    def turn(self, offset):
+        """Shows the page starting at ``offset`` in all menus showing this section.
+        """
+        self.offset = max(0, offset)
+        self.invalidate()
+
+    def next_page(self, *args):
+        self.turn(self.offset + self.page_size)
+
+    def previous_page(self, *args):
+        self.turn(self.offset - self.page_size)
+
+    def invalidate(self):
+        """Gets the items of the current page again, e.g. after the list has
+        changed, and updates the menus showing this section.
+
+        Like all changes to a live menu, this has to happen in the main loop
+        thread. From other threads, use ``tray.dispatcher.call(section.invalidate)``.
+        """
+        self._window = None
+        for listener in list(self._listeners):
+            refresh = listener()
+            if refresh is None:
+                self._listeners.remove(listener)
+            else:
+                refresh()
+
+    def attach(self, refresh):
+        """Makes :meth:`invalidate` call the bound method ``refresh``.
+        """
+        listener = weakref.WeakMethod(refresh)
+        if listener not in self._listeners:
+            self._listeners.append(listener)
+
+
+def as_submenu(value):
+    """Returns a :class:`Submenu` for the ``submenu`` of a menu item, which may
+    be a :class:`Submenu`, a provider callable or a :class:`Menu`.
+    """
+    if isinstance(value, Submenu):
+        return value
+    if callable(value):
+        return Submenu(value)
+    items = Menu.coerce(value)
+    return Submenu(lambda: items)
+
+
+def keyed(items):
+    """Returns a list of ``(key, item)`` pairs for :class:`MenuItem` instances.
+
+    :raises ValueError: if two items have the same explicit key
+    """
+    result = []
+    seen = set()
+    occurrences = {}
+    for item in items:
+        key = item.key
+        if key is None:
+            implicit = (item.variant, item.label)
+            occurrence = occurrences[implicit] = occurrences.get(implicit, -1) + 1
+            key = implicit + (occurrence,)
+        elif key in seen:
+            raise ValueError(f'Duplicate menu item key {key!r}')
+        seen.add(key)
+        result.append((key, item))
+    return result
+
+
+def reconcile(entries, items, backend):
+    """Brings a live menu in line with a new list of menu items.
+
+    :param entries: The list of :class:`MenuEntry` instances in the order of
+        the live menu. It is updated in place.
+
+    :param items: The new menu items, a :class:`Menu` or anything
+        :meth:`Menu.coerce` accepts.
+
+    :param backend: An object with these methods, all positions are indices
+        into the live menu at the time of the call:
+
+        * ``insert_item(position, item)`` creates an item and returns its handle
+        * ``remove_item(entry)`` removes an item
+        * ``move_item(entry, position)`` moves an item
+        * ``update_item(entry, item)`` changes an item in place and returns the
+          new handle, or ``None`` if the item has to be recreated
+
+    :return: the number of operations performed on the live menu
+    """
+    new = Menu.coerce(items).flat()
+    new_keys = {key for key, item in new}
+    operations = 0
+
+    live = []
+    for entry in entries:
+        if entry.key in new_keys:
+            live.append(entry)
+        else:
+            backend.remove_item(entry)
+            operations += 1
+
+    old_index = {entry.key: i for i, entry in enumerate(live)}
+    by_key = {entry.key: entry for entry in live}
+
+    # Items in the longest run that is already in the right relative order
+    # stay where they are, all others are moved around them
+    stable = _longest_increasing_subsequence([old_index[key] for key, item in new if key in old_index])
+
+    # Going backwards, every item is placed in front of its already final
+    # successor
+    result = [None] * len(new)
+    successor = None
+    for position in reversed(range(len(new))):
+        key, item = new[position]
+        entry = by_key.get(key)
+
+        if entry is None:
+            index = live.index(successor) if successor else len(live)
+            entry = MenuEntry(key, item, backend.insert_item(index, item))
+            live.insert(index, entry)
+            operations += 1
+        else:
+            if old_index[key] not in stable:
+                live.remove(entry)
+                index = live.index(successor) if successor else len(live)
+                backend.move_item(entry, index)
+                live.insert(index, entry)
+                operations += 1
+
+            if entry.item is not item and entry.item != item:
+                handle = backend.update_item(entry, item)
+                if handle is None:
+                    index = live.index(entry)
+                    backend.remove_item(entry)
+                    handle = backend.insert_item(index, item)
+                entry.handle = handle
+                entry.item = item
+                operations += 1
+
+        result[position] = successor = entry
+
+    entries[:] = result
+    return operations
+
+
+def _longest_increasing_subsequence(sequence):
+    """Returns the set of values of a longest strictly increasing subsequence.
+    """
+    # tails[i] is the index into sequence of the smallest tail of all
+    # increasing subsequences of length i + 1
+    tails = []
+    previous = [None] * len(sequence)
+    for i, value in enumerate(sequence):
+        low, high = 0, len(tails)
+        while low < high:
+            middle = (low + high) // 2
+            if sequence[tails[middle]] < value:
+                low = middle + 1
+            else:
+                high = middle
+        previous[i] = tails[low - 1] if low else None
+        if low == len(tails):
+            tails.append(i)
+        else:
+            tails[low] = i
+
+    result = set()
+    i = tails[-1] if tails else None
+    while i is not None:
+        result.add(sequence[i])
+        i = previous[i]
+    return result
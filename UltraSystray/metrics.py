@@ -0,0 +1,150 @@
+# UltraSystray
+#
+# Copyright (C) 2022 Ronny Rentner
+#
+# Counts and latency histograms of clicks, menu callbacks and main loop
+# messages of a tray icon.
+#
+# Metrics are off unless enabled. While they are off, every instrumented call
+# only checks a flag.
+#
+
+import bisect
+import collections
+import itertools
+import math
+import threading
+import time
+
+#: Upper bounds of the histogram buckets in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, math.inf)
+
+
+class Histogram():
+    __slots__ = ('count', 'total', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        #: Observations per bucket, not cumulative
+        self.buckets = [0] * len(BUCKETS)
+
+    def observe(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.buckets[bisect.bisect_left(BUCKETS, seconds)] += 1
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'total': self.total,
+            'buckets': dict(zip(BUCKETS, itertools.accumulate(self.buckets))),
+        }
+
+
+class Metrics():
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        #: :class:`Histogram` per event, e.g. ``left_click`` or ``menu``
+        self.events = {}
+        #: :class:`Histogram` per menu item, by key or label
+        self.items = {}
+        #: Count per main loop message
+        self.messages = collections.Counter()
+        # Callbacks on executors are observed from other threads
+        self._lock = threading.Lock()
+
+    def call(self, event, function, *args):
+        """Calls ``function`` and records how long it took as ``event``.
+        """
+        if not self.enabled:
+            return function(*args)
+
+        start = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            self.observe(event, time.perf_counter() - start)
+
+    def observe(self, event, seconds, item=None):
+        """Records the duration of an event and, for menu callbacks, of the
+        :class:`menu.MenuItem`.
+        """
+        with self._lock:
+            histogram = self.events.get(event)
+            if histogram is None:
+                histogram = self.events[event] = Histogram()
+            histogram.observe(seconds)
+
+            if item is not None:
+                name = item_name(item)
+                histogram = self.items.get(name)
+                if histogram is None:
+                    histogram = self.items[name] = Histogram()
+                histogram.observe(seconds)
+
+    def count(self, message):
+        """Counts a main loop message.
+        """
+        if self.enabled:
+            self.messages[message] += 1
+
+    def clear(self):
+        with self._lock:
+            self.events = {}
+            self.items = {}
+            self.messages = collections.Counter()
+
+    def snapshot(self, dispatched=None):
+        """Returns all metrics as dict. Bucket counts are cumulative, by upper
+        bound in seconds.
+
+        :param dispatched: Number of calls the dispatcher passed into the main
+            loop.
+        """
+        with self._lock:
+            return {
+                'events': { name: histogram.as_dict() for name, histogram in self.events.items() },
+                'menu_items': { name: histogram.as_dict() for name, histogram in self.items.items() },
+                'messages': dict(self.messages),
+                'dispatched': dispatched,
+            }
+
+    def openmetrics(self, dispatched=None, prefix='ultrasystray'):
+        """Returns all metrics in the OpenMetrics text format.
+        """
+        lines = []
+        with self._lock:
+            _histogram_lines(lines, f'{prefix}_event_seconds', 'event', self.events)
+            _histogram_lines(lines, f'{prefix}_menu_item_seconds', 'item', self.items)
+
+            lines.append(f'# TYPE {prefix}_messages counter')
+            for message, count in self.messages.items():
+                lines.append(f'{prefix}_messages_total{{message="{_escape(message)}"}} {count}')
+
+        if dispatched is not None:
+            lines.append(f'# TYPE {prefix}_dispatched_calls counter')
+            lines.append(f'{prefix}_dispatched_calls_total {dispatched}')
+
+        lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
+
+
+def item_name(item):
+    return str(item.key) if item.key is not None else item.label
+
+
+def _histogram_lines(lines, metric, label, histograms):
+    lines.append(f'# TYPE {metric} histogram')
+    lines.append(f'# UNIT {metric} seconds')
+    for name, histogram in histograms.items():
+        name = _escape(name)
+        for bound, count in zip(BUCKETS, itertools.accumulate(histogram.buckets)):
+            bound = '+Inf' if bound == math.inf else repr(bound)
+            lines.append(f'{metric}_bucket{{{label}="{name}",le="{bound}"}} {count}')
+        lines.append(f'{metric}_count{{{label}="{name}"}} {histogram.count}')
+        lines.append(f'{metric}_sum{{{label}="{name}"}} {histogram.total!r}')
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
@@ -0,0 +1,474 @@
+# UltraSystray
+#
+# Copyright (C) 2022 Ronny Rentner
+#
+# Headless backend without any desktop session, e.g. for tests, benchmarks
+# and servers. Select it with SystrayIcon(backend='null') or by setting
+# ULTRASYSTRAY_BACKEND=null.
+#
+# Nothing is drawn. The icon records every operation on it and on its menu in
+# `operations`, and clicks and menu activations are injected with click() and
+# activate(). The menu goes through the same reconciliation, dispatching and
+# metrics as on the real backends.
+#
+
+import time
+# Start of the import phase of the startup profile
+_import_started = time.perf_counter()
+
+import logging
+import queue
+import signal
+import threading
+
+from . import badge, dispatch, menu
+from .animation import Animation
+from .dispatch import Dispatcher, marshalled
+from .menu import Menu, MenuItem
+from .metrics import Metrics
+from .startup import StartupProfile
+
+_imported = time.perf_counter()
+
+log = logging.getLogger(__name__)
+
+#: Buttons :meth:`SystrayIcon.click` takes
+BUTTONS = ('left', 'middle', 'right')
+
+#: Handle of menu items without submenu. ``None`` would make
+#: :func:`menu.reconcile` recreate the item on every change.
+ITEM = object()
+
+
+class SystrayIcon():
+    # There is no panel to ask for its size
+    ICON_SIZE = 24
+
+    def __init__(self, unique_id=None, icon=None, tooltip=None, menu_items=None, executor=None, metrics=False, startup_hook=None, **kwargs):
+        """
+        :param metrics: Records the metrics returned by :meth:`stats`.
+
+        :param startup_hook: Called with the :class:`startup.StartupProfile`
+            once the icon is shown, which counts as embedded.
+        """
+        started = time.perf_counter()
+
+        self.unique_id = unique_id
+        self.icon = icon
+        self.tooltip = tooltip
+        self.menu_items = menu_items
+        self.menu = None
+        self.visible = False
+
+        #: Every operation as tuple of its name and arguments, in order
+        self.operations = []
+
+        self.badge = None
+        self.animation = None
+
+        #: The main loop of the icon while it is not hosted by a
+        #: :class:`manager.TrayManager`
+        self.loop = MainLoop()
+        #: Runs the public methods in the main loop when they are called from
+        #: other threads
+        self.dispatcher = Dispatcher(self.loop.wakeup)
+        #: :class:`concurrent.futures.Executor` for menu callbacks, which
+        #: otherwise run in the main loop
+        self.executor = executor
+        # Set while run_async() drives the icon
+        self._stopped = None
+        #: The :class:`manager.TrayManager` hosting the icon, if any
+        self.manager = None
+
+        #: Set once the icon is shown while its main loop runs
+        self.ready = threading.Event()
+        #: Seconds :meth:`start` and :meth:`stop` took the last time
+        self.startup_duration = None
+        self.shutdown_duration = None
+        self._thread = None
+
+        #: Timestamps of the startup phases up to the first embedding
+        self.startup_profile = StartupProfile((_import_started, _imported), startup_hook)
+        self.startup_profile.add('construct', started)
+
+        #: Counts and latencies of clicks, menu callbacks and messages
+        self.metrics = Metrics(metrics)
+
+    def record(self, name, *args):
+        self.operations.append((name, *args))
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('%s %r', name, args, extra={ 'event': name })
+
+    def show(self):
+        started = time.perf_counter()
+        self.record('show')
+
+        if self.menu_items:
+            with self.startup_profile.measure('menu'):
+                self.set_menu(self.create_menu(items=self.menu_items))
+
+        with self.startup_profile.measure('icon'):
+            self.update_icon()
+        self.set_tooltip(self.tooltip)
+        self.visible = True
+
+        self.startup_profile.add('show', started)
+        # Nothing to wait for
+        self.startup_profile.add('embedded', started)
+
+    def hide(self):
+        """Removes the icon. It can be shown again with :meth:`show`.
+        """
+        if self.visible:
+            self.record('hide')
+            self.visible = False
+
+    def run(self):
+        # Make sure that we do not inhibit CTRL-C;
+        # this is only possible from the main thread
+        try: signal.signal(signal.SIGINT, signal.SIG_DFL)
+        except ValueError: pass
+
+        self.dispatcher.attach()
+        try:
+            self.loop.run(self._start)
+        finally:
+            self.dispatcher.detach()
+
+    def _start(self):
+        self.show()
+        self.ready.set()
+
+    def start(self, timeout=None):
+        """Runs the icon on a thread of its own and returns once the panel
+        shows it. See :func:`dispatch.start`.
+        """
+        dispatch.start(self, timeout)
+
+    def stop(self, timeout=None):
+        """Quits the icon and waits until its main loop has ended. See
+        :func:`dispatch.stop`.
+        """
+        dispatch.stop(self, timeout)
+
+    async def run_async(self):
+        """Shows the icon and runs it in the running asyncio loop until
+        :meth:`quit` is called.
+
+        Menu callbacks and click handlers may be coroutine functions, they run
+        as tasks of the loop.
+        """
+        import asyncio
+        loop = asyncio.get_running_loop()
+        self._stopped = asyncio.Event()
+
+        # Calls from other threads wake up the asyncio loop directly
+        self.dispatcher.wakeup = loop.call_soon_threadsafe
+        self.dispatcher.attach()
+        try:
+            self._start()
+            await self._stopped.wait()
+        finally:
+            self.dispatcher.detach()
+            self.dispatcher.wakeup = self.loop.wakeup
+            self._stopped = None
+            self.hide()
+
+    @marshalled
+    def quit(self, *args, **kwargs):
+        """Hides the icon and ends its main loop.
+
+        Icons hosted by a :class:`manager.TrayManager` are only removed from
+        it, the main loop keeps running for the other icons.
+        """
+        self.record('quit')
+        if self.manager:
+            self.manager.remove(self)
+            return
+        self.hide()
+        if self._stopped:
+            self._stopped.set()
+        else:
+            self.loop.quit()
+
+    @marshalled
+    def click(self, button='left'):
+        """Injects a click on the icon, as if the user clicked it.
+
+        :param button: ``'left'``, ``'middle'`` or ``'right'``
+        """
+        if button not in BUTTONS:
+            raise ValueError(f"Invalid button '{button}', use one of {', '.join(BUTTONS)}")
+        self.record('click', button)
+
+        if button == 'left':
+            return dispatch.schedule(self.metrics.call('left_click', self.on_left_click))
+        if button == 'middle':
+            return self.metrics.call('middle_click', self.on_middle_click)
+        return self.metrics.call('right_click', self.on_right_click)
+
+    @marshalled
+    def activate(self, *keys, argument=None):
+        """Injects a click on a menu item, as if the user clicked it.
+
+        :param keys: The key, or the label if it has none, of the item,
+            preceded by those of the submenus it is in. The submenus are
+            opened on the way.
+
+        :param argument: Passed to the callback of the item.
+
+        :return: the future or task of the callback, see
+            :func:`dispatch.run_callback`, or ``None`` if the item has no
+            callback
+        """
+        if self.menu is None:
+            raise RuntimeError('The icon has no menu')
+        current = self.menu
+        for key in keys[:-1]:
+            current = current.open(key)
+        return current.activate(keys[-1], argument)
+
+    def on_left_click(self, *args):
+        pass
+
+    def on_middle_click(self, *args):
+        self.quit()
+
+    def on_right_click(self, *args):
+        if self.menu:
+            self.record('popup_menu')
+
+    @marshalled
+    def set_tooltip(self, tooltip):
+        self.tooltip = tooltip
+        self.title = tooltip
+        self.record('set_tooltip', tooltip)
+
+    @marshalled
+    def set_menu(self, menu):
+        self.menu = menu
+        self.record('set_menu', menu)
+
+    @marshalled
+    def set_icon(self, icon):
+        """Changes the icon. Any value is taken, nothing is decoded.
+        """
+        self.icon = icon
+        if self.visible and not self.animation:
+            self.update_icon()
+
+    def update_icon(self):
+        self.record('update_icon', self.icon, self.badge)
+
+    @marshalled
+    def set_badge(self, value, color=badge.DEFAULT_COLOR, position='top-right'):
+        """Sets or removes a badge, see :func:`badge.make`.
+        """
+        self.badge = badge.make(value, color, position)
+        if self.visible and not self.animation:
+            self.update_icon()
+
+    @marshalled
+    def animate(self, frames, fps=10):
+        """Starts an animation. There is no timer, frames are only advanced by
+        :meth:`next_animation_frame`.
+        """
+        self.stop_animation(restore=False)
+        self.animation = Animation(frames, fps)
+        self.animation.decode(lambda frame: frame)
+        self.record('animate', len(self.animation), fps)
+
+    @marshalled
+    def next_animation_frame(self):
+        self.metrics.count('animation_frame')
+        self.record('animation_frame', self.animation.next())
+
+    @marshalled
+    def stop_animation(self, restore=True):
+        if self.animation:
+            self.record('stop_animation')
+        self.animation = None
+
+        if restore and self.visible:
+            self.update_icon()
+
+    @marshalled
+    def notify(self, message, title=None):
+        """Records a desktop notification.
+        """
+        self.record('notify', message, title)
+
+    def create_menu(self, items=None):
+        return NullMenu(items or [{'key': 'quit', 'label': 'Quit', 'callback': self.quit}], runner=self.run_callback, record=self.record)
+
+    def run_callback(self, item, argument, set_busy=None):
+        """Runs the callback of a clicked menu item, on the executor of the
+        item or of the icon if there is one.
+        """
+        return dispatch.run_callback(self.dispatcher, self.executor, item, argument, set_busy, self.metrics)
+
+    def stats(self, format=None):
+        """Returns counts and latency histograms of clicks, menu callbacks and
+        main loop messages, see :class:`metrics.Metrics`. They are only
+        recorded if the icon was created with ``metrics=True``.
+
+        :param format: ``'openmetrics'`` for the OpenMetrics text format
+            instead of a dict.
+        """
+        if format == 'openmetrics':
+            return self.metrics.openmetrics(self.dispatcher.dispatched)
+        if format is not None:
+            raise ValueError(f'Unknown format {format!r}')
+        return self.metrics.snapshot(self.dispatcher.dispatched)
+
+    def create_menu_item(self, label='', callback=None, variant='default', active=True, enabled=True, key=None, submenu=None):
+        return MenuItem(label, callback, variant, active, enabled, key, submenu)
+
+    @marshalled
+    def update_menu(self, items):
+        """Changes the menu items.
+
+        :param items: A :class:`menu.Menu` or a list of :class:`menu.MenuItem`
+            instances or dicts. Showing the same :class:`menu.Menu` again does
+            nothing.
+
+        Items are matched by their ``key``, or by variant and label if they
+        have none, and only the changed items are recorded.
+        """
+        # Validates the items before anything is changed
+        self.menu_items = items = Menu.coerce(items)
+        if self.menu is None:
+            self.set_menu(self.create_menu(items))
+        else:
+            self.menu.update(items)
+
+
+class NullMenu():
+    """A menu without widgets, the backend of :func:`menu.reconcile`.
+
+    Handles are the :class:`NullMenu` of a submenu, or :data:`ITEM`.
+    """
+    def __init__(self, items=None, runner=None, record=None):
+        """
+        :param runner: Called as ``runner(item, argument, set_busy)`` to run
+            the callback of an activated item, see
+            :func:`dispatch.run_callback`. Without it, callbacks are called
+            directly.
+
+        :param record: Called with the name and the arguments of every
+            change of the menu.
+        """
+        self.runner = runner
+        self.record = record or (lambda *args: None)
+        #: :class:`menu.MenuEntry` instances in menu order
+        self.entries = []
+        #: The :class:`menu.Menu` shown right now
+        self.items = None
+        #: Keys of the items whose callbacks are running
+        self.busy = set()
+        self.update(items)
+
+    def update(self, items):
+        """Changes the menu to show ``items``.
+
+        :return: the number of changed items
+        """
+        items = menu.Menu.coerce(items)
+        if items is self.items:
+            return 0
+        self.items = items
+        for section in items.sections:
+            section.attach(self.refresh)
+        return menu.reconcile(self.entries, items, self)
+
+    def refresh(self):
+        """Shows the current page of all :class:`menu.Paged` sections.
+        """
+        if self.items is not None:
+            menu.reconcile(self.entries, self.items, self)
+
+    def set_busy(self, key, busy):
+        if busy:
+            self.busy.add(key)
+        else:
+            self.busy.discard(key)
+        self.record('set_busy', key, busy)
+
+    def entry(self, key):
+        """Returns the :class:`menu.MenuEntry` of the item with ``key``, or
+        with this label if the item has no key.
+
+        :raises KeyError: if there is no such item
+        """
+        for entry in self.entries:
+            item = entry.item
+            if item.key == key or (item.key is None and item.label == key):
+                return entry
+        raise KeyError(key)
+
+    def open(self, key):
+        """Opens a submenu and returns its :class:`NullMenu`.
+        """
+        entry = self.entry(key)
+        if entry.handle is ITEM:
+            raise ValueError(f'{entry.item!r} has no submenu')
+        self.record('open', key)
+        entry.handle.update(menu.as_submenu(entry.item.submenu).items())
+        return entry.handle
+
+    def activate(self, key, argument=None):
+        entry = self.entry(key)
+        item = entry.item
+        if not item.enabled or entry.key in self.busy:
+            raise ValueError(f'{item!r} is disabled')
+        self.record('activate', key)
+
+        if not item.callback:
+            return None
+        if self.runner:
+            return self.runner(item, argument, lambda busy: self.set_busy(entry.key, busy))
+        return item.callback(argument)
+
+    def insert_item(self, position, item):
+        self.record('insert_item', position, item)
+        if item.submenu is not None:
+            return NullMenu(runner=self.runner, record=self.record)
+        return ITEM
+
+    def remove_item(self, entry):
+        self.record('remove_item', entry.item)
+
+    def move_item(self, entry, position):
+        self.record('move_item', entry.item, position)
+
+    def update_item(self, entry, item):
+        if item.variant != entry.item.variant or item.submenu != entry.item.submenu:
+            return None
+        self.record('update_item', item)
+        return entry.handle
+
+
+class MainLoop():
+    """A main loop that only runs the calls of its dispatcher, for an icon or
+    a :class:`manager.TrayManager`.
+    """
+    def __init__(self):
+        self._calls = queue.SimpleQueue()
+
+    def wakeup(self, drain):
+        self._calls.put(drain)
+
+    def run(self, start):
+        """Runs the main loop until :meth:`quit` is called.
+
+        :param start: Called in the loop thread before the main loop runs.
+        """
+        start()
+        while True:
+            call = self._calls.get()
+            if call is None:
+                break
+            call()
+
+    def quit(self):
+        self._calls.put(None)
@@ -0,0 +1,202 @@
+# UltraSystray
+#
+# Copyright (C) 2022 Ronny Rentner
+#
+# Picks the backend that works in the current Linux desktop session.
+#
+# GTK status icons need an XEmbed tray, i.e. an owner of the
+# _NET_SYSTEM_TRAY_S<screen> selection. AppIndicators need a
+# StatusNotifierWatcher on the session bus. Both need their gi typelibs.
+#
+# The ranking is stored in a per-session cache, keyed by desktop and display,
+# so later launches don't probe at all. If the best backend fails to import,
+# the next one is used right away and the cache is updated.
+#
+
+import collections
+import hashlib
+import importlib
+import json
+import os
+import pathlib
+
+#: Backends that can be probed, in the order they are preferred
+BACKENDS = ('gtk', 'appindicator')
+
+Capabilities = collections.namedtuple('Capabilities', 'status_notifier_watcher xembed_tray gtk appindicator')
+
+
+def probe():
+    """Checks what the current session supports.
+
+    :return: :class:`Capabilities`
+    """
+    gtk = _has_typelib('Gtk', '3.0') and _has_typelib('GdkPixbuf', '2.0')
+    appindicator = gtk and _has_typelib('AyatanaAppIndicator3', '0.1')
+    return Capabilities(
+        status_notifier_watcher=appindicator and _has_status_notifier_watcher(),
+        xembed_tray=_has_xembed_tray(),
+        gtk=gtk,
+        appindicator=appindicator)
+
+
+def rank(capabilities):
+    """Orders the backends by how likely their icon shows up.
+
+    Backends whose tray host is running come first, then those that are at
+    least installed, in case a tray host starts later.
+    """
+    def score(name):
+        if name == 'gtk':
+            return (capabilities.gtk and capabilities.xembed_tray, capabilities.gtk)
+        return (capabilities.appindicator and capabilities.status_notifier_watcher, capabilities.appindicator)
+
+    # sorted() is stable, so ties keep the preferred order
+    return sorted(BACKENDS, key=score, reverse=True)
+
+
+def session_key():
+    """Returns the key of the desktop session in the cache.
+    """
+    session = [os.environ.get(name, '') for name in ('XDG_CURRENT_DESKTOP', 'XDG_SESSION_TYPE', 'DISPLAY', 'WAYLAND_DISPLAY')]
+    return hashlib.blake2b('\0'.join(session).encode(), digest_size=8).hexdigest()
+
+
+def cache_path():
+    # The runtime directory only lives as long as the user is logged in
+    base = os.environ.get('XDG_RUNTIME_DIR') or os.environ.get('XDG_CACHE_HOME') or pathlib.Path.home() / '.cache'
+    return pathlib.Path(base) / 'UltraSystray' / f'backend-{session_key()}.json'
+
+
+def backends(refresh=False):
+    """Returns the names of the backends for this session, best first.
+
+    :param refresh: Probe again instead of using the cached ranking.
+    """
+    path = cache_path()
+    if not refresh:
+        try:
+            names = json.loads(path.read_text())['backends']
+            if sorted(names) == sorted(BACKENDS):
+                return names
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+    capabilities = probe()
+    names = rank(capabilities)
+    _store(path, names, capabilities)
+    return names
+
+
+def load_backend(refresh=False):
+    """Imports the best backend of the session.
+
+    If it cannot be imported, the next one is used and the failed one is
+    moved to the end of the cached ranking.
+
+    :return: the backend module
+    """
+    names = backends(refresh)
+    errors = []
+    for name in names:
+        try:
+            module = importlib.import_module(f'.{name}', __package__)
+        except (ImportError, ValueError) as e:
+            # gi raises ValueError for missing typelibs
+            errors.append(e)
+            continue
+
+        if errors:
+            failed = names[:len(errors)]
+            _store(cache_path(), names[len(errors):] + failed)
+        return module
+
+    raise ImportError(f'No tray backend can be imported, tried {", ".join(names)}') from errors[-1]
+
+
+def invalidate():
+    """Removes the cached ranking, so that the next launch probes again.
+    """
+    try:
+        cache_path().unlink()
+    except FileNotFoundError:
+        pass
+
+
+def _store(path, names, capabilities=None):
+    data = { 'backends': names }
+    if capabilities:
+        data['capabilities'] = capabilities._asdict()
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        partial = path.with_suffix('.partial')
+        partial.write_text(json.dumps(data))
+        partial.replace(path)
+    except OSError:
+        # Without a cache, the next launch just probes again
+        pass
+
+
+def _has_typelib(namespace, version):
+    try:
+        import gi
+        gi.require_version(namespace, version)
+    except (ImportError, ValueError):
+        return False
+    return True
+
+
+def _has_status_notifier_watcher():
+    try:
+        from gi.repository import Gio, GLib
+        bus = Gio.bus_get_sync(Gio.BusType.SESSION, None)
+        reply = bus.call_sync(
+            'org.freedesktop.DBus', '/org/freedesktop/DBus', 'org.freedesktop.DBus', 'NameHasOwner',
+            GLib.Variant('(s)', ('org.kde.StatusNotifierWatcher',)), GLib.VariantType('(b)'),
+            Gio.DBusCallFlags.NONE, 500, None)
+    except Exception:
+        return False
+    return reply.unpack()[0]
+
+
+def _has_xembed_tray():
+    # Asks the X server directly, loading Gdk would take much longer
+    if not os.environ.get('DISPLAY'):
+        return False
+
+    import ctypes
+    try:
+        xlib = ctypes.CDLL('libX11.so.6')
+    except OSError:
+        return False
+
+    xlib.XOpenDisplay.argtypes = (ctypes.c_char_p,)
+    xlib.XOpenDisplay.restype = ctypes.c_void_p
+    xlib.XDefaultScreen.argtypes = (ctypes.c_void_p,)
+    xlib.XInternAtom.argtypes = (ctypes.c_void_p, ctypes.c_char_p, ctypes.c_int)
+    xlib.XInternAtom.restype = ctypes.c_ulong
+    xlib.XGetSelectionOwner.argtypes = (ctypes.c_void_p, ctypes.c_ulong)
+    xlib.XGetSelectionOwner.restype = ctypes.c_ulong
+    xlib.XCloseDisplay.argtypes = (ctypes.c_void_p,)
+
+    display = xlib.XOpenDisplay(None)
+    if not display:
+        return False
+    try:
+        selection = f'_NET_SYSTEM_TRAY_S{xlib.XDefaultScreen(display)}'.encode()
+        # Without the atom, nobody can own the selection
+        atom = xlib.XInternAtom(display, selection, True)
+        return bool(atom and xlib.XGetSelectionOwner(display, atom))
+    finally:
+        xlib.XCloseDisplay(display)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Probe the tray backends of this desktop session')
+    parser.add_argument('--refresh', action='store_true', help='Probe again instead of using the cached ranking')
+    args = parser.parse_args()
+
+    for field, value in probe()._asdict().items():
+        print(f'{field:24} {value}')
+    print('Backends:', ', '.join(backends(args.refresh)), f"(cached in '{cache_path()}')")
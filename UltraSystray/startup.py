@@ -0,0 +1,91 @@
+# UltraSystray
+#
+# Copyright (C) 2022 Ronny Rentner
+#
+# Timestamps of the startup phases of an icon, from the import of the backend
+# up to the moment the panel has embedded the icon.
+#
+# All timestamps come from time.perf_counter(), which is monotonic. Every
+# phase is only recorded the first time, showing the icon again later on
+# doesn't change the profile.
+#
+
+import collections
+import contextlib
+import time
+
+#: The phases in the order they happen
+PHASES = ('import', 'construct', 'show', 'menu', 'icon', 'embedded')
+
+Phase = collections.namedtuple('Phase', 'name start end')
+
+
+class StartupProfile():
+    def __init__(self, imported=None, hook=None):
+        """
+        :param imported: The start and end of the import of the backend module.
+
+        :param hook: Called with the profile once the icon is embedded, e.g.
+            to log it or to check it against a budget.
+        """
+        self.phases = {}
+        self.hook = hook
+        if imported:
+            self.add('import', *imported)
+
+    def add(self, name, start, end=None):
+        """Records a phase that ends now, or at ``end``.
+        """
+        if name in self.phases:
+            return
+        self.phases[name] = Phase(name, start, time.perf_counter() if end is None else end)
+        if name == 'embedded' and self.hook:
+            self.hook(self)
+
+    @contextlib.contextmanager
+    def measure(self, name):
+        """Records the code run in the ``with`` block as phase.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, start)
+
+    @property
+    def complete(self):
+        return 'embedded' in self.phases
+
+    def duration(self, name):
+        """Returns the duration of a phase in seconds, or ``None`` if it
+        wasn't recorded.
+        """
+        phase = self.phases.get(name)
+        return phase.end - phase.start if phase else None
+
+    def total(self):
+        """Returns the seconds from the first recorded phase to the last one.
+        """
+        if not self.phases:
+            return 0.0
+        return max(phase.end for phase in self.phases.values()) - min(phase.start for phase in self.phases.values())
+
+    def as_dict(self):
+        """Returns the phases in order, with start and end in seconds relative
+        to the start of the first phase.
+        """
+        if not self.phases:
+            return {}
+        origin = min(phase.start for phase in self.phases.values())
+        return {
+            name: {
+                'start': phase.start - origin,
+                'end': phase.end - origin,
+                'duration': phase.end - phase.start,
+            }
+            for name in PHASES if (phase := self.phases.get(name))
+        }
+
+    def __repr__(self):
+        durations = ', '.join(f'{name}={self.duration(name) * 1000:.1f}ms' for name in PHASES if name in self.phases)
+        return f'StartupProfile({durations})'
@@ -15,19 +15,48 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
+import time
+# Start of the import phase of the startup profile
+_import_started = time.perf_counter()
+
 import ctypes
+import logging
+import pathlib
 import threading
 
 from ctypes import wintypes
 
 from . import win32_adapter as win32
+from . import badge, cache, dispatch, ico, icons, menu
+from .animation import Animation
+from .archive import IconRef
+from .dispatch import Dispatcher, marshalled
+from .metrics import Metrics
+from .startup import StartupProfile
+
+_imported = time.perf_counter()
+
+log = logging.getLogger(__name__)
 
 class SystrayIcon():
     _HWND_TO_ICON = {}
 
-    def __init__(self, unique_id=None, icon=None, tooltip=None, menu_items=None, **kwargs):
+    #: The window class shared by all icons of the process
+    _ATOM = None
+    _ATOM_LOCK = threading.Lock()
+
+    #: The ID of the timer driving animations
+    _ANIMATION_TIMER = 1
+
+    def __init__(self, unique_id=None, icon=None, tooltip=None, menu_items=None, executor=None, metrics=False, startup_hook=None, **kwargs):
+        """
+        :param metrics: Records the metrics returned by :meth:`stats`.
+
+        :param startup_hook: Called with the :class:`startup.StartupProfile`
+            once the icon is added to the notification area.
+        """
+        started = time.perf_counter()
 
-        
         # unique_id not used in this implementation
         self.unique_id = unique_id
 
@@ -35,14 +64,44 @@ class SystrayIcon():
         self.icon = icon
         self.tooltip = tooltip
         self.menu_items = menu_items
+        #: The :class:`Win32Menu` while running
         self.menu = None
 
         self._icon_handle = None
+        # Whether the icon handle is a copy the icon has to destroy
+        self._icon_owned = False
         self._hwnd = None
         self._menu_hwnd = None
-        self._menu_handle = None
-        self._hmenu = None
         self._running = False
+        #: The :class:`manager.TrayManager` hosting the icon, if any
+        self.manager = None
+
+        self.badge = None
+        self.animation = None
+
+        #: Runs the public methods in the message loop when they are called
+        #: from other threads
+        self.dispatcher = Dispatcher(self._wakeup)
+        #: :class:`concurrent.futures.Executor` for menu callbacks, which
+        #: otherwise run in the message loop
+        self.executor = executor
+
+        #: Set once the notification area shows the icon while its message
+        #: loop runs
+        self.ready = threading.Event()
+        #: Seconds :meth:`start` and :meth:`stop` took the last time
+        self.startup_duration = None
+        self.shutdown_duration = None
+        self._thread = None
+
+        #: Timestamps of the startup phases up to the first time the icon
+        #: was added to the notification area
+        self.startup_profile = StartupProfile((_import_started, _imported), startup_hook)
+        self.startup_profile.add('construct', started)
+        self._show_started = None
+
+        #: Counts and latencies of clicks, menu callbacks and window messages
+        self.metrics = Metrics(metrics)
 
     def __del__(self):
         if self._running:
@@ -53,12 +112,17 @@ class SystrayIcon():
 
     def _show(self):
         self.load_icon()
-        self._message(
+        added = self._message(
             win32.NIM_ADD,
             win32.NIF_MESSAGE | win32.NIF_ICON | win32.NIF_TIP,
             uCallbackMessage=win32.WM_NOTIFY,
             hIcon=self._icon_handle,
             szTip=self.tooltip)
+        # Without a taskbar, the icon is added again on WM_TASKBARCREATED
+        if added:
+            if self._show_started is not None:
+                self.startup_profile.add('embedded', self._show_started)
+            self.ready.set()
 
     def _hide(self):
         self._message(win32.NIM_DELETE, 0)
@@ -70,7 +134,74 @@ class SystrayIcon():
             win32.NIM_MODIFY,
             win32.NIF_ICON,
             hIcon=self._icon_handle)
-        self._icon_valid = True
+
+    @marshalled
+    def set_icon(self, icon):
+        """Changes the icon.
+
+        :param icon: A :class:`pathlib.Path`, an :class:`archive.IconRef`, an
+            :class:`ico.IcoFile` or encoded PNG or ICO data in any object
+            supporting the buffer protocol.
+        """
+        self.icon = icon
+        if self._hwnd and not self.animation:
+            self._update_icon()
+
+    @marshalled
+    def set_badge(self, value, color=badge.DEFAULT_COLOR, position='top-right'):
+        """Draws a badge like an unread count or a warning dot onto the icon.
+
+        :param value: A number, a short text, ``''`` for a plain dot or ``None``
+            to remove the badge.
+
+        Badges can only be drawn on ICO icons with 32 bit frames. Every
+        combination of icon, badge and size is rendered only once.
+        """
+        self.badge = badge.make(value, color, position)
+        if self._hwnd and not self.animation:
+            self._update_icon()
+
+    @marshalled
+    def animate(self, frames, fps=10):
+        """Cycles through a sequence of icons until :meth:`stop_animation` is called.
+
+        All frames are decoded to icon handles once up front, the timer only
+        swaps handles.
+        """
+        self.stop_animation(restore=False)
+        self.animation = Animation(frames, fps)
+        if self._hwnd:
+            self._start_animation()
+
+    def _start_animation(self):
+        size = win32.GetSystemMetrics(win32.SM_CXSMICON)
+        self.animation.decode(lambda frame: self._decode_icon(frame, size)[0])
+        win32.SetTimer(self._hwnd, self._ANIMATION_TIMER, self.animation.interval, None)
+
+    def _on_timer(self, wparam, lparam):
+        """Handles ``WM_TIMER``.
+        """
+        # Hidden icons are not animated
+        if wparam != self._ANIMATION_TIMER or not self.animation or not self.visible:
+            return
+        self._message(
+            win32.NIM_MODIFY,
+            win32.NIF_ICON,
+            hIcon=self.animation.next())
+
+    @marshalled
+    def stop_animation(self, restore=True):
+        animation = self.animation
+        self.animation = None
+        if not animation:
+            return
+
+        if self._hwnd:
+            win32.KillTimer(self._hwnd, self._ANIMATION_TIMER)
+        if restore and self._hwnd:
+            self._update_icon()
+        for handle in animation.frames or ():
+            win32.DestroyIcon(handle)
 
     def _update_title(self):
         self._message(
@@ -92,68 +223,176 @@ class SystrayIcon():
             szInfo='')
 
     def destroy_menu(self):
-        try:
-            hmenu, callbacks = self._menu_handle
-            win32.DestroyMenu(hmenu)
-        except:
-            pass
+        if self.menu:
+            self.menu.destroy()
+            self.menu = None
 
     def _update_menu(self):
-        self.destroy_menu()
-
-        callbacks = []
-        hmenu = self.create_menu(self.menu_items)
-        self.menu = hmenu
-        print('update menu', hmenu)
-        if hmenu:
-            self._menu_handle = (hmenu, callbacks)
+        if self.menu is None:
+            self.menu = self.create_menu(self.menu_items)
         else:
-            self._menu_handle = None
+            self.menu.update(self.menu_items)
+
+    @marshalled
+    def update_menu(self, items):
+        """Changes the menu items.
+
+        :param items: A :class:`menu.Menu` or a list of :class:`menu.MenuItem`
+            instances or dicts. Showing the same :class:`menu.Menu` again does
+            nothing.
+
+        Items are matched by their ``key``, or by variant and label if they
+        have none, and only the changed menu items are touched.
+        """
+        # Validates the items before anything is changed
+        self.menu_items = items = menu.Menu.coerce(items)
+        if self._hwnd:
+            self._update_menu()
 
     def run(self):
+        # Ready once the icon is added to the notification area, see _show()
+        self._start()
+        self._mainloop()
+
+    def start(self, timeout=None):
+        """Runs the icon on a thread of its own and returns once the panel
+        shows it. See :func:`dispatch.start`.
+        """
+        dispatch.start(self, timeout)
 
+    def stop(self, timeout=None):
+        """Quits the icon and waits until its main loop has ended. See
+        :func:`dispatch.stop`.
+        """
+        dispatch.stop(self, timeout)
+
+    async def run_async(self, interval=0.05):
+        """Shows the icon and pumps its messages from the running asyncio loop
+        until :meth:`quit` is called.
+
+        Menu callbacks and click handlers may be coroutine functions, they run
+        as tasks of the loop.
+
+        The message queue of a thread can only be waited on by the thread
+        itself, which would block the asyncio loop, so it is polled. After a
+        message, the next poll follows within a millisecond, the wait then
+        doubles up to ``interval`` while the icon stays idle. Calls from other
+        threads don't wait for the poll, they wake up the asyncio loop.
+
+        :param interval: Longest wait in seconds between two polls.
+        """
+        import asyncio
+        loop = asyncio.get_running_loop()
+        self._start()
+
+        # Calls from other threads wake up the asyncio loop directly
+        self.dispatcher.wakeup = loop.call_soon_threadsafe
+        try:
+            msg = wintypes.MSG()
+            lpmsg = ctypes.byref(msg)
+            wait = 0
+            while True:
+                busy = False
+                while win32.PeekMessage(lpmsg, None, 0, 0, win32.PM_REMOVE):
+                    if msg.message == win32.WM_QUIT:
+                        return
+                    win32.TranslateMessage(lpmsg)
+                    win32.DispatchMessage(lpmsg)
+                    busy = True
+
+                # Give other tasks a turn right after a message, then back off
+                wait = 0 if busy else min(interval, max(wait * 2, 0.001))
+                await asyncio.sleep(wait)
+
+        finally:
+            self.dispatcher.wakeup = self._wakeup
+            self._cleanup()
+
+    def _start(self):
         @win32.TypeConsoleCtrlHandler
         def console_handler(ctrl_type):
             if ctrl_type == win32.CTRL_C_EVENT:
                 self.quit()
             return False
 
+        # Kept alive as long as the icon, since Windows calls it later on
+        self._console_handler = console_handler
         if not win32.SetConsoleCtrlHandler(console_handler, True):
             raise RuntimeError('SetConsoleCtrlHandler failed.')
 
-        self._atom = self._register_class()
+        # Create the message loop
+        msg = wintypes.MSG()
+        lpmsg = ctypes.byref(msg)
+        win32.PeekMessage(
+            lpmsg, None, win32.WM_USER, win32.WM_USER, win32.PM_NOREMOVE)
+
+        self.dispatcher.attach()
+        self.show()
+        # Calls from other threads before the window existed couldn't wake
+        # up the message loop
+        self.dispatcher.drain()
+
+    def show(self):
+        """Creates the windows of the icon and adds it to the notification
+        area. Must be called in the thread running the message loop.
+        """
+        started = self._show_started = time.perf_counter()
+        atom = self._register_class()
 
         # This is a mapping from win32 event codes to handlers used by the
         # mainloop
         self._message_handlers = {
             win32.WM_STOP: self.quit,
             win32.WM_NOTIFY: self._on_notify,
+            win32.WM_TIMER: self._on_timer,
+            win32.WM_INITMENUPOPUP: self._on_init_menu_popup,
+            # A manager may have replaced the dispatcher
+            win32.WM_DISPATCH: lambda wparam, lparam: self.dispatcher.drain(),
             win32.WM_TASKBARCREATED: self._on_taskbarcreated
         }
 
-        # Create the message loop
-        msg = wintypes.MSG()
-        lpmsg = ctypes.byref(msg)
-        win32.PeekMessage(
-            lpmsg, None, win32.WM_USER, win32.WM_USER, win32.PM_NOREMOVE)
-
-        self._hwnd = self._create_window(self._atom)
-        self._menu_hwnd = self._create_window(self._atom)
+        self._hwnd = self._create_window(atom)
+        self._menu_hwnd = self._create_window(atom)
         self._HWND_TO_ICON[self._hwnd] = self
+        # Receives WM_INITMENUPOPUP while the menu is open
+        self._HWND_TO_ICON[self._menu_hwnd] = self
 
-        #self._mark_ready()
+        with self.startup_profile.measure('menu'):
+            self._update_menu()
 
-        # Run the event loop
-        #self._thread = threading.current_thread()
+        with self.startup_profile.measure('icon'):
+            self.load_icon()
+        self._show()
 
-        self._update_menu()
+        if self.animation:
+            self._start_animation()
 
-        self._show()
+        self.startup_profile.add('show', started)
 
-        self._mainloop()
+    def hide(self):
+        """Removes the icon from the notification area and destroys its
+        windows. It can be shown again with :meth:`show`.
+        """
+        if not self._hwnd:
+            return
+
+        if self.animation:
+            win32.KillTimer(self._hwnd, self._ANIMATION_TIMER)
+        self._hide()
+        self._release_icon()
+        self.destroy_menu()
+
+        del self._HWND_TO_ICON[self._hwnd]
+        del self._HWND_TO_ICON[self._menu_hwnd]
+        win32.DestroyWindow(self._hwnd)
+        win32.DestroyWindow(self._menu_hwnd)
+        self._hwnd = self._menu_hwnd = None
 
-    def _run_detached(self):
-        threading.Thread(target=lambda: self._run()).start()
+    def _wakeup(self, drain):
+        # Without a window, the message would go to the calling thread. The
+        # calls are drained once the window exists.
+        if self._hwnd:
+            win32.PostMessage(self._hwnd, win32.WM_DISPATCH, 0, 0)
 
     def _stop(self):
         win32.PostMessage(self._hwnd, win32.WM_STOP, 0, 0)
@@ -164,57 +403,47 @@ class SystrayIcon():
         This method retrieves all events from *Windows* and makes sure to
         dispatch clicks.
         """
-        # Pump messages
         try:
-            msg = wintypes.MSG()
-            lpmsg = ctypes.byref(msg)
-            while True:
-                r = win32.GetMessage(lpmsg, None, 0, 0)
-                if not r:
-                    break
-                elif r == -1:
-                    break
-                else:
-                    win32.TranslateMessage(lpmsg)
-                    win32.DispatchMessage(lpmsg)
-
-        except Exception as e:
-            print('An error occurred in the main loop')
-            raise e
-
+            _pump()
         finally:
-            try:
-                self._hide()
-                del self._HWND_TO_ICON[self._hwnd]
-            except:
-                # Ignore
-                pass
-
-            #win32.DestroyWindow(self._hwnd)
-            #win32.DestroyWindow(self._menu_hwnd)
-            #if self._menu_handle:
-            #    hmenu, callbacks = self._menu_handle
-            #    win32.DestroyMenu(hmenu)
-            #self._unregister_class(self._atom)
+            self._cleanup()
 
-    @classmethod
-    def quit(cls, wparam=0, lparam=0):
+    def _cleanup(self):
+        self.dispatcher.detach()
+        try:
+            self.hide()
+        except:
+            # Ignore
+            pass
+
+    @marshalled
+    def quit(self, wparam=0, lparam=0):
         """Handles ``WM_STOP``.
 
         This method posts a quit message, causing the mainloop thread to
-        terminate.
+        terminate. From other threads, the call is passed to the mainloop
+        thread first, since quit messages go to the queue of the calling thread.
+
+        Icons hosted by a :class:`manager.TrayManager` are only removed from
+        it, the message loop keeps running for the other icons.
         """
+        if self.manager:
+            self.manager.remove(self)
+            return
         win32.PostQuitMessage(0)
 
     def on_left_click(self, *args):
-        print('left click', args)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('left click', extra={ 'event': 'left_click' })
 
     def on_middle_click(self, *args):
-        print('middle click', args)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('middle click', extra={ 'event': 'middle_click' })
         self.quit()
 
     def on_right_click(self, *args):
-        print('right click', args)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('right click', extra={ 'event': 'right_click' })
         # TrackPopupMenuEx does not behave unless our systray window is the
         # foreground window
         win32.SetForegroundWindow(self._hwnd)
@@ -223,19 +452,20 @@ class SystrayIcon():
         point = wintypes.POINT()
         win32.GetCursorPos(ctypes.byref(point))
 
-        # Display the menu and get the menu item identifier; the identifier
-        # is the menu item index
-        hmenu, descriptors = self._menu_handle
-        index = win32.TrackPopupMenuEx(
-            self.menu,
-            win32.TPM_RIGHTALIGN | win32.TPM_BOTTOMALIGN
-            | win32.TPM_RETURNCMD,
-            point.x,
-            point.y,
-            self._menu_hwnd,
-            None)
-        if index > 0:
-            self.menu_items[index]['callback'](index)
+        # Display the menu and get the command ID of the clicked menu item;
+        # after turning the page of a paged section, the menu is shown again
+        while True:
+            command = win32.TrackPopupMenuEx(
+                self.menu.hmenu,
+                win32.TPM_RIGHTALIGN | win32.TPM_BOTTOMALIGN
+                | win32.TPM_RETURNCMD,
+                point.x,
+                point.y,
+                self._menu_hwnd,
+                None)
+            item = self.menu.activate(command)
+            if not isinstance(item, menu.PageItem):
+                break
 
         win32.PostMessage(self._hwnd, 0, 0, 0)
 
@@ -248,13 +478,22 @@ class SystrayIcon():
         """
 
         if lparam == win32.WM_LBUTTONUP:
-            self.on_left_click()
+            dispatch.schedule(self.metrics.call('left_click', self.on_left_click))
 
         if lparam == win32.WM_MBUTTONUP:
-            self.on_middle_click()
+            dispatch.schedule(self.metrics.call('middle_click', self.on_middle_click))
 
         elif lparam == win32.WM_RBUTTONUP:
-            self.on_right_click(wparam, lparam)
+            # Includes the time the menu is open
+            self.metrics.call('right_click', self.on_right_click, wparam, lparam)
+
+    def _on_init_menu_popup(self, wparam, lparam):
+        """Handles ``WM_INITMENUPOPUP``.
+
+        Submenus are populated right before they are shown for the first time.
+        """
+        if self.menu:
+            self.menu.populate(wparam)
 
     def _on_taskbarcreated(self, wparam, lparam):
         """Handles ``WM_TASKBARCREATED``.
@@ -265,7 +504,8 @@ class SystrayIcon():
         if self.visible:
             self._show()
 
-    def _create_window(self, atom):
+    @staticmethod
+    def _create_window(atom):
         """Creates the system tray icon window.
 
         :param atom: The window class atom.
@@ -292,56 +532,49 @@ class SystrayIcon():
         return hwnd
 
     def create_menu(self, items=None):
-        """Creates a :class:`ctypes.wintypes.HMENU` from a
-        :class:`pystray.Menu` instance.
-
-        :param descriptors: The menu descriptors. If this is falsy, ``None`` is
-            returned.
-
-        :param callbacks: A list to which a callback is appended for every menu
-            item created. The menu item IDs correspond to the items in this
-            list plus one.
+        """Creates a :class:`Win32Menu` from menu items.
 
         :return: a menu
         """
-        # Generate the menu
-        hmenu = win32.CreatePopupMenu()
-        i = 0
-        if items:
-            for item in items:
-                menu_item = self.create_menu_item(index=i, **item)
-                win32.InsertMenuItem(hmenu, i, True, ctypes.byref(menu_item))
-                i += 1
+        return Win32Menu(self.create_menu_item, items, runner=self.run_callback)
 
-        menu_info = win32.MENUINFO(
-            cbSize=ctypes.sizeof(win32.MENUINFO),
-            fMask=win32.MIM_STYLE,
-            dwStyle=win32.MNS_AUTODISMISS | win32.MNS_CHECKORBMP,
-        )
+    def run_callback(self, item, argument, set_busy=None):
+        """Runs the callback of a clicked menu item, on the executor of the
+        item or of the icon if there is one.
+        """
+        return dispatch.run_callback(self.dispatcher, self.executor, item, argument, set_busy, self.metrics)
 
-        #win32.SetMenuInfo(hmenu, ctypes.byref(menu_info))
-        return hmenu
+    def stats(self, format=None):
+        """Returns counts and latency histograms of clicks, menu callbacks and
+        main loop messages, see :class:`metrics.Metrics`. They are only
+        recorded if the icon was created with ``metrics=True``.
 
-    def create_menu_item(self, index, label='', callback=None, variant='default', active=True, enabled=True):
+        :param format: ``'openmetrics'`` for the OpenMetrics text format
+            instead of a dict.
+        """
+        if format == 'openmetrics':
+            return self.metrics.openmetrics(self.dispatcher.dispatched)
+        if format is not None:
+            raise ValueError(f'Unknown format {format!r}')
+        return self.metrics.snapshot(self.dispatcher.dispatched)
 
-        """Creates a :class:`pystray._util.win32.MENUITEMINFO` from a
-        :class:`pystray.MenuItem` instance.
+    def create_menu_item(self, index, label='', callback=None, variant='default', active=True, enabled=True, key=None, submenu=None):
+        """Creates a :class:`win32_adapter.MENUITEMINFO` from a menu item.
 
-        :param descriptor: The menu item descriptor.
+        :param index: The command ID of the menu item.
 
-        :param callbacks: A list to which a callback is appended for every menu
-            item created. The menu item IDs correspond to the items in this
-            list plus one.
+        :param submenu: The HMENU of the submenu, if any.
 
-        :return: a :class:`pystray._util.win32.MENUITEMINFO`
+        :return: a :class:`win32_adapter.MENUITEMINFO`
         """
         default = False
-        checked = False
+        checked = active and variant in ('check', 'radio')
         if variant == 'separator':
             return win32.MENUITEMINFO(
                 cbSize=ctypes.sizeof(win32.MENUITEMINFO),
-                fMask=win32.MIIM_FTYPE,
-                fType=win32.MFT_SEPARATOR)
+                fMask=win32.MIIM_FTYPE | win32.MIIM_ID,
+                fType=win32.MFT_SEPARATOR,
+                wID=index)
         else:
             return win32.MENUITEMINFO(
                 cbSize=ctypes.sizeof(win32.MENUITEMINFO),
@@ -352,14 +585,10 @@ class SystrayIcon():
                 fState=0 | 
                     (win32.MFS_DEFAULT if default else 0) | 
                     (win32.MFS_CHECKED if checked else 0) | 
-                    (win32.MFS_DISABLED if not active else 0),
+                    (win32.MFS_DISABLED if not enabled else 0),
                 fType=win32.MFT_STRING | 
                     (win32.MFT_RADIOCHECK if variant == 'radio' else 0),
-                hSubMenu=None
-                #hSubMenu=self.create_menu(descriptor.submenu, callbacks)
-                #if descriptor.submenu
-                #else None
-                )
+                hSubMenu=submenu)
 
     def _message(self, code, flags, **kwargs):
         """Sends a message the the systray icon.
@@ -374,7 +603,7 @@ class SystrayIcon():
 
         :param kwargs: Data for the :class:`NOTIFYICONDATAW` object.
         """
-        win32.Shell_NotifyIcon(code, win32.NOTIFYICONDATAW(
+        return win32.Shell_NotifyIcon(code, win32.NOTIFYICONDATAW(
             cbSize=ctypes.sizeof(win32.NOTIFYICONDATAW),
             hWnd=self._hwnd,
             hID=id(self),
@@ -382,13 +611,15 @@ class SystrayIcon():
             **kwargs))
 
     def _release_icon(self):
-        """Releases the icon handle and sets it to ``None``.
+        """Destroys the icon handle and sets it to ``None``.
 
-        If not icon handle is set, no action is performed.
+        The handle is a copy of the one in the icon cache, which may evict and
+        destroy its own while the icon is still shown.
         """
-        if self._icon_handle:
+        if self._icon_handle and self._icon_owned:
             win32.DestroyIcon(self._icon_handle)
-            self._icon_handle = None
+        self._icon_handle = None
+        self._icon_owned = False
 
     def load_icon(self):
         """Asserts that the cached icon handle exists.
@@ -396,26 +627,34 @@ class SystrayIcon():
         if self._icon_handle:
             return
 
-        print("load", str(self.icon), self._icon_handle)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug('loading icon %s', self.icon, extra={ 'event': 'load_icon' })
 
-        if self.icon.suffix == '.ico':
-            try:
-                self._icon_handle = win32.LoadImage(None, str(self.icon), win32.IMAGE_ICON, 0, 0, win32.LR_DEFAULTSIZE | win32.LR_LOADFROMFILE)
-                return
-            except OSError as e:
-                pass
+        icon = self.icon
+        size = win32.GetSystemMetrics(win32.SM_CXSMICON)
+        current = self.badge
 
-        if self.icon.suffix == '.png':
-            try:
-                with open(self.icon, "rb") as f:
-                    png = f.read()
-                    self._icon_handle = win32.CreateIconFromResourceEx(png, len(png), 1, 0x30000, 0, 0, win32.LR_DEFAULTSIZE | win32.LR_DEFAULTCOLOR)
-                return
-            except Exception as e:
-                pass
+        try:
+            handle = None
+            if current:
+                try:
+                    handle = cache.icons.get(
+                        cache.key(icon, size, overlay=current), lambda: self._decode_badge(icon, size, current), release=win32.DestroyIcon)
+                except Exception as e:
+                    # Rather the icon without badge than a warning sign
+                    log.warning('Cannot draw badge onto icon %s: %s', icon, e, extra={ 'event': 'load_icon' })
+            if handle is None:
+                handle = cache.icons.get(
+                    cache.key(icon, size), lambda: self._decode_icon(icon, size), release=win32.DestroyIcon)
+            self._icon_handle = win32.CopyIcon(handle)
+            self._icon_owned = True
+            return
+        except Exception as e:
+            pass
 
         # Cannot load icon file from file system
         try:
+            # Shared system icon, never destroyed
             self._icon_handle = win32.LoadIcon(0, win32.IDI_WARNING)
             return
         except OSError as e:
@@ -424,24 +663,95 @@ class SystrayIcon():
         raise OSError(f"Cannot load icon file '{self.icon}'")
 
 
-    def _register_class(self):
-        """Registers the systray window class.
+    def _decode_icon(self, icon, size):
+        """Creates an icon handle from an icon source.
+
+        :return: the handle and the approximate size in bytes
+        """
+        if ico.is_ico(icon):
+            # Only the frame for the small icon size of the system is
+            # passed on, the others are never touched
+            frame = ico.load(icon).best(size)
+            data = frame.data.tobytes()
+            handle = win32.CreateIconFromResourceEx(data, len(data), 1, 0x30000, frame.width, frame.height, win32.LR_DEFAULTCOLOR)
+            if handle:
+                return handle, frame.width * frame.height * 4
+
+        elif (png := self._png_data(icon, size)) is not None:
+            handle = win32.CreateIconFromResourceEx(png, len(png), 1, 0x30000, 0, 0, win32.LR_DEFAULTSIZE | win32.LR_DEFAULTCOLOR)
+            if handle:
+                return handle, size * size * 4
+
+        raise OSError(f"Cannot load icon file '{icon}'")
+
+    def _png_data(self, icon, size):
+        """Returns the PNG data of a PNG or SVG icon source, or ``None`` for
+        other icons. SVGs are rendered at ``size`` with cairosvg.
+        """
+        if isinstance(icon, IconRef):
+            format = icon.format
+            data = icon.data()
+        elif isinstance(icon, pathlib.Path):
+            format = icon.suffix.lower()[1:]
+            data = icon.read_bytes() if format in ('png', 'svg') else None
+        else:
+            data = icons.as_buffer(icon)
+            format = icons.image_format(data) if data is not None else None
+
+        if format == 'png':
+            return bytes(data)
+        if format != 'svg':
+            return None
+
+        # Windows cannot draw SVGs, like the bundled icons
+        try:
+            import cairosvg
+        except ImportError:
+            raise OSError(f"Cannot load SVG icon '{icon}' without cairosvg") from None
+        return cairosvg.svg2png(bytestring=bytes(data), output_width=size, output_height=size)
+
+    def _decode_badge(self, icon, size, current):
+        """Creates an icon handle of an ICO frame or a PNG icon with a badge
+        drawn onto it.
+
+        :return: the handle and the approximate size in bytes
+        """
+        if ico.is_ico(icon):
+            frame = ico.load(icon).best(size)
+        else:
+            png = self._png_data(icon, size)
+            if png is None:
+                raise OSError(f"Cannot draw badge onto icon '{icon}'")
+            frame = ico.IcoFrame.from_png(png)
+        frame = badge.composite_frame(frame, current)
+        data = frame.data.tobytes()
+        handle = win32.CreateIconFromResourceEx(data, len(data), 1, 0x30000, frame.width, frame.height, win32.LR_DEFAULTCOLOR)
+        if not handle:
+            raise OSError(f"Cannot draw badge onto icon '{icon}'")
+        return handle, frame.width * frame.height * 4
+
+    @classmethod
+    def _register_class(cls):
+        """Registers the systray window class once per process.
 
         :return: the class atom
         """
-        return win32.RegisterClassEx(win32.WNDCLASSEX(
-            cbSize=ctypes.sizeof(win32.WNDCLASSEX),
-            style=0,
-            lpfnWndProc=_dispatcher,
-            cbClsExtra=0,
-            cbWndExtra=0,
-            hInstance=win32.GetModuleHandle(None),
-            hIcon=None,
-            hCursor=None,
-            hbrBackground=win32.COLOR_WINDOW + 1,
-            lpszMenuName=None,
-            lpszClassName='%s%dSystemTrayIcon' % (self.tooltip, id(self)),
-            hIconSm=None))
+        with cls._ATOM_LOCK:
+            if cls._ATOM is None:
+                cls._ATOM = win32.RegisterClassEx(win32.WNDCLASSEX(
+                    cbSize=ctypes.sizeof(win32.WNDCLASSEX),
+                    style=0,
+                    lpfnWndProc=_dispatcher,
+                    cbClsExtra=0,
+                    cbWndExtra=0,
+                    hInstance=win32.GetModuleHandle(None),
+                    hIcon=None,
+                    hCursor=None,
+                    hbrBackground=win32.COLOR_WINDOW + 1,
+                    lpszMenuName=None,
+                    lpszClassName='UltraSystrayIcon',
+                    hIconSm=None))
+            return cls._ATOM
 
     def _unregister_class(self, atom):
         """Unregisters the systray window class.
@@ -451,12 +761,251 @@ class SystrayIcon():
         win32.UnregisterClass(atom, win32.GetModuleHandle(None))
 
 
+class Win32Menu():
+    """A popup menu kept in sync with a list of menu items.
+
+    Every menu item gets a command ID of its own that stays the same across
+    updates, so changed items can be addressed without knowing their position.
+    Submenus share the command IDs of their root menu and are empty until
+    :meth:`populate` is called for them.
+    """
+    def __init__(self, create_menu_item, items=None, root=None, runner=None):
+        """
+        :param runner: Called as ``runner(item, command, set_busy)`` to run the
+            callback of a clicked item, see :func:`dispatch.run_callback`.
+            Without it, callbacks are called directly.
+        """
+        self.create_menu_item = create_menu_item
+        self.root = root or self
+        self.hmenu = win32.CreatePopupMenu()
+        #: :class:`menu.MenuEntry` instances in menu order, handles are
+        #: command IDs
+        self.entries = []
+        #: The items shown right now
+        self.items = None
+
+        if self.root is self:
+            #: Command ID -> menu item, for the whole menu tree
+            self.commands = {}
+            # Command ID -> (Win32Menu, menu.Submenu) and HMENU -> the same
+            self.submenus = {}
+            self.popups = {}
+            #: Command IDs of the items whose callbacks are running
+            self.busy = set()
+            self.runner = runner
+            # Zero is returned by TrackPopupMenuEx if nothing was clicked
+            self._next_command = 1
+
+        self.update(items)
+
+    def update(self, items):
+        """Changes the menu to show ``items``.
+
+        :return: the number of changed menu items
+        """
+        items = menu.Menu.coerce(items)
+        if items is self.items:
+            return 0
+        self.items = items
+        for section in items.sections:
+            section.attach(self.refresh)
+        return menu.reconcile(self.entries, items, self)
+
+    def refresh(self):
+        """Shows the current page of all :class:`menu.Paged` sections.
+        """
+        if self.items is not None:
+            menu.reconcile(self.entries, self.items, self)
+
+    def populate(self, hmenu):
+        """Shows the items of the submenu with the handle ``hmenu``, unless
+        they are shown already.
+        """
+        popup = self.root.popups.get(hmenu)
+        if popup:
+            child, submenu = popup
+            child.update(submenu.items())
+
+    def activate(self, command):
+        """Runs the callback of the item with the command ID ``command``.
+
+        :return: the item or ``None``
+        """
+        item = self.root.commands.get(command)
+        if item and item.callback:
+            if self.root.runner:
+                self.root.runner(item, command, lambda busy: self.set_busy(command, busy))
+            else:
+                item.callback(command)
+        return item
+
+    def set_busy(self, command, busy):
+        """Disables an item while its callback is running.
+        """
+        root = self.root
+        if busy:
+            root.busy.add(command)
+        else:
+            root.busy.discard(command)
+
+        item = root.commands.get(command)
+        if item:
+            # Items are also found inside submenus by their command ID
+            info = win32.MENUITEMINFO(
+                cbSize=ctypes.sizeof(win32.MENUITEMINFO),
+                fMask=win32.MIIM_STATE,
+                fState=self._state(command, item))
+            win32.SetMenuItemInfo(root.hmenu, command, False, ctypes.byref(info))
+
+    def _state(self, command, item):
+        return (win32.MFS_CHECKED if item.active and item.variant in ('check', 'radio') else 0) | \
+            (win32.MFS_DISABLED if not item.enabled or command in self.root.busy else 0)
+
+    def destroy(self):
+        # Destroys all submenus as well
+        win32.DestroyMenu(self.hmenu)
+        self.hmenu = None
+
+    def insert_item(self, position, item):
+        root = self.root
+        command = root._next_command
+        root._next_command += 1
+
+        if item.submenu is not None:
+            child = Win32Menu(self.create_menu_item, root=root)
+            root.submenus[command] = root.popups[child.hmenu] = (child, menu.as_submenu(item.submenu))
+
+        info = self._menu_item_info(command, item)
+        win32.InsertMenuItem(self.hmenu, position, True, ctypes.byref(info))
+        root.commands[command] = item
+        return command
+
+    def remove_item(self, entry):
+        # Destroys the submenu as well
+        win32.DeleteMenu(self.hmenu, entry.handle, win32.MF_BYCOMMAND)
+        self._forget(entry.handle)
+
+    def _forget(self, command):
+        root = self.root
+        del root.commands[command]
+        popup = root.submenus.pop(command, None)
+        if popup:
+            child = popup[0]
+            del root.popups[child.hmenu]
+            for entry in child.entries:
+                child._forget(entry.handle)
+
+    def move_item(self, entry, position):
+        # Unlike DeleteMenu, RemoveMenu keeps the submenu
+        win32.RemoveMenu(self.hmenu, entry.handle, win32.MF_BYCOMMAND)
+        info = self._menu_item_info(entry.handle, entry.item)
+        win32.InsertMenuItem(self.hmenu, position, True, ctypes.byref(info))
+
+    def update_item(self, entry, item):
+        old = entry.item
+        if item.variant != old.variant or item.submenu != old.submenu:
+            return None
+        info = self._menu_item_info(entry.handle, item)
+        win32.SetMenuItemInfo(self.hmenu, entry.handle, False, ctypes.byref(info))
+        self.root.commands[entry.handle] = item
+        return entry.handle
+
+    def _menu_item_info(self, command, item):
+        # The MENUITEMINFO of an item is created once and only its command ID,
+        # state and submenu are filled in, Windows copies it on every call
+        if item.compiled is None:
+            item.compiled = {}
+        info = item.compiled.get('win32')
+        if info is None:
+            info = item.compiled['win32'] = self.create_menu_item(
+                0, item.label, item.callback, item.variant, item.active, item.enabled, item.key)
+        info.wID = command
+        info.fState = self._state(command, item)
+        popup = self.root.submenus.get(command)
+        info.hSubMenu = popup[0].hmenu if popup else None
+        return info
+
+
+class MainLoop():
+    """The message loop of a :class:`manager.TrayManager`, shared by all its
+    icons.
+
+    Calls from other threads are passed in with a message to a window of its
+    own, since thread messages get lost while a menu is open.
+    """
+    def __init__(self):
+        self._hwnd = None
+        self._drain = None
+        self._message_handlers = {
+            win32.WM_DISPATCH: lambda wparam, lparam: self._drain(),
+        }
+
+    def wakeup(self, drain):
+        self._drain = drain
+        if self._hwnd:
+            win32.PostMessage(self._hwnd, win32.WM_DISPATCH, 0, 0)
+
+    def run(self, start):
+        """Runs the message loop until :meth:`quit` is called.
+
+        :param start: Called in the loop thread before the first message.
+        """
+        self._hwnd = SystrayIcon._create_window(SystrayIcon._register_class())
+        SystrayIcon._HWND_TO_ICON[self._hwnd] = self
+        try:
+            start()
+            # Calls from other threads before the window existed
+            if self._drain:
+                self._drain()
+            _pump()
+        finally:
+            del SystrayIcon._HWND_TO_ICON[self._hwnd]
+            win32.DestroyWindow(self._hwnd)
+            self._hwnd = None
+
+    def quit(self):
+        win32.PostQuitMessage(0)
+
+
+def _pump():
+    """Dispatches the messages of the calling thread until ``WM_QUIT``.
+    """
+    try:
+        msg = wintypes.MSG()
+        lpmsg = ctypes.byref(msg)
+        while True:
+            r = win32.GetMessage(lpmsg, None, 0, 0)
+            if not r:
+                break
+            elif r == -1:
+                break
+            else:
+                win32.TranslateMessage(lpmsg)
+                win32.DispatchMessage(lpmsg)
+
+    except Exception:
+        log.exception('An error occurred in the main loop')
+        raise
+
+
+#: Names of the handled messages in the metrics
+_MESSAGE_NAMES = {
+    win32.WM_STOP: 'WM_STOP',
+    win32.WM_NOTIFY: 'WM_NOTIFY',
+    win32.WM_TIMER: 'WM_TIMER',
+    win32.WM_INITMENUPOPUP: 'WM_INITMENUPOPUP',
+    win32.WM_DISPATCH: 'WM_DISPATCH',
+    win32.WM_TASKBARCREATED: 'WM_TASKBARCREATED',
+}
+
+
 @win32.TypeMessageHandler
 def _dispatcher(hwnd, uMsg, wParam, lParam):
     """The function used as window procedure for the systray window.
     """
 
-    #print('dispatcher', uMsg, wParam, lParam)
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug('message %s', _MESSAGE_NAMES.get(uMsg, uMsg), extra={ 'event': 'message', 'window_message': uMsg, 'wparam': wParam, 'lparam': lParam })
 
     # These messages are sent before Icon._HWND_TO_ICON[hwnd] has been set, so
     # we handle them explicitly
@@ -470,10 +1019,18 @@ def _dispatcher(hwnd, uMsg, wParam, lParam):
     except KeyError:
         return win32.DefWindowProc(hwnd, uMsg, wParam, lParam)
 
+    handler = icon._message_handlers.get(uMsg)
+    if handler is None:
+        return 0
+
+    # The window of a MainLoop has no metrics
+    metrics = getattr(icon, 'metrics', None)
+    if metrics is not None:
+        metrics.count(_MESSAGE_NAMES.get(uMsg, uMsg))
+
     try:
-        return int(icon._message_handlers.get(
-            uMsg, lambda w, l: 0)(wParam, lParam) or 0)
+        return int(handler(wParam, lParam) or 0)
 
-    except Exception as e:
-        print('An error occurred when calling message handler')
-        raise e
+    except Exception:
+        log.exception('An error occurred when calling message handler', extra={ 'event': 'message', 'window_message': uMsg })
+        raise
@@ -23,6 +23,9 @@ windll = ctypes.LibraryLoader(ctypes.WinDLL)
 
 
 WM_CREATE = 0x0001
+WM_QUIT = 0x0012
+WM_TIMER = 0x0113
+WM_INITMENUPOPUP = 0x0117
 WM_NCCREATE = 0x0081
 WM_LBUTTONUP = 0x0202
 WM_MBUTTONUP = 0x0208
@@ -32,10 +35,14 @@ WM_USER = 0x400
 
 WM_STOP = WM_USER + 10
 WM_NOTIFY = WM_USER + 11
+WM_DISPATCH = WM_USER + 12
 
 LR_DEFAULTSIZE = 0x00000040
 LR_LOADFROMFILE = 0x00000010
 
+MF_BYCOMMAND = 0x00000000
+MF_BYPOSITION = 0x00000400
+
 MFS_CHECKED = 0x00000008
 MFS_DEFAULT = 0x00001000
 MFS_DISABLED = 0x00000003
@@ -122,6 +129,7 @@ WS_POPUP = 0x80000000
 
 
 PM_NOREMOVE = 0
+PM_REMOVE = 1
 COLOR_WINDOW = 5
 HWND_MESSAGE = -3
 IMAGE_ICON = 1
@@ -253,6 +261,12 @@ def _err(result, func, arguments):
 
 LPWNDCLASSEX = ctypes.POINTER(WNDCLASSEX)
 
+CopyIcon = windll.user32.CopyIcon
+CopyIcon.argtypes = (
+    wintypes.HICON,)
+CopyIcon.restype = wintypes.HICON
+CopyIcon.errcheck = _err
+
 CreateIconFromResource = windll.user32.CreateIconFromResource
 CreateIconFromResourceEx = windll.user32.CreateIconFromResourceEx
 LR_DEFAULTCOLOR = 0
@@ -277,6 +291,12 @@ DefWindowProc.argtypes = (
     wintypes.HWND, wintypes.UINT, wintypes.WPARAM, wintypes.LPARAM)
 DefWindowProc.restype = wintypes.DWORD
 
+DeleteMenu = windll.user32.DeleteMenu
+DeleteMenu.argtypes = (
+    wintypes.HMENU, wintypes.UINT, wintypes.UINT)
+DeleteMenu.restype = wintypes.BOOL
+DeleteMenu.errcheck = _err
+
 DestroyIcon = windll.user32.DestroyIcon
 DestroyIcon.argtypes = (
     wintypes.HICON,)
@@ -311,6 +331,13 @@ GetMessage.argtypes = (
     LPMSG, wintypes.HWND, wintypes.UINT, wintypes.UINT)
 GetMessage.restype = wintypes.BOOL
 
+GetSystemMetrics = windll.user32.GetSystemMetrics
+GetSystemMetrics.argtypes = (
+    wintypes.INT,)
+GetSystemMetrics.restype = wintypes.INT
+SM_CXSMICON = 49
+SM_CYSMICON = 50
+
 GetModuleHandle = windll.kernel32.GetModuleHandleW
 GetModuleHandle.argtypes = (
     wintypes.LPCWSTR,)
@@ -347,6 +374,12 @@ PostQuitMessage = windll.user32.PostQuitMessage
 PostQuitMessage.argtypes = (
     wintypes.INT,)
 
+RemoveMenu = windll.user32.RemoveMenu
+RemoveMenu.argtypes = (
+    wintypes.HMENU, wintypes.UINT, wintypes.UINT)
+RemoveMenu.restype = wintypes.BOOL
+RemoveMenu.errcheck = _err
+
 RegisterClassEx = windll.user32.RegisterClassExW
 RegisterClassEx.argtypes = (
     LPWNDCLASSEX,)
@@ -357,9 +390,25 @@ SetForegroundWindow = windll.user32.SetForegroundWindow
 SetForegroundWindow.argtypes = (wintypes.HWND,)
 SetForegroundWindow.restype = wintypes.BOOL
 
+SetTimer = windll.user32.SetTimer
+SetTimer.argtypes = (
+    wintypes.HWND, ctypes.c_size_t, wintypes.UINT, wintypes.LPVOID)
+SetTimer.restype = ctypes.c_size_t
+
+KillTimer = windll.user32.KillTimer
+KillTimer.argtypes = (
+    wintypes.HWND, ctypes.c_size_t)
+KillTimer.restype = wintypes.BOOL
+
 SetMenuInfo = windll.user32.SetMenuInfo
 SetMenuInfo.argtypes = (wintypes.HMENU, LPMENUINFO)
 
+SetMenuItemInfo = windll.user32.SetMenuItemInfoW
+SetMenuItemInfo.argtypes = (
+    wintypes.HMENU, wintypes.UINT, wintypes.BOOL, LPMENUITEMINFO)
+SetMenuItemInfo.restype = wintypes.BOOL
+SetMenuItemInfo.errcheck = _err
+
 
 Shell_NotifyIcon = windll.shell32.Shell_NotifyIconW
 Shell_NotifyIcon.argtypes = (
@@ -0,0 +1,75 @@
+# UltraSystray
+#
+# Copyright (C) 2022 Ronny Rentner
+#
+# Checks the import time of the package and its backends against the budget.
+#
+# Every module is imported in a fresh interpreter with `python -X importtime`,
+# the fastest of a few runs counts. Modules that can't be imported on this
+# platform, e.g. the win32 backend on Linux, are skipped.
+#
+#   python benchmark/importtime.py [--runs 5] [module ...]
+#
+
+import argparse, pathlib, subprocess, sys
+
+root = pathlib.Path(__file__).parent.parent
+
+#: Cumulative import time budget per module in milliseconds
+BUDGET = {
+    'UltraSystray': 5,
+    'UltraSystray.menu': 10,
+    'UltraSystray.dispatch': 40,
+    'UltraSystray.icons': 50,
+    'UltraSystray.manager': 50,
+    'UltraSystray.gtk': 250,
+    'UltraSystray.appindicator': 250,
+    'UltraSystray.win32': 80,
+    'UltraSystray.null': 60,
+}
+
+def measure(module):
+    """Returns the cumulative import time of a module in milliseconds, or
+    ``None`` if it can't be imported.
+    """
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        cwd=root, capture_output=True, text=True)
+    if result.returncode:
+        return None
+
+    # Lines look like "import time: self [us] | cumulative | name", the module
+    # itself is the last line with its name
+    for line in reversed(result.stderr.splitlines()):
+        fields = line.split('|')
+        if len(fields) == 3 and fields[2].strip() == module:
+            return int(fields[1]) / 1000
+    return None
+
+def main():
+    parser = argparse.ArgumentParser(description='Checks import times against the budget')
+    parser.add_argument('--runs', type=int, default=5, help='Imports per module, the fastest counts')
+    parser.add_argument('modules', nargs='*', default=list(BUDGET))
+    args = parser.parse_args()
+
+    over = 0
+    for module in args.modules:
+        times = [measure(module) for _ in range(args.runs)]
+        if None in times:
+            print(f'{module:28} skipped, cannot be imported here')
+            continue
+
+        best = min(times)
+        budget = BUDGET.get(module)
+        if budget is None:
+            print(f'{module:28} {best:7.1f} ms')
+            continue
+
+        ok = best <= budget
+        over += not ok
+        print(f'{module:28} {best:7.1f} ms  budget {budget:4} ms  {"ok" if ok else "OVER BUDGET"}')
+
+    return 1 if over else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
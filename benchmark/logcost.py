@@ -0,0 +1,68 @@
+# UltraSystray
+#
+# Measures what logging costs per tray event while the DEBUG level is
+# disabled, which it is unless the application configures logging.
+#
+# Compares a bare event, the guarded debug call the backends use, an unguarded
+# debug call with structured fields, and the print() they used before. Also
+# runs a menu callback through dispatch.run_callback() with logging disabled
+# and enabled.
+#
+#   python benchmark/logcost.py [--number 200000]
+#
+
+import argparse, io, logging, pathlib, sys, timeit
+
+root = pathlib.Path(__file__).parent.parent
+sys.path.insert(0, str(root))
+
+from UltraSystray import dispatch
+from UltraSystray.menu import MenuItem
+
+log = logging.getLogger('UltraSystray.benchmark')
+
+def bare(args):
+    pass
+
+def guarded(args):
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug('left click', extra={ 'event': 'left_click' })
+
+def unguarded(args):
+    log.debug('left click %r', args, extra={ 'event': 'left_click' })
+
+def printed(args):
+    print('left click', args)
+
+def main():
+    parser = argparse.ArgumentParser(description='Measures the per-event cost of disabled logging')
+    parser.add_argument('--number', type=int, default=200000, help='Events per measurement')
+    args = parser.parse_args()
+
+    def measure(statement):
+        # The fastest of a few repeats, in nanoseconds per event
+        return min(timeit.repeat(statement, number=args.number, repeat=5)) / args.number * 1e9
+
+    event = (object(), 3, 0)
+    stdout = sys.stdout
+    results = {}
+    for function in (bare, guarded, unguarded):
+        results[function.__name__] = measure(lambda: function(event))
+    # What every click cost before, with stdout captured by a service manager
+    sys.stdout = io.StringIO()
+    try:
+        results['print'] = measure(lambda: printed(event))
+    finally:
+        sys.stdout = stdout
+
+    item = MenuItem('Sync', callback=bare, key='sync')
+    results['menu callback'] = measure(lambda: dispatch.run_callback(None, None, item, None))
+    logging.basicConfig(level=logging.DEBUG, stream=io.StringIO())
+    results['menu callback, DEBUG'] = measure(lambda: dispatch.run_callback(None, None, item, None))
+
+    for name, ns in results.items():
+        print(f'{name:24} {ns:8.1f} ns per event')
+    print(f'{"guarded - bare":24} {results["guarded"] - results["bare"]:8.1f} ns per event')
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,4 @@
-import pathlib, sys, time, threading
+import concurrent.futures, pathlib, sys, time
 
 # Make the example find UltraSystray relative to itself
 sys.path.append(str(pathlib.Path(__file__).parent.parent))
@@ -13,35 +13,35 @@ assert icon_file.exists()
 
 def do_something(menu_item):
     print("Doing something for 5 seconds...")
-    print("This will block the UI!")
+    print("This runs on the executor and does not block the UI")
     time.sleep(5)
     print("Done...")
 
 def update_menu():
     pass
 
-def run_thread():
-    # In order for the icon to be displayed, you must provide an icon
-    tray = SystrayIcon(icon=icon_file, tooltip='Systray demo')
-    tray.menu_items = [
-        { 'label': 'Choice 1', 'variant': 'radio', 'callback': do_something },
-        { 'label': 'Choice 2', 'variant': 'radio', 'callback': do_something },
-        { 'label': 'Choice 3', 'variant': 'radio', 'callback': do_something },
-        { 'variant': 'separator' },
-        { 'label': 'Another entry', 'callback': do_something },
-        { 'label': 'Do something', 'callback': do_something },
-        { 'variant': 'separator' },
-        { 'label': 'Quit', 'callback': tray.quit }
-    ]
-
-    # Create system tray window and show it
-    tray.run()
-
-thread = threading.Thread(target=run_thread)
-thread.start()
-
-print("Tray started")
+# In order for the icon to be displayed, you must provide an icon
+# Menu callbacks run on the executor, their item is disabled meanwhile
+tray = SystrayIcon(icon=icon_file, tooltip='Systray demo', executor=concurrent.futures.ThreadPoolExecutor())
+tray.menu_items = [
+    { 'label': 'Choice 1', 'variant': 'radio', 'callback': do_something },
+    { 'label': 'Choice 2', 'variant': 'radio', 'callback': do_something },
+    { 'label': 'Choice 3', 'variant': 'radio', 'callback': do_something },
+    { 'variant': 'separator' },
+    { 'label': 'Another entry', 'callback': do_something },
+    { 'label': 'Do something', 'callback': do_something },
+    { 'variant': 'separator' },
+    { 'label': 'Quit', 'callback': tray.quit, 'executor': False }
+]
+
+# Create system tray window and show it on a thread of its own
+tray.start(timeout=5)
+
+print(f"Tray started in {tray.startup_duration:.3f}s")
 
 print("Doing something else for 5 seconds")
 time.sleep(5)
 print("Done")
+
+tray.stop(timeout=5)
+print(f"Tray stopped in {tray.shutdown_duration:.3f}s")
@@ -9,13 +9,39 @@ long_description = (this_directory / "README.md").read_text()
 
 version = '0.0.2'
 
-def glob(*patterns):
-    package_path = this_directory / 'UltraSystray'
-    icon_path = this_directory / 'icons'
-    result = []
-    for pattern in patterns:
-        result.extend([str(path.relative_to(package_path)) for path in package_path.glob(pattern)])
-    return result
+from setuptools.command.build_py import build_py
+from setuptools.command.sdist import sdist
+
+def pack_icons():
+    """Packs the icons tree into a single archive, together with its index, so
+    that installs don't have to unpack thousands of tiny files.
+
+    An sdist only contains the archive, it is used as it is.
+    """
+    from UltraSystray.icons import Manifest
+    from UltraSystray.archive import pack
+
+    icons = this_directory / 'icons'
+    archive = this_directory / 'UltraSystray' / 'icons.pack'
+    if not icons.is_dir():
+        if not archive.is_file():
+            sys.exit(f"Neither the icons tree '{icons}' nor the archive '{archive}' exist")
+        return
+
+    manifest = Manifest.build(icons)
+    if not len(manifest):
+        sys.exit(f"No icons found in '{icons}'")
+    pack(manifest, archive)
+
+class BuildPy(build_py):
+    def run(self):
+        pack_icons()
+        super().run()
+
+class Sdist(sdist):
+    def run(self):
+        pack_icons()
+        super().run()
 
 setup(
     name='UltraSystray',
@@ -36,5 +62,6 @@ setup(
         ':sys_platform == "darwin"': [],
     },
     #include_package_data=True,
-    package_data={'UltraSystray': glob('../icons/**/*.svg', '../icons/**/*.ico', '../icons/**/*.png')},
+    package_data={'UltraSystray': ['icons.pack']},
+    cmdclass={'build_py': BuildPy, 'sdist': Sdist},
 )
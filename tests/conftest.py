@@ -0,0 +1,52 @@
+import struct
+import zlib
+
+import pytest
+
+from UltraSystray import ico
+
+
+def _paeth(left, up, upper_left):
+    estimate = left + up - upper_left
+    if abs(estimate - left) <= abs(estimate - up) and abs(estimate - left) <= abs(estimate - upper_left):
+        return left
+    if abs(estimate - up) <= abs(estimate - upper_left):
+        return up
+    return upper_left
+
+
+def encode_png(width, height, pixels, color_type=6, filters=(0,), palette=None, transparency=None):
+    """Encodes raw pixels as PNG, cycling through ``filters`` row by row.
+    """
+    channels = ico.PNG_CHANNELS[color_type]
+    stride = width * channels
+    raw = bytearray()
+    prior = bytes(stride)
+    for y in range(height):
+        row = pixels[y * stride:(y + 1) * stride]
+        kind = filters[y % len(filters)]
+        raw.append(kind)
+        for i, value in enumerate(row):
+            left = row[i - channels] if i >= channels else 0
+            up = prior[i]
+            upper_left = prior[i - channels] if i >= channels else 0
+            predictor = (0, left, up, (left + up) >> 1, _paeth(left, up, upper_left))[kind]
+            raw.append((value - predictor) & 0xff)
+        prior = row
+
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+    chunks = [chunk(b'IHDR', ico.PNG_IHDR.pack(width, height, 8, color_type, 0, 0, 0))]
+    if palette is not None:
+        chunks.append(chunk(b'PLTE', palette))
+    if transparency is not None:
+        chunks.append(chunk(b'tRNS', transparency))
+    chunks.append(chunk(b'IDAT', zlib.compress(bytes(raw))))
+    chunks.append(chunk(b'IEND', b''))
+    return ico.PNG_SIGNATURE + b''.join(chunks)
+
+
+@pytest.fixture
+def png():
+    return encode_png
@@ -0,0 +1,79 @@
+import pytest
+
+from UltraSystray import archive, icons
+
+SVG = b'<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 24 24">' + b'<path d="M0 0h24v24H0z"/>' * 8 + b'</svg>'
+
+
+@pytest.fixture
+def tree(tmp_path, png):
+    root = tmp_path / 'icons'
+    (root / 'material' / 'action').mkdir(parents=True)
+    (root / 'material' / 'action' / 'home-24px.svg').write_bytes(SVG)
+    (root / 'material' / 'action' / 'home-outlined-24px.svg').write_bytes(SVG)
+    (root / 'material' / 'action' / 'search-48px.svg').write_bytes(SVG.replace(b'24 24', b'48 48'))
+    (root / 'logo.png').write_bytes(png(16, 16, bytes(range(256)) * 4))
+    return root
+
+
+def test_build_scans_the_tree(tree):
+    manifest = icons.Manifest.build(tree)
+
+    assert sorted(manifest.names()) == ['home', 'logo', 'search']
+    home = manifest.get('home')
+    assert (home.family, home.category, home.variant, home.size, home.format) == ('material', 'action', 'filled', 24, 'svg')
+    assert manifest.get('home', variant='outlined').path == 'material/action/home-outlined-24px.svg'
+    assert manifest.get('logo').size == 16
+    assert manifest.get('missing') is None
+
+
+@pytest.mark.parametrize('compress', [False, True])
+def test_pack_round_trip(tree, tmp_path, compress):
+    manifest = icons.Manifest.build(tree)
+    path = tmp_path / 'icons.pack'
+    assert archive.pack(manifest, path, compress=compress) == path.stat().st_size
+
+    with archive.IconArchive(path) as packed:
+        assert len(packed) == len(manifest)
+        for entry in manifest.entries:
+            stored = packed.get(entry.name, entry.variant, entry.size, entry.format)
+            assert bytes(packed.data(stored)) == bytes(manifest.data(entry))
+            assert packed.path(stored) is None
+
+        compressions = {entry.compression for entry in packed.entries}
+        assert compressions == ({'zlib', ''} if compress else {''})
+
+
+def test_identical_files_are_stored_once(tree, tmp_path):
+    manifest = icons.Manifest.build(tree)
+    path = tmp_path / 'icons.pack'
+    archive.pack(manifest, path)
+
+    with archive.IconArchive(path) as packed:
+        filled = packed.get('home', variant='filled')
+        outlined = packed.get('home', variant='outlined')
+        assert filled.hash == outlined.hash
+        assert filled.offset == outlined.offset
+
+
+def test_refs_materialize_archived_icons(tree, tmp_path):
+    manifest = icons.Manifest.build(tree)
+    path = tmp_path / 'icons.pack'
+    archive.pack(manifest, path)
+
+    assert archive.IconRef(manifest, manifest.get('logo')).materialize() == tree / 'logo.png'
+
+    with archive.IconArchive(path) as packed:
+        ref = archive.IconRef(packed, packed.get('logo'))
+        assert ref.name == 'logo' and ref.format == 'png'
+        materialized = ref.materialize(tmp_path / 'cache')
+        assert materialized.parent == tmp_path / 'cache'
+        assert materialized.read_bytes() == bytes(ref.data())
+        assert ref.materialize(tmp_path / 'cache') == materialized
+
+
+def test_invalid_archives_are_rejected(tmp_path):
+    path = tmp_path / 'icons.pack'
+    path.write_bytes(b'\0' * 64)
+    with pytest.raises(ValueError):
+        archive.IconArchive(path)
@@ -0,0 +1,102 @@
+import random
+
+import pytest
+
+from UltraSystray import badge, ico
+
+
+def pixels(count, seed=0):
+    generator = random.Random(seed)
+    return bytes(generator.randrange(256) for _ in range(count))
+
+
+def test_encode_and_parse_round_trip(png):
+    rgba = pixels(16 * 16 * 4)
+    frames = [ico.IcoFrame.from_rgba(16, 16, rgba), ico.IcoFrame.from_png(png(32, 32, pixels(32 * 32 * 4)))]
+
+    parsed = ico.IcoFile(ico.encode(frames))
+
+    assert parsed.sizes() == [16, 32]
+    assert [frame.format for frame in parsed] == ['bmp', 'png']
+    assert parsed.frames[0].rgba() == rgba
+    assert bytes(parsed.frames[1].data) == bytes(frames[1].data)
+
+
+def test_large_frames_take_their_size_from_the_png_header(png):
+    parsed = ico.IcoFile(ico.encode([ico.IcoFrame.from_png(png(300, 1, pixels(300 * 4)))]))
+    assert (parsed.frames[0].width, parsed.frames[0].height) == (300, 1)
+
+
+def test_best_prefers_exact_then_larger_frames():
+    frames = [ico.IcoFrame.from_rgba(size, size, bytes(size * size * 4)) for size in (16, 32, 48)]
+    parsed = ico.IcoFile(ico.encode(frames))
+
+    assert parsed.best(32).width == 32
+    assert parsed.best(24).width == 32
+    assert parsed.best(16, scale=2).width == 32
+    assert parsed.best(64).width == 48
+
+
+def test_invalid_data_is_rejected():
+    with pytest.raises(ValueError):
+        ico.IcoFile(b'\0\0')
+    with pytest.raises(ValueError):
+        ico.IcoFile(b'\0\0\2\0\0\0')
+    with pytest.raises(ValueError):
+        ico.IcoFrame.from_rgba(2, 2, bytes(3))
+    with pytest.raises(ValueError):
+        ico.IcoFrame.from_png(b'not a png')
+
+
+def test_is_ico():
+    data = ico.encode([ico.IcoFrame.from_rgba(1, 1, bytes(4))])
+    assert ico.is_ico(data)
+    assert ico.is_ico(bytearray(data))
+    assert ico.is_ico(memoryview(data))
+    assert not ico.is_ico(memoryview(b'\x89PNG'))
+    assert not ico.is_ico(b'\x89PNG')
+    assert not ico.is_ico('name')
+
+
+@pytest.mark.parametrize('filters', [(0,), (1,), (2,), (3,), (4,), (0, 1, 2, 3, 4)])
+def test_decode_png_reverses_all_filters(png, filters):
+    rgba = pixels(7 * 5 * 4, seed=len(filters))
+    assert ico.decode_png(png(7, 5, rgba, filters=filters)) == (7, 5, rgba)
+
+
+def test_decode_png_color_types(png):
+    rgb = pixels(3 * 2 * 3)
+    rgba = ico.decode_png(png(3, 2, rgb, color_type=2, filters=(4,)))[2]
+    assert rgba[0::4] == rgb[0::3] and rgba[2::4] == rgb[2::3] and rgba[3::4] == b'\xff' * 6
+
+    gray_alpha = pixels(3 * 2 * 2)
+    rgba = ico.decode_png(png(3, 2, gray_alpha, color_type=4, filters=(1,)))[2]
+    assert rgba[1::4] == gray_alpha[0::2] and rgba[3::4] == gray_alpha[1::2]
+
+    palette = bytes((255, 0, 0, 0, 0, 255))
+    rgba = ico.decode_png(png(2, 1, bytes((0, 1)), color_type=3, palette=palette, transparency=b'\x80'))[2]
+    assert rgba == bytes((255, 0, 0, 128, 0, 0, 255, 255))
+
+
+def test_decode_png_rejects_unsupported_data(png):
+    with pytest.raises(ValueError):
+        ico.decode_png(b'not a png')
+
+    sixteen_bit = bytearray(png(1, 1, bytes(4)))
+    # Bit depth in the IHDR chunk
+    sixteen_bit[24] = 16
+    with pytest.raises(ValueError):
+        ico.decode_png(bytes(sixteen_bit))
+
+
+def test_badges_are_drawn_on_png_and_bmp_frames(png):
+    transparent = bytes(32 * 32 * 4)
+    current = badge.make(3)
+
+    for frame in (ico.IcoFrame.from_png(png(32, 32, transparent)), ico.IcoFrame.from_rgba(32, 32, transparent)):
+        badged = badge.composite_frame(frame, current)
+        assert (badged.format, badged.width, badged.height) == ('bmp', 32, 32)
+        rgba = badged.rgba()
+        # Top right is covered by the badge, bottom left is untouched
+        assert rgba[(4 * 32 + 27) * 4 + 3] == 255
+        assert rgba[(31 * 32) * 4 + 3] == 0
@@ -0,0 +1,180 @@
+import pytest
+
+from UltraSystray import menu
+from UltraSystray.menu import Menu, MenuItem, Paged, Submenu
+
+
+class Recorder():
+    """A live menu that is a list of labels, the backend of :func:`menu.reconcile`.
+    """
+    def __init__(self):
+        self.labels = []
+        self.calls = []
+
+    def insert_item(self, position, item):
+        self.calls.append('insert')
+        self.labels.insert(position, item.label)
+        return object()
+
+    def remove_item(self, entry):
+        self.calls.append('remove')
+        self.labels.remove(entry.item.label)
+
+    def move_item(self, entry, position):
+        self.calls.append('move')
+        self.labels.remove(entry.item.label)
+        self.labels.insert(position, entry.item.label)
+
+    def update_item(self, entry, item):
+        if item.variant != entry.item.variant:
+            return None
+        self.calls.append('update')
+        self.labels[self.labels.index(entry.item.label)] = item.label
+        return entry.handle
+
+
+def items(*labels):
+    return [{'key': label, 'label': label} for label in labels]
+
+
+def unkeyed(*labels):
+    return [{'label': label} for label in labels]
+
+
+def show(backend, entries, new):
+    backend.calls.clear()
+    menu.reconcile(entries, new, backend)
+    assert backend.labels == [entry.item.label for entry in entries]
+    return backend.calls
+
+
+def test_first_reconcile_inserts_everything():
+    backend, entries = Recorder(), []
+    assert show(backend, entries, items('a', 'b', 'c')) == ['insert'] * 3
+    assert backend.labels == ['a', 'b', 'c']
+
+
+def test_unchanged_menu_costs_nothing():
+    backend, entries = Recorder(), []
+    show(backend, entries, items('a', 'b', 'c'))
+    assert show(backend, entries, items('a', 'b', 'c')) == []
+    assert menu.reconcile(entries, items('a', 'b', 'c'), backend) == 0
+
+
+def test_insert_and_remove_only_touch_the_changed_items():
+    backend, entries = Recorder(), []
+    show(backend, entries, items('a', 'b', 'c'))
+    assert show(backend, entries, items('a', 'x', 'c')) == ['remove', 'insert']
+    assert backend.labels == ['a', 'x', 'c']
+
+
+def test_reordering_moves_as_few_items_as_possible():
+    backend, entries = Recorder(), []
+    show(backend, entries, items('a', 'b', 'c', 'd', 'e'))
+    assert show(backend, entries, items('e', 'a', 'b', 'c', 'd')) == ['move']
+    assert show(backend, entries, items('a', 'b', 'c', 'd', 'e')) == ['move']
+    assert sorted(show(backend, entries, items('e', 'd', 'c', 'b', 'a'))) == ['move'] * 4
+
+
+def test_changed_items_are_updated_or_recreated():
+    backend, entries = Recorder(), []
+    show(backend, entries, items('a', 'b'))
+    handle = entries[1].handle
+
+    assert show(backend, entries, [{'key': 'a', 'label': 'a'}, {'key': 'b', 'label': 'B'}]) == ['update']
+    assert entries[1].handle is handle
+
+    assert show(backend, entries, [{'key': 'a', 'label': 'a'}, {'key': 'b', 'label': 'B', 'variant': 'check'}]) == ['remove', 'insert']
+    assert entries[1].handle is not handle
+    # Recreating counts as a single operation
+    assert menu.reconcile(entries, items('a', 'b'), backend) == 1
+
+
+def test_items_without_key_are_matched_by_label():
+    backend, entries = Recorder(), []
+    show(backend, entries, unkeyed('a', 'b', 'a'))
+    assert [entry.key for entry in entries] == [('default', 'a', 0), ('default', 'b', 0), ('default', 'a', 1)]
+    assert show(backend, entries, unkeyed('b', 'a')) == ['remove', 'move']
+
+
+def test_duplicate_keys_are_rejected():
+    with pytest.raises(ValueError):
+        Menu(items('a', 'a'))
+
+
+def test_invalid_items_are_rejected():
+    with pytest.raises(ValueError):
+        MenuItem('a', variant='unknown')
+    with pytest.raises(TypeError):
+        MenuItem('a', callback='not callable')
+    with pytest.raises(ValueError):
+        Menu([{'label': 'a', 'unknown': True}])
+
+
+def test_paged_sections_show_one_page():
+    section = Paged(unkeyed(*(f'item {i}' for i in range(5))), page_size=2, key='list')
+    backend, entries = Recorder(), []
+
+    show(backend, entries, [{'label': 'top'}, section])
+    assert backend.labels == ['top', 'item 0', 'item 1', 'More…']
+
+    section.turn(2)
+    assert show(backend, entries, [{'label': 'top'}, section]) == ['update', 'update', 'insert']
+    assert backend.labels == ['top', 'Previous', 'item 2', 'item 3', 'More…']
+
+    section.turn(4)
+    show(backend, entries, [{'label': 'top'}, section])
+    assert backend.labels == ['top', 'Previous', 'item 4']
+
+
+def test_turning_a_page_refreshes_attached_menus():
+    section = Paged(lambda index: {'label': f'item {index}'}, length=lambda: 3, page_size=2)
+
+    class Listener():
+        refreshed = 0
+
+        def refresh(self):
+            self.refreshed += 1
+
+    listener = Listener()
+    section.attach(listener.refresh)
+    section.attach(listener.refresh)
+
+    section.next_page()
+    assert listener.refreshed == 1
+    assert [key for key, item in section.window()] == [('paged', 'previous'), ('paged', 'row', 0)]
+
+    section.previous_page()
+    assert listener.refreshed == 2
+    assert section.offset == 0
+
+    with pytest.raises(ValueError):
+        Paged(lambda index: index)
+
+
+def test_submenus_call_their_provider_once_until_invalidated():
+    calls = []
+
+    def provider():
+        calls.append(1)
+        return unkeyed('a', 'b')
+
+    submenu = Submenu(provider)
+    assert submenu.items() is submenu.items()
+    assert len(calls) == 1
+
+    submenu.invalidate()
+    submenu.items()
+    assert len(calls) == 2
+
+    uncached = Submenu(provider, cache=False)
+    uncached.items()
+    uncached.items()
+    assert len(calls) == 4
+
+
+def test_as_submenu():
+    submenu = Submenu(list)
+    assert menu.as_submenu(submenu) is submenu
+    assert menu.as_submenu(lambda: unkeyed('a')).items() == Menu(unkeyed('a'))
+    assert menu.as_submenu(unkeyed('a', 'b')).items() == Menu(unkeyed('a', 'b'))
@@ -0,0 +1,221 @@
+import asyncio
+import concurrent.futures
+import threading
+
+import pytest
+
+from UltraSystray import null
+from UltraSystray.manager import TrayManager
+
+
+def names(icon):
+    return [operation[0] for operation in icon.operations]
+
+
+def test_show_creates_the_menu():
+    icon = null.SystrayIcon(icon='icon.png', tooltip='Tooltip', menu_items=[{'key': 'a', 'label': 'A'}, {'key': 'b', 'label': 'B'}])
+    icon.show()
+
+    assert icon.visible
+    assert names(icon) == ['show', 'insert_item', 'insert_item', 'set_menu', 'update_icon', 'set_tooltip']
+    assert icon.startup_profile.phases['embedded'] is not None
+
+
+def test_activate_runs_callbacks():
+    clicked = []
+    icon = null.SystrayIcon(menu_items=[
+        {'key': 'a', 'label': 'A', 'callback': clicked.append},
+        {'key': 'sub', 'label': 'Sub', 'submenu': lambda: [{'key': 'b', 'label': 'B', 'callback': clicked.append}]},
+        {'label': 'No callback'},
+    ])
+    icon.show()
+
+    assert icon.activate('a', argument=1).result().result() is None
+    icon.activate('sub', 'b', argument=2)
+    assert icon.activate('No callback').result() is None
+    assert clicked == [1, 2]
+    assert ('open', 'sub') in icon.operations
+
+    with pytest.raises(ValueError):
+        icon.activate('a', 'b')
+    with pytest.raises(KeyError):
+        icon.activate('missing')
+
+
+def test_changed_labels_are_updated_in_place():
+    icon = null.SystrayIcon(menu_items=[{'key': 'a', 'label': 'A'}, {'key': 'b', 'label': 'B'}])
+    icon.show()
+    icon.operations.clear()
+
+    icon.update_menu([{'key': 'a', 'label': 'A'}, {'key': 'b', 'label': 'Changed'}])
+    assert names(icon) == ['update_item']
+
+    icon.operations.clear()
+    icon.update_menu(icon.menu_items)
+    assert icon.operations == []
+
+
+def test_disabled_items_cannot_be_activated():
+    icon = null.SystrayIcon(menu_items=[{'key': 'a', 'label': 'A', 'enabled': False, 'callback': print}])
+    icon.show()
+    with pytest.raises(ValueError):
+        icon.activate('a')
+
+
+def test_clicks():
+    icon = null.SystrayIcon(menu_items=[{'key': 'a', 'label': 'A'}])
+    icon.show()
+
+    icon.click('right')
+    assert icon.operations[-2:] == [('click', 'right'), ('popup_menu',)]
+    icon.click('left')
+    icon.click('middle')
+    assert not icon.visible
+    with pytest.raises(ValueError):
+        icon.click('other')
+
+
+def test_calls_from_other_threads_run_in_the_main_loop():
+    icon = null.SystrayIcon(menu_items=[{'key': 'a', 'label': 'A'}])
+    icon.start(timeout=5)
+    try:
+        assert icon.ready.is_set()
+        threads = []
+        future = icon.dispatcher.call(lambda: threads.append(threading.get_ident()))
+        future.result(timeout=5)
+        assert threads == [icon._thread.ident]
+
+        icon.set_tooltip('Changed').result(timeout=5)
+        assert icon.tooltip == 'Changed'
+        assert icon.dispatcher.dispatched >= 2
+    finally:
+        icon.stop(timeout=5)
+
+    assert icon.dispatcher.ended
+    with pytest.raises(RuntimeError):
+        icon.set_tooltip('Too late')
+    # Stopping again does nothing
+    icon.stop(timeout=5)
+
+
+def test_calls_before_the_main_loop_runs():
+    icon = null.SystrayIcon()
+    # The creating thread sets the icon up directly
+    assert icon.set_tooltip('Direct').done()
+
+    calls = []
+    def call():
+        calls.append(icon.dispatcher.call(lambda: threading.get_ident()))
+    caller = threading.Thread(target=call)
+    caller.start()
+    caller.join()
+    # Other threads wait for the main loop
+    assert not calls[0].done()
+
+    loop = threading.Thread(target=icon.run)
+    loop.start()
+    try:
+        assert calls[0].result(timeout=5) == loop.ident
+    finally:
+        icon.quit()
+        loop.join(5)
+
+
+def test_stopping_an_icon_that_never_ran_does_nothing():
+    icon = null.SystrayIcon()
+    icon.stop(timeout=5)
+    assert icon.operations == []
+    assert not icon.dispatcher.ended
+
+
+def test_icons_can_be_restarted():
+    icon = null.SystrayIcon()
+    for _ in range(2):
+        icon.start(timeout=5)
+        assert icon.visible
+        icon.stop(timeout=5)
+        assert not icon.visible
+
+
+def test_callbacks_run_on_the_executor():
+    started = threading.Event()
+    release = threading.Event()
+
+    def callback(argument):
+        started.set()
+        release.wait(5)
+        return threading.get_ident()
+
+    with concurrent.futures.ThreadPoolExecutor(1) as executor:
+        icon = null.SystrayIcon(executor=executor, menu_items=[{'key': 'a', 'label': 'A', 'callback': callback}])
+        icon.start(timeout=5)
+        try:
+            future = icon.activate('a').result(timeout=5)
+            started.wait(5)
+            assert icon.menu.busy == {'a'}
+            with pytest.raises(ValueError):
+                icon.activate('a').result(timeout=5)
+
+            release.set()
+            assert future.result(timeout=5) != icon._thread.ident
+            # Enabled again in the main loop once the callback has finished
+            icon.dispatcher.call(lambda: None).result(timeout=5)
+            assert icon.menu.busy == set()
+            assert ('set_busy', 'a', False) in icon.operations
+        finally:
+            release.set()
+            icon.stop(timeout=5)
+
+
+def test_metrics():
+    icon = null.SystrayIcon(metrics=True, menu_items=[{'key': 'a', 'label': 'A', 'callback': lambda argument: None}])
+    icon.show()
+    icon.activate('a')
+    icon.click('left')
+
+    stats = icon.stats()
+    assert stats['events']['menu']['count'] == 1
+    assert stats['events']['left_click']['count'] == 1
+    assert stats['menu_items']['a']['count'] == 1
+    assert icon.stats('openmetrics').endswith('# EOF\n')
+    with pytest.raises(ValueError):
+        icon.stats('xml')
+
+
+def test_manager_hosts_several_icons():
+    manager = TrayManager(null)
+    first = manager.create(tooltip='First')
+    second = manager.create(tooltip='Second')
+    manager.start(timeout=5)
+    try:
+        assert first.visible and second.visible
+        assert first.dispatcher is second.dispatcher is manager.dispatcher
+
+        first.quit().result(timeout=5)
+        assert not first.visible and second.visible
+        assert first.manager is None
+    finally:
+        manager.stop(timeout=5)
+    assert not second.visible
+
+
+def test_run_async_runs_coroutine_callbacks():
+    clicked = []
+
+    async def callback(argument):
+        await asyncio.sleep(0)
+        clicked.append(argument)
+
+    icon = null.SystrayIcon(menu_items=[{'key': 'a', 'label': 'A', 'callback': callback}])
+
+    async def main():
+        runner = asyncio.ensure_future(icon.run_async())
+        await asyncio.sleep(0)
+        task = icon.activate('a', argument='value').result()
+        await task
+        icon.quit()
+        await runner
+
+    asyncio.run(main())
+    assert clicked == ['value']
+    assert not icon.visible